@@ -1,18 +1,37 @@
-import React, { useEffect, useState } from "react";
+import React, { useEffect, useRef, useState } from "react";
 import { ProgressSpinner } from "primereact/progressspinner";
 import { Dropdown } from "primereact/dropdown";
 import { MultiSelect } from "primereact/multiselect";
-import { createChartData } from "../utils/chartUtils";
+import { createChartData, getColumns, getHeaders } from "../utils/chartUtils";
 import ChartDisplay from "./ChartDisplay";
 import { Accordion, AccordionTab } from "primereact/accordion";
 import { DataTable } from "primereact/datatable";
 import { Column } from "primereact/column";
 
+// What the job works on after each reported step
+const STEP_LABELS = {
+  started: "Finding keywords...",
+  keywords: "Looking up tables...",
+  tables: "Writing the SQL query...",
+  sql: "Running the query...",
+  results: "Preparing the chart...",
+  coalesced: "Preparing the chart...",
+};
+
+// Rows asked of the server for charting; larger results come back downsampled
+const CHART_MAX_POINTS = 5000;
+const JOB_POLL_INTERVAL_MS = 1000;
+
 const QueryCard = ({ query, chartType = "bar", response: initialResponse = null }) => {
   const [loading, setLoading] = useState(true);
   const [chartData, setChartData] = useState(null);
   const [response, setResponse] = useState(initialResponse);
   const [sqlQuery, setSqlQuery] = useState("");
+  const [step, setStep] = useState(null);
+  const [error, setError] = useState(null);
+  // Pending poll, cleared on unmount so a closed card stops polling
+  const pollTimeout = useRef(null);
+  const unmounted = useRef(false);
   const [selectedChartType, setSelectedChartType] = useState(chartType);
 
   const [xField, setXField] = useState(null);
@@ -31,7 +50,7 @@ const QueryCard = ({ query, chartType = "bar", response: initialResponse = null
 
   const processResponse = (result) => {
     if (result?.result) {
-      const [headers, rows] = result.result;
+      const headers = getHeaders(result);
 
       // Set default x/y fields if not already set
       if (!xField) setXField(headers[0]);
@@ -51,23 +70,80 @@ const QueryCard = ({ query, chartType = "bar", response: initialResponse = null
     }
   };
 
+  // Runs the request as a background job and polls its status with short
+  // requests, so a pending card never holds a server thread while it waits
   const fetchData = async () => {
     setLoading(true);
+    setStep(null);
+    setError(null);
     const databaseName = localStorage.getItem("databaseName");
-    const baseURL = `${window.location.protocol}//${window.location.hostname}:${window.location.port}/request`;
-
-    const res = await fetch(baseURL, {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ query, databaseName }),
-    });
-
-    const result = await res.json();
-    setResponse(result);
-    processResponse(result);
-    setLoading(false);
+    const baseURL = `${window.location.protocol}//${window.location.hostname}:${window.location.port}`;
+
+    const fail = (message) => {
+      if (unmounted.current) return;
+      setError(message);
+      setLoading(false);
+    };
+
+    let job;
+    try {
+      const res = await fetch(`${baseURL}/request/jobs`, {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ query, databaseName }),
+      });
+      job = await res.json();
+      if (!res.ok) {
+        fail(job.message || `Could not submit the request (${res.status})`);
+        return;
+      }
+    } catch (error) {
+      fail(`Could not submit the request: ${error.message}`);
+      return;
+    }
+
+    const poll = async () => {
+      pollTimeout.current = null;
+      let status;
+      try {
+        const statusRes = await fetch(
+          `${baseURL}${job.status_url}?format=columnar-packed&max_points=${CHART_MAX_POINTS}`
+        );
+        status = await statusRes.json();
+        if (!statusRes.ok) {
+          fail(status.message || `Job status failed (${statusRes.status})`);
+          return;
+        }
+      } catch (error) {
+        fail(`Lost track of the request: ${error.message}`);
+        return;
+      }
+      if (unmounted.current) return;
+      if (status.status === "error") {
+        fail(status.error?.message || "The request failed");
+        return;
+      }
+      if (status.status === "done") {
+        setResponse(status);
+        processResponse(status);
+        setLoading(false);
+        return;
+      }
+      const steps = status.steps || [];
+      if (steps.length) setStep(steps[steps.length - 1].step);
+      pollTimeout.current = setTimeout(poll, JOB_POLL_INTERVAL_MS);
+    };
+    poll();
   };
 
+  useEffect(() => {
+    unmounted.current = false;
+    return () => {
+      unmounted.current = true;
+      clearTimeout(pollTimeout.current);
+    };
+  }, []);
+
   useEffect(() => {
     if (response) {
       processResponse(response);
@@ -79,7 +155,7 @@ const QueryCard = ({ query, chartType = "bar", response: initialResponse = null
   }, [query, response, selectedChartType, xField, yFields]);
 
   const columnOptions =
-    response?.result?.[0]?.map((col) => ({ label: col, value: col })) || [];
+    getHeaders(response).map((col) => ({ label: col, value: col }));
 
   return (
     <div>
@@ -89,6 +165,7 @@ const QueryCard = ({ query, chartType = "bar", response: initialResponse = null
             {loading ? (
               <div className="w3-center">
                 <ProgressSpinner />
+                {step && <p className="text-sm text-500">{STEP_LABELS[step] || step}</p>}
               </div>
             ) : chartData ? (
               <>
@@ -130,10 +207,17 @@ const QueryCard = ({ query, chartType = "bar", response: initialResponse = null
                     title={query}
                   />
                 )}
+                {response?.downsampled && (
+                  <p className="w3-small">
+                    Showing {getColumns(response).rowCount} of {response.row_count} rows ({response.downsampled})
+                  </p>
+                )}
                 <pre>
                   <code>{sqlQuery}</code>
                 </pre>
               </>
+            ) : error ? (
+              <p className="w3-red w3-padding">{error}</p>
             ) : (
               <p>No data to display.</p>
             )}
@@ -19,6 +19,7 @@ const SqlRun = () => {
                 body: JSON.stringify({
                     query,
                     databaseName,
+                    format: "columnar-packed",
                 }),
             });
             if (!res.ok) {
@@ -8,8 +8,56 @@ const getColor = (i) => {
     return colors[i % colors.length];
   };
   
-  export const createChartData = ({ result }, config) => {
-    const [headers, rows] = result;
+  const decodeBase64 = (text, ArrayType) => {
+    const bytes = Uint8Array.from(atob(text), (c) => c.charCodeAt(0));
+    return new ArrayType(bytes.buffer);
+  };
+
+  const isColumnar = (response) => typeof response?.format === "string" && response.format.startsWith("columnar");
+
+  // Decoded columns per response object, so changing the chart config does not decode again
+  const decodedColumns = new WeakMap();
+
+  /**
+   * Result of /request or /run-sql as { headers, columns, rowCount }, one array per column.
+   * Columnar responses ("columnar" / "columnar-packed") are used as they are, with packed
+   * numeric columns decoded into Float64Array / Int32Array; row results are transposed.
+   */
+  export const getColumns = (response) => {
+    if (decodedColumns.has(response)) return decodedColumns.get(response);
+    let decoded;
+    if (isColumnar(response)) {
+      const { headers, columns, row_count: rowCount } = response.result;
+      decoded = {
+        headers,
+        rowCount,
+        columns: columns.map((column) => {
+          if (column.f64 !== undefined) return decodeBase64(column.f64, Float64Array);
+          if (column.i32 !== undefined) return decodeBase64(column.i32, Int32Array);
+          return column.values;
+        }),
+      };
+    } else {
+      const [headers, rows] = response.result;
+      decoded = {
+        headers,
+        rowCount: rows.length,
+        columns: headers.map((_, j) => rows.map((row) => row[j])),
+      };
+    }
+    decodedColumns.set(response, decoded);
+    return decoded;
+  };
+
+  export const getHeaders = (response) => {
+    if (!response?.result) return [];
+    return isColumnar(response) ? response.result.headers : response.result[0];
+  };
+
+  const toNumbers = (column) => Array.from(column, (value) => Number(value) || 0);
+
+  export const createChartData = (response, config) => {
+    const { headers, columns, rowCount } = getColumns(response);
     const {
       chartType,
       xField,
@@ -32,7 +80,7 @@ const getColor = (i) => {
     const rIndex = rField ? headers.indexOf(rField) : null;
     const labelIndex = labelsField ? headers.indexOf(labelsField) : null;
   
-    const labels = rows.map((row) => row[xIndex]);
+    const labels = Array.from(columns[xIndex]);
   
     const commonOptions = {
       plugins: {
@@ -60,7 +108,7 @@ const getColor = (i) => {
           labels,
           datasets: yFields.map((field, i) => ({
             label: field,
-            data: rows.map((row) => Number(row[yIndices[i]]) || 0),
+            data: toNumbers(columns[yIndices[i]]),
             backgroundColor: getColor(i),
             borderColor: getColor(i),
             fill: chartType === "radar",
@@ -71,8 +119,8 @@ const getColor = (i) => {
     }
   
     if (["pie", "doughnut", "polarArea"].includes(chartType)) {
-      const data = rows.map((row) => Number(row[yIndices[0]]) || 0);
-      const pieLabels = labelIndex !== null ? rows.map((row) => row[labelIndex]) : labels;
+      const data = toNumbers(columns[yIndices[0]]);
+      const pieLabels = labelIndex !== null ? Array.from(columns[labelIndex]) : labels;
       return {
         data: {
           labels: pieLabels,
@@ -87,14 +135,16 @@ const getColor = (i) => {
     }
   
     if (chartType === "bubble") {
+      const x = columns[xIndex];
+      const r = rIndex !== null ? columns[rIndex] : null;
       return {
         data: {
           datasets: yFields.map((field, i) => ({
             label: field,
-            data: rows.map((row) => ({
-              x: Number(row[xIndex]) || 0,
-              y: Number(row[yIndices[i]]) || 0,
-              r: rIndex !== null ? Number(row[rIndex]) || 5 : 5,
+            data: Array.from(columns[yIndices[i]], (y, row) => ({
+              x: Number(x[row]) || 0,
+              y: Number(y) || 0,
+              r: r !== null ? Number(r[row]) || 5 : 5,
             })),
             backgroundColor: getColor(i),
           })),
@@ -104,13 +154,14 @@ const getColor = (i) => {
     }
   
     if (chartType === "scatter") {
+      const x = columns[xIndex];
       return {
         data: {
           datasets: yFields.map((field, i) => ({
             label: field,
-            data: rows.map((row) => ({
-              x: Number(row[xIndex]) || 0,
-              y: Number(row[yIndices[i]]) || 0,
+            data: Array.from(columns[yIndices[i]], (y, row) => ({
+              x: Number(x[row]) || 0,
+              y: Number(y) || 0,
             })),
             backgroundColor: getColor(i),
           })),
@@ -120,13 +171,16 @@ const getColor = (i) => {
     }
 
     if (chartType === "table") {
-      const columns = headers.map((header) => ({
+      const tableColumns = headers.map((header) => ({
         field: header,
         header,
       }));
       return {
-        data: rows.map((row) => Object.fromEntries(headers.map((h) => [h, row[h]]))),
-        options: { columns },
+        data: Array.from({ length: rowCount }, (_, row) =>
+          // Packed float columns carry NULL as NaN
+          Object.fromEntries(headers.map((h, j) => [h, Number.isNaN(columns[j][row]) ? null : columns[j][row]]))
+        ),
+        options: { columns: tableColumns },
       };
     }
   
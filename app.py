@@ -1,8 +1,29 @@
 import traceback
-from flask import Flask, request, jsonify, render_template, send_from_directory
+import io
+import sqlite3
+import json
+import shutil
+import tempfile
+import time
+import uuid
+from flask import Flask, Response, g, request, jsonify, render_template, send_from_directory
 from functions.run import get_sql_query, generate_questions
-from functions.sql import SqlConn
-from functions.database import get_sql_query as sql_run
+from functions.sql import SqlConn, QueryLimitExceeded, SqlValidationError
+from functions.pool import close_all_pools
+from functions.database import get_sql_query as sql_run, stream_sql_query, get_schema_version
+from functions.cache import LRUCache
+from functions.schema_cache import schema_cache
+from functions.result_cache import result_cache
+from functions.query_store import query_store, normalize_prompt
+from functions.ingest import CountingReader, get_progress
+from functions.bulk_ingest import bulk_ingest
+from functions.index_advisor import index_advisor
+from functions.columnar import encode_result, json_body, COLUMNAR_MEDIA_TYPE, RESULT_FORMATS
+from functions.metrics import registry as metrics_registry, observe as observe_metric, METRICS
+from functions.downsample import downsample, CHART_MAX_POINTS, METHODS as DOWNSAMPLE_METHODS
+from functions.jobs import job_manager, JobQueueFull
+from functions.singleflight import SingleFlight, SingleFlightTimeout
+from functions.llm import LLMError
 # enable CORS
 from flask_cors import CORS
 import dotenv
@@ -17,6 +38,12 @@ CORS(app)
 
 FAKE_CHARTS = os.getenv("FAKE_CHARTS") == "true" or os.getenv("FAKE_CHARTS") == "1" or os.getenv("FAKE_CHARTS") == "True"
 DEBUG = os.getenv("DEBUG") == "true" or os.getenv("DEBUG") == "1" or os.getenv("DEBUG") == "True"
+QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "3600")) or None
+# Waitress worker threads. Each open SSE stream of /request/jobs/<id>/events keeps one busy
+WAITRESS_THREADS = int(os.getenv("WAITRESS_THREADS", "16"))
+JOB_EVENTS_MAX_SECONDS = float(os.getenv("JOB_EVENTS_MAX_SECONDS", "30"))  # an SSE stream is closed (and resumed by the client) after this
+JOB_EVENTS_HEARTBEAT = 10  # seconds between keep-alive comments on an idle SSE stream
 
 print(f'''
 
@@ -26,6 +53,77 @@ Model : {os.getenv("OLLAMA_MODEL")}
 
 ''')
 
+query_store.warm_load()
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    '''
+    Latency per route into aisql_request_seconds. For streamed responses
+    this is the time until the body starts.
+    '''
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        observe_metric('aisql_request_seconds', time.perf_counter() - started,
+                       route=route, method=request.method, status=response.status_code)
+    return response
+
+def error_payload(e):
+    '''JSON body describing a failed request or job.'''
+    if isinstance(e, QueryLimitExceeded):
+        return {'status': 'error', **e.to_dict()}
+    if isinstance(e, SqlValidationError):
+        return {'status': 'error', 'error': 'invalid_sql', 'message': str(e), 'query': e.query}
+    if isinstance(e, LLMError):
+        return {'status': 'error', 'error': 'llm_error', 'message': str(e)}
+    if isinstance(e, sqlite3.Error):
+        return {'status': 'error', 'error': 'sql_error', 'message': str(e)}
+    return {'status': 'error', 'error': 'internal', 'message': str(e)}
+
+@app.errorhandler(QueryLimitExceeded)
+def query_limit_exceeded(e):
+    '''A query went over SQL_TIMEOUT / SQL_MAX_ROWS / SQL_MAX_BYTES.'''
+    return jsonify(error_payload(e)), 422
+
+@app.errorhandler(SqlValidationError)
+def sql_validation_error(e):
+    '''Generated SQL that still failed validation after the retries.'''
+    return jsonify(error_payload(e)), 400
+
+class InvalidField(ValueError):
+    '''A request field of the wrong type or out of range.'''
+
+    def __init__(self, field, message):
+        super().__init__(message)
+        self.field = field
+
+@app.errorhandler(InvalidField)
+def invalid_field(e):
+    return jsonify({'status': 'error', 'error': 'invalid_field', 'field': e.field, 'message': str(e)}), 400
+
+@app.errorhandler(sqlite3.Error)
+def sql_error(e):
+    '''SQL passed to /run-sql that SQLite rejected (syntax error, unknown table, ...).'''
+    return jsonify(error_payload(e)), 400
+
+@app.errorhandler(LLMError)
+def llm_error(e):
+    '''The LLM backend failed with a permanent error, or a transient one past the client's retries.'''
+    return jsonify(error_payload(e)), 502
+
+@app.errorhandler(SingleFlightTimeout)
+def single_flight_timeout(e):
+    '''An identical request was already running and did not finish in time.'''
+    return jsonify({'status': 'error', 'error': 'timeout', 'message': str(e)}), 504
+
+@app.errorhandler(JobQueueFull)
+def job_queue_full(e):
+    return jsonify({'status': 'error', 'error': 'job_queue_full', 'message': str(e)}), 503, {'Retry-After': '5'}
+
 # Serve static files and fallback to index.html for React-style routing
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
@@ -36,11 +134,106 @@ def serve(path):
         return send_from_directory(app.static_folder, 'index.html')  # just serve the file
 
 
-query_cache = {}
+def get_stream_format(data):
+    '''
+    Streaming is requested with a `stream` field ("ndjson" or "json") or an
+    `Accept: application/x-ndjson` header. Returns None for a plain response.
+    '''
+    stream = data.get('stream')
+    if stream in ('json', 'ndjson'):
+        return stream
+    if stream in (True, 'true', '1', 'True'):
+        return 'ndjson'
+    if 'application/x-ndjson' in request.headers.get('Accept', ''):
+        return 'ndjson'
+    return None
+
+def get_int_field(data, name, minimum=0):
+    '''Integer field `name` of a request, None when missing; InvalidField (400) below `minimum` or not an integer.'''
+    value = data.get(name)
+    if value is None:
+        return None
+    try:
+        if isinstance(value, (bool, float)):
+            raise ValueError(value)
+        value = int(value)
+    except (TypeError, ValueError):
+        raise InvalidField(name, f"{name} must be an integer, got {value!r}") from None
+    if value < minimum:
+        raise InvalidField(name, f"{name} must be at least {minimum}, got {value}")
+    return value
+
+def get_bypass_cache(data):
+    '''
+    A `bypass_cache` field or a `Cache-Control: no-cache` header skips the
+    response and SQL result caches; the fresh result is cached again.
+    '''
+    if data.get('bypass_cache') in (True, 'true', '1', 'True'):
+        return True
+    return 'no-cache' in request.headers.get('Cache-Control', '')
+
+def get_result_format(data):
+    '''
+    Result layout: a `format` field ("rows", "columnar" or "columnar-packed"),
+    or an `Accept: application/vnd.aisql.columnar+json` header (with
+    "; encoding=packed" for typed-array numeric columns). Rows by default.
+    '''
+    result_format = data.get('format')
+    if result_format in RESULT_FORMATS:
+        return result_format
+    accept = request.headers.get('Accept', '')
+    if COLUMNAR_MEDIA_TYPE in accept:
+        return 'columnar-packed' if 'encoding=packed' in accept else 'columnar'
+    return 'rows'
+
+def downsample_result(response, data):
+    '''
+    Chart points of a full (unpaged) result, for clients that ask for them
+    with `max_points` and/or `downsample`: about `max_points` rows
+    (CHART_MAX_POINTS by default, 0 for all), reduced with `downsample`
+    ("lttb", "minmax", "top_n", or chosen from the data). Adds the original
+    "row_count" and the "downsampled" method (None when unchanged). Without
+    either field the result is returned as it is.
+    '''
+    if 'result' not in response or 'next_cursor' in response:
+        return response
+    max_points = get_int_field(data, 'max_points')
+    method = data.get('downsample') if data.get('downsample') in DOWNSAMPLE_METHODS else None
+    if max_points is None and method is None:
+        return response
+    max_points = CHART_MAX_POINTS if max_points is None else max_points
+    headers, rows = response['result']
+    reduced, used = downsample(headers, rows, max_points, method)
+    return dict(response, result=[headers, reduced], row_count=len(rows), downsampled=used)
+
+def result_response(response, data):
+    '''JSON response of a query result in the requested layout, gzipped if the client accepts it.'''
+    response = downsample_result(response, data)
+    result_format = get_result_format(data)
+    body, headers = json_body(encode_result(response, result_format), request.headers.get('Accept-Encoding', ''))
+    mimetype = 'application/json' if result_format == 'rows' else COLUMNAR_MEDIA_TYPE
+    return Response(body, mimetype=mimetype, headers=headers)
+
+def run_sql_response(sql, db_name, data):
+    '''Streamed or paginated response for an SQL query, honouring limit/cursor.'''
+    fmt = get_stream_format(data)
+    limit = get_int_field(data, 'limit', minimum=1)
+    cursor = get_int_field(data, 'cursor')
+    if fmt:
+        mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+        return Response(stream_sql_query(sql, db_name, fmt=fmt, limit=limit, cursor=cursor), mimetype=mimetype)
+    return result_response(sql_run(sql, db_name, limit=limit, cursor=cursor, use_cache=not get_bypass_cache(data)), data)
+
+
+# /request responses keyed by (databaseName, schema version, query)
+query_cache = LRUCache(max_bytes=QUERY_CACHE_MAX_BYTES, ttl=QUERY_CACHE_TTL)
+# Identical requests in flight at the same time share one pipeline run,
+# keyed by (databaseName, normalized prompt[, execute]) and databaseName
+request_flight = SingleFlight('request')
+questions_flight = SingleFlight('questions')
 
 @app.route('/request', methods=['POST'])
 def process_request():
-    global query_cache
     if request.headers['Content-Type'] == 'application/x-www-form-urlencoded':
         data = request.form
     else:
@@ -114,18 +307,126 @@ def process_request():
                 ]
         }
     query = data['query']
-    if query in query_cache:
-        return query_cache[query]
-    else:
+    if get_stream_format(data) or data.get('limit') is not None or data.get('cursor') is not None:
+        # Generate the SQL only, then stream/page it instead of materializing the result
         print("User Query:", query)
-        response = get_sql_query(query, db_name=data['databaseName'])
-        query_cache[query] = response
+        db_name = data['databaseName']
+        response, _ = request_flight.do((db_name, normalize_prompt(query), False),
+                                        lambda: get_sql_query(query, db_name=db_name, execute=False))
+        return run_sql_response(response['query'], db_name, data)
+    return result_response(answer_request(data['databaseName'], query, use_cache=not get_bypass_cache(data)), data)
+
+def answer_request(db_name, query, progress=None, use_cache=True):
+    '''
+    Full response of a natural language request, from query_cache when
+    possible (use_cache=False skips it and the SQL result cache). Concurrent
+    identical requests wait for the one already running (progress then only
+    gets a "coalesced" step).
+    '''
+    cache_key = (db_name, get_schema_version(db_name), query)
+    response = query_cache.get(cache_key) if use_cache else None
+    if response is None:
+        def compute():
+            print("User Query:", query)
+            computed = get_sql_query(query, db_name=db_name, progress=progress, use_cache=use_cache)
+            query_cache.set(cache_key, computed)
+            return computed
+
+        response, shared = request_flight.do((db_name, normalize_prompt(query), True), compute)
+        if shared and progress:
+            progress('coalesced')
+    return response
+
+@app.route('/request/jobs', methods=['POST'])
+def submit_request_job():
+    '''
+    Asynchronous /request: returns a job id right away (202) and runs the
+    pipeline on the job executor. Follow it with GET /request/jobs/<id>
+    (status, and the result in the /request formats once done) or the
+    server-sent events of /request/jobs/<id>/events.
+    '''
+    data = request.get_json()
+    db_name = data['databaseName']
+    query = data['query']
+    use_cache = not get_bypass_cache(data)
+
+    def run(report):
+        response = answer_request(db_name, query, progress=report, use_cache=use_cache)
+        if 'result' in response:
+            headers, rows = response['result']
+            report('results', row_count=len(rows), columns=headers)
         return response
 
+    job = job_manager.submit('request', run, error_payload=error_payload, databaseName=db_name, query=query)
+    return jsonify({
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': f'/request/jobs/{job.id}',
+        'events_url': f'/request/jobs/{job.id}/events',
+    }), 202
+
+@app.route('/request/jobs/<job_id>', methods=['GET'])
+def request_job_status(job_id):
+    '''Job status and steps; once done also the result (format, max_points, downsample query parameters apply).'''
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Unknown job id'}), 404
+    status = job.to_dict()
+    if status['status'] == 'done':
+        return result_response({**status, **job.result}, request.args)
+    return jsonify(status)
+
+@app.route('/request/jobs/<job_id>/events', methods=['GET'])
+def request_job_events(job_id):
+    '''
+    Server-sent events of a job: one "step" event per progress step and a
+    final "done" event with the status. An open stream occupies a server
+    thread (see WAITRESS_THREADS) until the job finishes or
+    JOB_EVENTS_MAX_SECONDS pass, when EventSource reconnects with
+    Last-Event-ID and resumes. The web frontend polls the status route
+    instead, which only takes a thread per request.
+    '''
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Unknown job id'}), 404
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('since'))
+    try:
+        since = int(last_event_id) + 1 if last_event_id not in (None, '') else 0
+    except ValueError:
+        return jsonify({'status': 'error', 'message': f'Invalid Last-Event-ID: {last_event_id}'}), 400
+
+    def events():
+        nonlocal since
+        deadline = time.monotonic() + JOB_EVENTS_MAX_SECONDS
+        yield 'retry: 1000\n\n'
+        while time.monotonic() < deadline:
+            new_events, finished = job.wait(since, min(JOB_EVENTS_HEARTBEAT, max(0, deadline - time.monotonic())))
+            for event in new_events:
+                yield f"id: {event['id']}\nevent: step\ndata: {json.dumps(event, default=str)}\n\n"
+                since = event['id'] + 1
+            if finished:
+                status = job.to_dict()
+                status.pop('steps')
+                yield f"event: done\ndata: {json.dumps(status, default=str)}\n\n"
+                return
+            if not new_events:
+                yield ': keep-alive\n\n'
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route("/run-sql", methods=['POST'])
 def run_sql():
     data = request.get_json()
-    return sql_run(data["query"],data["databaseName"])
+    return run_sql_response(data["query"], data["databaseName"], data)
+
+def get_import_options(data):
+    '''Optional table layout flags of an import (strict, without_rowid); unset ones use the env defaults.'''
+    options = {}
+    for name in ('strict', 'without_rowid'):
+        if name in data:
+            options[name] = data[name] in (True, 'true', '1', 'True')
+    return options
 
 @app.route('/create-database', methods=['POST'])
 def create_database():
@@ -139,27 +440,153 @@ def create_database():
         csv_string = data['csv_string']
         db_name = data['db_name']
 
-        conn = SqlConn.create_new_database(csv_title, csv_string, db_name)
-        columns = conn.get_database_structure()
+        with SqlConn.create_new_database(csv_title, csv_string, db_name, **get_import_options(data)) as conn:
+            columns = conn.get_database_structure()
+        query_cache.invalidate(lambda key: key[0] == db_name)
 
         return jsonify({'status': 'success', 'database': conn.db_path, 'table': csv_title, 'columns': columns})
 
     except Exception as e:
         return jsonify({'status': 'error', 'traceback': traceback.format_exc() }), 500
 
+@app.route('/create-database/upload', methods=['POST'])
+def upload_database():
+    '''
+    Streaming import for large CSVs: either a multipart form with a `file`
+    part, or the raw CSV as the (possibly chunked) request body with
+    csv_title/db_name in the query string. Pass an upload_id to follow
+    the import on /create-database/progress/<upload_id>.
+    '''
+    try:
+        upload = request.files.get('file')
+        if upload is not None:
+            stream = upload.stream
+            csv_title = request.form.get('csv_title') or upload.filename
+        else:
+            stream = request.stream
+            csv_title = request.args.get('csv_title')
+        db_name = request.values.get('db_name')
+        upload_id = request.values.get('upload_id') or uuid.uuid4().hex
+
+        if not csv_title or not db_name:
+            return jsonify({'status': 'error', 'message': 'Missing required fields'}), 400
+
+        counter = CountingReader(stream)
+        text = io.TextIOWrapper(io.BufferedReader(counter), encoding='utf-8', newline='')
+        with SqlConn.ingest_csv_stream(text, csv_title, db_name, upload_id=upload_id, counter=counter,
+                                       **get_import_options(request.values)) as conn:
+            columns = conn.get_database_structure()
+        query_cache.invalidate(lambda key: key[0] == db_name)
+
+        progress = get_progress(upload_id)
+        return jsonify({'status': 'success', 'database': conn.db_path, 'table': progress['table'],
+                        'rows': progress['rows'], 'upload_id': upload_id, 'columns': columns})
+
+    except Exception as e:
+        return jsonify({'status': 'error', 'traceback': traceback.format_exc() }), 500
+
+@app.route('/create-database/bulk', methods=['POST'])
+def bulk_upload_database():
+    '''
+    Bulk import of a zip or tar archive of CSVs, one table per file: a
+    multipart form with a `file` part, or the raw archive as the request
+    body with db_name in the query string. Files are loaded in parallel
+    (functions.bulk_ingest) and likely foreign keys between the tables are
+    inferred and indexed. Pass an upload_id to follow it on
+    /create-database/progress/<upload_id>.
+    '''
+    archive_path = None
+    try:
+        upload = request.files.get('file')
+        stream = upload.stream if upload is not None else request.stream
+        db_name = request.values.get('db_name')
+        upload_id = request.values.get('upload_id') or uuid.uuid4().hex
+
+        if not db_name:
+            return jsonify({'status': 'error', 'message': 'Missing required fields'}), 400
+
+        # Workers read the archive from disk, so spool the upload next to the databases
+        os.makedirs(SqlConn.base_path, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=SqlConn.base_path, prefix='.upload-', delete=False) as archive:
+            archive_path = archive.name
+            shutil.copyfileobj(stream, archive)
+
+        db_path = os.path.join(SqlConn.base_path, db_name)
+        loaded = bulk_ingest(archive_path, db_path, upload_id=upload_id, **get_import_options(request.values))
+        with SqlConn(db_name) as conn:
+            columns = conn.get_database_structure()
+        query_cache.invalidate(lambda key: key[0] == db_name)
+
+        return jsonify({'status': 'success', 'database': conn.db_path, 'upload_id': upload_id,
+                        'tables': loaded['tables'], 'relationships': loaded['relationships'], 'columns': columns})
+
+    except Exception as e:
+        return jsonify({'status': 'error', 'traceback': traceback.format_exc() }), 500
+    finally:
+        if archive_path is not None and os.path.exists(archive_path):
+            os.remove(archive_path)
+
+@app.route('/create-database/progress/<upload_id>', methods=['GET'])
+def upload_progress(upload_id):
+    progress = get_progress(upload_id)
+    if progress is None:
+        return jsonify({'status': 'error', 'message': 'Unknown upload id'}), 404
+    return jsonify(progress)
+
+@app.route('/index-advice', methods=['GET', 'POST'])
+def index_advice():
+    '''
+    Index suggestions collected from executed queries for a database, and the
+    indexes created so far with their measured speedups. POST with
+    "apply": true creates the top suggestions (within the budget).
+    '''
+    data = request.get_json(silent=True) or request.values
+    db_name = data.get('databaseName')
+    if not db_name:
+        return jsonify({'status': 'error', 'message': 'Missing databaseName'}), 400
+    db_path = SqlConn.base_path + db_name
+    if not os.path.exists(db_path):
+        return jsonify({'status': 'error', 'message': f'Database file not found: {db_path}'}), 404
+
+    if request.method == 'POST' and data.get('apply') in (True, 'true', '1', 'True'):
+        index_advisor.apply(db_path, limit=get_int_field(data, 'limit', minimum=1))
+    return jsonify(index_advisor.advice(db_path))
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    '''Prometheus text format; 404 when METRICS is off.'''
+    if not METRICS:
+        return jsonify({'status': 'error', 'message': 'Metrics are disabled'}), 404
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        'query_cache': query_cache.stats(),
+        'schema_cache': schema_cache.stats(),
+        'query_store': query_store.stats(),
+        'result_cache': result_cache.stats(),
+        'jobs': job_manager.stats(),
+        'single_flight': {flight.group: flight.stats() for flight in (request_flight, questions_flight)},
+    })
+
 @app.route('/get-questions', methods=['GET', 'POST'])
 def get_questions():
     if request.headers['Content-Type'] == 'application/x-www-form-urlencoded':
         data = request.form
     else:
         data = request.get_json()
-    
-    return generate_questions(db_name=data['databaseName'])
+    db_name = data['databaseName']
+    questions, _ = questions_flight.do(db_name, lambda: generate_questions(db_name=db_name))
+    return questions
 
 
 if __name__ == '__main__':
-    if not DEBUG:
-        serve(app, port=3000)
-    else:
-        app.run(debug=DEBUG, port=3000, host='0.0.0.0')
+    try:
+        if not DEBUG:
+            serve(app, port=3000, threads=WAITRESS_THREADS)
+        else:
+            app.run(debug=DEBUG, port=3000, host='0.0.0.0')
+    finally:
+        close_all_pools()
 
@@ -0,0 +1,353 @@
+'''
+Benchmarks of the NL->SQL pipeline against synthetic databases.
+
+The app is served by waitress in-process and driven over HTTP, with the LLM
+replaced by a deterministic StubBackend (see functions.llm) answering after
+a configurable latency. For every database size (tables x columns x rows)
+and concurrency level, each scenario sends a number of requests and records
+throughput and latency percentiles:
+
+    create_database  POST /create-database, one table of the size per request
+    run_sql          POST /run-sql with a GROUP BY query
+    request_cold     POST /request with a new prompt each time (no cache hits)
+    request_warm     POST /request repeating one prompt (response cache)
+    get_questions    POST /get-questions
+
+Results are written as JSON; with --compare a previous result file is used
+as baseline and the run fails when a p50/p99 latency got more than
+--tolerance worse.
+
+    python benchmarks/run_benchmarks.py --sizes 4x8x1000,12x24x20000 --concurrency 1,8 \
+        --requests 50 --llm-latency 0.05 --output benchmarks/results.json
+'''
+import argparse
+import csv
+import io
+import json
+import os
+import platform
+import random
+import re
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TABLE_WORDS = [
+    'orders', 'customers', 'products', 'invoices', 'shipments', 'suppliers', 'employees', 'stores',
+    'campaigns', 'tickets', 'payments', 'reviews', 'vehicles', 'patients', 'courses', 'flights',
+    'projects', 'devices', 'accounts', 'warehouses', 'contracts', 'listings', 'sessions', 'claims',
+]
+DIMENSION_WORDS = ['region', 'segment', 'channel', 'status', 'category', 'country', 'tier', 'brand', 'source', 'team']
+MEASURE_WORDS = ['amount', 'quantity', 'price', 'score', 'duration', 'weight', 'cost', 'margin', 'rating', 'distance']
+DIMENSION_VALUES = ['north', 'south', 'east', 'west', 'online', 'retail', 'gold', 'silver', 'bronze', 'other']
+SCENARIOS = ('create_database', 'run_sql', 'request_cold', 'request_warm', 'get_questions')
+PROMPT_PATTERN = re.compile(r'average (\w+) by (\w+) in (\w+)')
+
+
+def parse_size(text):
+    tables, columns, rows = (int(part) for part in text.lower().split('x'))
+    return {'tables': tables, 'columns': max(3, columns), 'rows': rows}
+
+
+def table_layout(size):
+    '''[(table, [columns], [dimension columns], [measure columns])] of a synthetic database.'''
+    layout = []
+    for t in range(size['tables']):
+        table = TABLE_WORDS[t % len(TABLE_WORDS)] + ('' if t < len(TABLE_WORDS) else f'_{t // len(TABLE_WORDS)}')
+        dimensions, measures = [], []
+        for c in range(size['columns'] - 2):
+            words, chosen = (DIMENSION_WORDS, dimensions) if c % 2 == 0 else (MEASURE_WORDS, measures)
+            word = words[(c // 2) % len(words)]
+            chosen.append(word if c // 2 < len(words) else f'{word}_{c // 2 // len(words)}')
+        layout.append((table, ['id'] + dimensions + measures + ['created_at'], dimensions, measures))
+    return layout
+
+
+def table_csv(columns, dimensions, measures, rows, seed):
+    rng = random.Random(seed)
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    for i in range(rows):
+        writer.writerow(
+            [i + 1]
+            + [rng.choice(DIMENSION_VALUES) for _ in dimensions]
+            + [round(rng.uniform(0, 1000), 2) for _ in measures]
+            + [f'2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}']
+        )
+    return out.getvalue()
+
+
+def fake_llm(layout_by_db):
+    '''
+    Deterministic stand-in for the LLM. Prompts of the form
+    "average <measure> by <dimension> in <table>" get matching keywords and
+    SQL; question requests get questions in the same form.
+    '''
+    from functions.llm import make_reply
+
+    def responder(context, tools):
+        tool = tools[0]['function']['name'] if tools else None
+        text = "\n".join(message.get('content', '') for message in context)
+        match = PROMPT_PATTERN.search(text)
+        if tool == 'extract_keywords':
+            words = match.groups() if match else ('id',)
+            return make_reply(text=",".join(words))
+        if tool == 'get_sql_query' and match:
+            measure, dimension, table = match.groups()
+            return make_reply(name='get_sql_query', arguments={'query': (
+                f'SELECT {dimension}, AVG({measure}) AS avg_{measure} FROM {table} '
+                f'GROUP BY {dimension} ORDER BY avg_{measure} DESC'
+            )})
+        if tool == 'get_questions':
+            questions = []
+            for layout in layout_by_db.values():
+                for table, _, dimensions, measures in layout:
+                    if table in text and dimensions and measures:
+                        questions.append(f'What is the average {measures[0]} by {dimensions[0]} in {table}')
+            return make_reply(name='get_questions', arguments={'questions': '?'.join(questions[:4])})
+        return make_reply(text='')
+
+    return responder
+
+
+def post(base_url, path, payload, timeout=300):
+    body = json.dumps(payload).encode('utf-8')
+    request = urllib.request.Request(base_url + path, data=body, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        return e.code
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def run_scenario(name, make_call, requests, concurrency):
+    '''Run `requests` calls of make_call(i) with `concurrency` threads; latency stats in ms.'''
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def timed(i):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            ok = make_call(i) < 400
+        except Exception as e:
+            print(f'{name}: request failed: {e}')
+            ok = False
+        elapsed = (time.perf_counter() - start) * 1000
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, range(requests)))
+    wall = time.perf_counter() - started
+    return {
+        'scenario': name,
+        'requests': requests,
+        'errors': errors,
+        'throughput_rps': round(requests / wall, 2) if wall else None,
+        'mean_ms': round(statistics.mean(latencies), 2),
+        'p50_ms': round(percentile(latencies, 0.50), 2),
+        'p90_ms': round(percentile(latencies, 0.90), 2),
+        'p99_ms': round(percentile(latencies, 0.99), 2),
+        'max_ms': round(max(latencies), 2),
+    }
+
+
+def benchmark_size(base_url, size, layout, db_name, concurrency, requests, scenarios, seed):
+    rng = random.Random(seed)
+    queries = [
+        (table, dimensions[0], measures[0])
+        for table, _, dimensions, measures in layout if dimensions and measures
+    ]
+    run_id = f'{int(time.time())}{rng.randint(0, 9999)}'
+    results = []
+    for scenario in scenarios:
+        if scenario == 'create_database':
+            table, columns, dimensions, measures = layout[0]
+            csv_string = table_csv(columns, dimensions, measures, size['rows'], seed)
+
+            def call(i):
+                return post(base_url, '/create-database', {
+                    'csv_title': f'{table}.csv', 'csv_string': csv_string, 'db_name': f'create_{run_id}_{i}.db'})
+        elif scenario == 'run_sql':
+            def call(i):
+                table, dimension, measure = queries[i % len(queries)]
+                return post(base_url, '/run-sql', {'databaseName': db_name, 'query': (
+                    f'SELECT {dimension}, AVG({measure}) AS avg_{measure} FROM {table} GROUP BY {dimension}')})
+        elif scenario == 'request_cold':
+            def call(i):
+                table, dimension, measure = queries[i % len(queries)]
+                # The run number keeps every prompt distinct, so no cache answers it
+                return post(base_url, '/request', {'databaseName': db_name,
+                                                   'query': f'average {measure} by {dimension} in {table} (run {run_id} {i})'})
+        elif scenario == 'request_warm':
+            table, dimension, measure = queries[0]
+            post(base_url, '/request', {'databaseName': db_name, 'query': f'average {measure} by {dimension} in {table}'})
+
+            def call(i):
+                return post(base_url, '/request', {'databaseName': db_name,
+                                                   'query': f'average {measure} by {dimension} in {table}'})
+        elif scenario == 'get_questions':
+            def call(i):
+                return post(base_url, '/get-questions', {'databaseName': db_name})
+        else:
+            raise ValueError(f'Unknown scenario: {scenario}')
+
+        result = run_scenario(scenario, call, requests, concurrency)
+        result.update({'size': f"{size['tables']}x{size['columns']}x{size['rows']}", 'concurrency': concurrency})
+        print(json.dumps(result))
+        results.append(result)
+    return results
+
+
+def build_database(path, layout, rows, seed):
+    '''Synthetic database written directly (setup is not part of the measurements).'''
+    from functions.ingest import ingest_csv
+    for t, (table, columns, dimensions, measures) in enumerate(layout):
+        ingest_csv(io.StringIO(table_csv(columns, dimensions, measures, rows, seed + t), newline=''), f'{table}.csv', path)
+
+
+def compare(results, baseline_path, tolerance):
+    '''Regressions against a previous result file: p50/p99 more than `tolerance` slower.'''
+    with open(baseline_path) as f:
+        baseline = {(r['size'], r['concurrency'], r['scenario']): r for r in json.load(f)['results']}
+    regressions = []
+    for result in results:
+        before = baseline.get((result['size'], result['concurrency'], result['scenario']))
+        if not before:
+            continue
+        for metric in ('p50_ms', 'p99_ms'):
+            if before[metric] and result[metric] > before[metric] * (1 + tolerance):
+                regressions.append({
+                    'size': result['size'], 'concurrency': result['concurrency'], 'scenario': result['scenario'],
+                    'metric': metric, 'baseline': before[metric], 'current': result[metric],
+                })
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='4x8x1000,12x24x20000', help='comma-separated TABLESxCOLUMNSxROWS')
+    parser.add_argument('--concurrency', default='1,8', help='comma-separated client thread counts')
+    parser.add_argument('--requests', type=int, default=50, help='requests per scenario')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--llm-latency', type=float, default=0.05, help='seconds per fake LLM call')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--output', default=os.path.join(ROOT, 'benchmarks', 'results.json'))
+    parser.add_argument('--compare', help='previous result file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed latency increase for --compare')
+    args = parser.parse_args()
+
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    concurrency_levels = [int(level) for level in args.concurrency.split(',')]
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(',') if scenario.strip()]
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.compare) if args.compare else None
+
+    # Configure the app before importing it: stub LLM, no tracing or persistent caches,
+    # and everything relative (databases/, cache/) inside a scratch directory
+    os.environ.update({
+        'LLM_BACKEND': 'stub',
+        'LLM_STUB_LATENCY': str(args.llm_latency),
+        'CONTEXT_TRACE': 'false',
+        'PERSISTENT_QUERY_CACHE': 'false',
+        'QUESTIONS_RATE_LIMIT': os.environ.get('QUESTIONS_RATE_LIMIT', '1000'),
+        # request_cold prompts only differ in their run number; near-duplicate reuse would answer them
+        'PROMPT_SIMILARITY_THRESHOLD': '2',
+    })
+    workdir = tempfile.mkdtemp(prefix='aisql-bench-')
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+
+    import app as app_module
+    from waitress import create_server
+    from functions.llm import LLMClient, StubBackend, set_client
+    from functions.pool import close_all_pools
+
+    layouts = {}
+    for i, size in enumerate(sizes):
+        db_name = f"bench_{size['tables']}x{size['columns']}x{size['rows']}.db"
+        layouts[db_name] = table_layout(size)
+        os.makedirs(app_module.SqlConn.base_path, exist_ok=True)
+        print(f'Building {db_name}...')
+        build_database(os.path.join(app_module.SqlConn.base_path, db_name), layouts[db_name], size['rows'], args.seed + i)
+    set_client('stub', LLMClient(StubBackend(fake_llm(layouts), latency=args.llm_latency)))
+
+    server = create_server(app_module.app, host='127.0.0.1', port=0, threads=max(concurrency_levels) + 2)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    base_url = f'http://127.0.0.1:{server.effective_port}'
+
+    results = []
+    try:
+        for i, size in enumerate(sizes):
+            db_name = f"bench_{size['tables']}x{size['columns']}x{size['rows']}.db"
+            for concurrency in concurrency_levels:
+                results += benchmark_size(base_url, size, layouts[db_name], db_name, concurrency,
+                                          args.requests, scenarios, args.seed + i)
+    finally:
+        # The server thread is a daemon and ends with the process; closing it
+        # under in-flight keep-alive channels only produces shutdown noise
+        close_all_pools()
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'sizes': args.sizes,
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'llm_latency': args.llm_latency,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+    if baseline:
+        report['regressions'] = compare(results, baseline, args.tolerance)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {output}')
+
+    if report.get('regressions'):
+        print('Regressions:', json.dumps(report['regressions'], indent=2))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import io
+import multiprocessing
+import os
+import posixpath
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+
+from functions.ingest import ingest_csv, quote, sanitize_table_name, report_progress, INGEST_PRAGMAS
+from functions.column_stats import STATS_TABLE, STATS_TABLE_SQL
+from functions.relationships import infer_relationships
+from functions.schema_cache import schema_cache
+from functions.result_cache import result_cache
+
+BULK_INGEST_WORKERS = int(os.getenv("BULK_INGEST_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+
+def list_csv_members(archive_path):
+    '''Names of the CSV files in a zip or tar archive (hidden files and __MACOSX skipped).'''
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            names = [info.filename for info in archive.infolist() if not info.is_dir()]
+    elif tarfile.is_tarfile(archive_path):
+        with tarfile.open(archive_path) as archive:
+            names = [member.name for member in archive.getmembers() if member.isfile()]
+    else:
+        raise ValueError("Upload is neither a zip nor a tar archive")
+    return [
+        name for name in names
+        if name.lower().endswith('.csv')
+        and not posixpath.basename(name).startswith('.')
+        and not name.startswith('__MACOSX/')
+    ]
+
+
+@contextmanager
+def open_member(archive_path, name):
+    '''Binary stream of one archive member.'''
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive, archive.open(name) as member:
+            yield member
+    else:
+        with tarfile.open(archive_path) as archive:
+            member = archive.extractfile(name)
+            try:
+                yield member
+            finally:
+                member.close()
+
+
+def stage_csv(archive_path, name, staging_path, options):
+    '''
+    Worker process: parse one CSV of the archive into its own staging
+    database with the regular import (types, NULLs, column statistics).
+    '''
+    with open_member(archive_path, name) as member:
+        text = io.TextIOWrapper(member, encoding='utf-8', newline='')
+        return ingest_csv(text, posixpath.basename(name), staging_path, **options)
+
+
+def commit_staged(db_path, staged):
+    '''
+    Single writer: copy the staged tables (and their column statistics) into
+    `db_path` with ATTACH + INSERT ... SELECT. SQLite only attaches a few
+    databases at a time, so each batch of them is one transaction.
+    '''
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    try:
+        for name, value in INGEST_PRAGMAS.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        batch_size = max(1, conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED))
+        for start in range(0, len(staged), batch_size):
+            batch = staged[start:start + batch_size]
+            aliases = []
+            for i, (staging_path, table) in enumerate(batch):
+                alias = f'staging_{i}'
+                conn.execute(f"ATTACH DATABASE ? AS {alias}", (staging_path,))
+                aliases.append((alias, table))
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.execute(STATS_TABLE_SQL)
+                    for alias, table in aliases:
+                        create_sql = conn.execute(
+                            f"SELECT sql FROM {alias}.sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()[0]
+                        conn.execute(f"DROP TABLE IF EXISTS main.{quote(table)}")
+                        conn.execute(create_sql)  # unqualified, so it lands in main
+                        conn.execute(f"INSERT INTO main.{quote(table)} SELECT * FROM {alias}.{quote(table)}")
+                        conn.execute(f"DELETE FROM main.{STATS_TABLE} WHERE table_name = ?", (table,))
+                        has_stats = conn.execute(
+                            f"SELECT 1 FROM {alias}.sqlite_master WHERE type='table' AND name=?", (STATS_TABLE,)).fetchone()
+                        if has_stats:
+                            conn.execute(f"INSERT INTO main.{STATS_TABLE} SELECT * FROM {alias}.{STATS_TABLE} WHERE table_name = ?",
+                                         (table,))
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+            finally:
+                for alias, _ in aliases:
+                    conn.execute(f"DETACH DATABASE {alias}")
+    finally:
+        conn.close()
+
+
+def bulk_ingest(archive_path, db_path, upload_id=None, workers=BULK_INGEST_WORKERS, **options):
+    '''
+    Load every CSV of a zip/tar archive into `db_path`, one table per file.
+
+    Files are parsed in parallel by a process pool, each into a staging
+    database next to the target; a single writer then copies the staged
+    tables in (see commit_staged). Afterwards likely foreign keys are
+    inferred for the whole database and indexed (functions.relationships).
+    Progress is published under `upload_id`. Options are those of ingest_csv
+    (strict, without_rowid).
+    '''
+    members = list_csv_members(archive_path)
+    if not members:
+        raise ValueError("The archive contains no CSV files")
+    tables = {}
+    for name in members:
+        table = sanitize_table_name(posixpath.basename(name))
+        if table in tables:
+            raise ValueError(f"{tables[table]} and {name} would both become table {table}")
+        tables[table] = name
+
+    report_progress(upload_id, status='running', files=len(members), staged=0)
+    staging_dir = tempfile.mkdtemp(prefix='.staging-', dir=os.path.dirname(os.path.abspath(db_path)))
+    try:
+        results = []
+        # Workers are forked from a single-threaded fork server: forking the
+        # multi-threaded web server itself could copy locks held by other threads
+        with ProcessPoolExecutor(max_workers=max(1, min(workers, len(members))),
+                                 mp_context=multiprocessing.get_context('forkserver')) as executor:
+            futures = {
+                executor.submit(stage_csv, archive_path, name, os.path.join(staging_dir, f'{i}.db'), options):
+                    os.path.join(staging_dir, f'{i}.db')
+                for i, name in enumerate(members)
+            }
+            for future in as_completed(futures):
+                result = future.result()
+                results.append((futures[future], result))
+                report_progress(upload_id, staged=len(results))
+
+        report_progress(upload_id, status='committing')
+        commit_staged(db_path, [(staging_path, result['table']) for staging_path, result in results])
+        schema_cache.invalidate(db_path)
+        result_cache.invalidate(db_path)
+
+        report_progress(upload_id, status='inferring relationships')
+        relationships = infer_relationships(db_path)
+        schema_cache.invalidate(db_path)
+    except Exception as e:
+        report_progress(upload_id, status='error', error=str(e))
+        raise
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    loaded = sorted((result for _, result in results), key=lambda result: result['table'])
+    report_progress(upload_id, status='done', rows=sum(result['rows'] for result in loaded))
+    return {'tables': loaded, 'relationships': relationships}
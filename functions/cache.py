@@ -0,0 +1,99 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+def estimate_size(value):
+    '''Approximate memory cost of a cached value by its JSON length.'''
+    try:
+        return len(json.dumps(value, default=str))
+    except (TypeError, ValueError):
+        return len(repr(value))
+
+
+class LRUCache:
+    '''
+    Thread-safe LRU cache bounded by an approximate byte budget, with an
+    optional time-to-live per entry (ttl=None keeps entries until evicted).
+    `on_evict(key, value)` is called, with the cache lock held, for every
+    entry evicted to stay within the budget.
+    '''
+
+    def __init__(self, max_bytes, ttl=None, on_evict=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (value, size, stored_at)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def remove(self, key):
+        '''Drop an entry. Caller holds the lock.'''
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, _, stored_at = entry
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                self.remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size=None):
+        '''Store a value; `size` skips estimate_size() when the caller already knows it.'''
+        size = estimate_size(value) if size is None else size
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            if size > self.max_bytes:
+                return False  # Never worth evicting everything for one entry
+            self.entries[key] = (value, size, time.monotonic())
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                oldest = next(iter(self.entries))
+                evicted = self.entries[oldest][0]
+                self.remove(oldest)
+                self.evictions += 1
+                if self.on_evict is not None:
+                    self.on_evict(oldest, evicted)
+            return True
+
+    def invalidate(self, match=None):
+        '''Drop every entry whose key satisfies `match`, or everything if match is None.'''
+        with self.lock:
+            keys = [key for key in self.entries if match is None or match(key)]
+            for key in keys:
+                self.remove(key)
+            return len(keys)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
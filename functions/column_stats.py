@@ -0,0 +1,345 @@
+import json
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+COLUMN_STATS = os.getenv("COLUMN_STATS", "true") not in ("false", "0", "False")
+COLUMN_STATS_TOP_K = int(os.getenv("COLUMN_STATS_TOP_K", "5"))
+COLUMN_STATS_HISTOGRAM_BUCKETS = int(os.getenv("COLUMN_STATS_HISTOGRAM_BUCKETS", "10"))
+COLUMN_STATS_BATCH_ROWS = 5000
+HLL_PRECISION = 12  # 4096 registers, about 1.6% standard error
+TOP_K_CAPACITY = 512  # distinct values tracked for top-k before pruning
+HISTOGRAM_SAMPLE = 2048  # reservoir of numeric values the histogram is built from
+
+INTERNAL_TABLE_PREFIX = '_aisql_'  # side tables of the app, hidden from the schema
+STATS_TABLE = '_aisql_column_stats'
+STATS_TABLE_SQL = f'''
+    CREATE TABLE IF NOT EXISTS {STATS_TABLE} (
+        table_name TEXT NOT NULL,
+        column_name TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        row_count INTEGER NOT NULL,
+        null_fraction REAL NOT NULL,
+        distinct_estimate INTEGER NOT NULL,
+        min_value,
+        max_value,
+        top_values TEXT NOT NULL,
+        histogram TEXT,
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (table_name, column_name)
+    )
+'''
+
+
+NUMBER_TYPES = {int, float}
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def sqlite_order(value):
+    '''Sort key of mixed values the way SQLite orders them: numbers before text.'''
+    return (0, value) if is_number(value) else (1, str(value))
+
+
+def extremes(values):
+    '''(min, max) of non-empty values, in SQLite order when the types are mixed.'''
+    try:
+        return min(values), max(values)
+    except TypeError:
+        return min(values, key=sqlite_order), max(values, key=sqlite_order)
+
+
+class HyperLogLog:
+    '''Distinct-count sketch over Python's hash of the values (stable within the process).'''
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+
+    def add_many(self, values):
+        registers = self.registers
+        mask = self.size - 1
+        precision = self.precision
+        width = 64 - precision
+        for value in values:
+            # hash() of a 1-tuple mixes the bits, unlike hash() of a small int
+            h = hash((value,)) & 0xFFFFFFFFFFFFFFFF
+            rank = width - (h >> precision).bit_length() + 1
+            if rank > registers[h & mask]:
+                registers[h & mask] = rank
+
+    def estimate(self):
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            return round(m * math.log(m / zeros))  # linear counting for small cardinalities
+        return round(raw)
+
+
+class ColumnCollector:
+    '''
+    One-pass statistics of a column, fed chunk by chunk: nulls, distinct
+    estimate, min/max, approximate top-k (counts of at most TOP_K_CAPACITY
+    values, pruned to the most frequent half when full) and a reservoir
+    sample of the numbers for the histogram.
+    '''
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.count = 0
+        self.nulls = 0
+        self.hll = HyperLogLog()
+        self.min = None
+        self.max = None
+        self.counts = Counter()
+        self.numbers = 0
+        self.sample = []
+        self.next_index = None  # position among the numbers of the next one to enter the sample
+        self.weight = None
+
+    def add_values(self, values):
+        '''Add a chunk of the column's values.'''
+        self.count += len(values)
+        present = [value for value in values if value is not None]
+        self.nulls += len(values) - len(present)
+        if not present:
+            return
+
+        chunk_counts = Counter(present)
+        self.hll.add_many(chunk_counts)
+
+        # Columns are usually of one type: only filter per value when they are not
+        types = set(map(type, present))
+        comparable = present if bytes not in types else [value for value in present if not isinstance(value, bytes)]
+        if comparable:
+            low, high = extremes(comparable)
+            self.min = low if self.min is None else extremes([self.min, low])[0]
+            self.max = high if self.max is None else extremes([self.max, high])[1]
+
+        self.counts.update(chunk_counts)
+        if len(self.counts) > TOP_K_CAPACITY:
+            self.counts = Counter(dict(self.counts.most_common(TOP_K_CAPACITY // 2)))
+
+        if types <= NUMBER_TYPES:
+            self.add_sample(present)
+        elif types & NUMBER_TYPES:
+            self.add_sample([value for value in comparable if is_number(value)])
+
+    def uniform(self):
+        return self.rng.random() or 1e-300  # in (0, 1)
+
+    def add_sample(self, numbers):
+        '''Reservoir sampling (Algorithm L: random skips instead of a draw per value).'''
+        start = self.numbers
+        self.numbers += len(numbers)
+        free = HISTOGRAM_SAMPLE - len(self.sample)
+        if free > 0:
+            self.sample.extend(numbers[:free])
+            if len(self.sample) < HISTOGRAM_SAMPLE:
+                return
+        if self.next_index is None:
+            self.weight = math.exp(math.log(self.uniform()) / HISTOGRAM_SAMPLE)
+            self.next_index = HISTOGRAM_SAMPLE - 1 + self.skip()
+        while self.next_index < self.numbers:
+            self.sample[self.rng.randrange(HISTOGRAM_SAMPLE)] = numbers[self.next_index - start]
+            self.weight *= math.exp(math.log(self.uniform()) / HISTOGRAM_SAMPLE)
+            self.next_index += self.skip()
+
+    def skip(self):
+        return int(math.log(self.uniform()) / math.log(1 - self.weight)) + 1
+
+    def histogram(self, buckets=COLUMN_STATS_HISTOGRAM_BUCKETS):
+        '''Equal-width buckets [[low, high, count], ...] over the numeric values, counts scaled from the sample.'''
+        if not self.sample or not buckets:
+            return None
+        if is_number(self.min) and is_number(self.max):
+            low, high = self.min, self.max
+        else:
+            low, high = min(self.sample), max(self.sample)
+        if low == high:
+            return [[low, high, self.numbers]]
+        width = (high - low) / buckets
+        counts = [0] * buckets
+        for value in self.sample:
+            counts[min(int((value - low) / width), buckets - 1)] += 1
+        scale = self.numbers / len(self.sample)
+        return [
+            [float(f'{low + i * width:.6g}'), float(f'{low + (i + 1) * width:.6g}'), round(count * scale)]
+            for i, count in enumerate(counts)
+        ]
+
+    def result(self, top_k=COLUMN_STATS_TOP_K):
+        distinct = self.hll.estimate()
+        top = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return {
+            'row_count': self.count,
+            'null_fraction': self.nulls / self.count if self.count else 0.0,
+            # The sketch may overshoot on tiny columns; there cannot be more distinct values than values
+            'distinct_estimate': min(distinct, self.count - self.nulls),
+            'min': self.min,
+            'max': self.max,
+            'top_values': [[value, count] for value, count in top],
+            'histogram': self.histogram(),
+        }
+
+
+class TableStats:
+    '''Collectors for all columns of a table, fed row chunks as they are read or written.'''
+
+    def __init__(self, columns, seed=0):
+        rng = random.Random(seed)
+        self.columns = list(columns)
+        self.collectors = [ColumnCollector(rng) for _ in self.columns]
+
+    def add_rows(self, rows):
+        if not rows:
+            return
+        for collector, values in zip(self.collectors, zip(*rows)):
+            collector.add_values(values)
+
+    def results(self):
+        return {column: collector.result() for column, collector in zip(self.columns, self.collectors)}
+
+
+def write_table_stats(conn, table, table_stats):
+    '''Replace the catalog rows of `table`. Runs in the caller's transaction, if any.'''
+    conn.execute(STATS_TABLE_SQL)
+    conn.execute(f"DELETE FROM {STATS_TABLE} WHERE table_name = ?", (table,))
+    now = time.time()
+    conn.executemany(
+        f"INSERT INTO {STATS_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            (table, column, position, stats['row_count'], stats['null_fraction'], stats['distinct_estimate'],
+             stats['min'], stats['max'], json.dumps(stats['top_values'], default=str),
+             json.dumps(stats['histogram']) if stats['histogram'] is not None else None, now)
+            for position, (column, stats) in enumerate(table_stats.results().items())
+        ],
+    )
+
+
+def drop_table_stats(conn, table):
+    '''Forget the catalog rows of `table`, if the database has a catalog.'''
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (STATS_TABLE,)).fetchone()
+    if exists:
+        conn.execute(f"DELETE FROM {STATS_TABLE} WHERE table_name = ?", (table,))
+
+
+def read_stats(conn):
+    '''{table: {column: stats}} from the catalog; empty when there is none.'''
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (STATS_TABLE,)).fetchone()
+    if not exists:
+        return {}
+    catalog = {}
+    rows = conn.execute(
+        f"SELECT table_name, column_name, row_count, null_fraction, distinct_estimate, min_value, max_value, "
+        f"top_values, histogram FROM {STATS_TABLE} ORDER BY table_name, position"
+    ).fetchall()
+    for table, column, row_count, null_fraction, distinct, min_value, max_value, top_values, histogram in rows:
+        catalog.setdefault(table, {})[column] = {
+            'row_count': row_count,
+            'null_fraction': null_fraction,
+            'distinct_estimate': distinct,
+            'min': min_value,
+            'max': max_value,
+            'top_values': json.loads(top_values),
+            'histogram': json.loads(histogram) if histogram else None,
+        }
+    return catalog
+
+
+def catalog_matches(conn, table, catalog):
+    '''Whether the catalog has statistics of exactly the current columns of `table`.'''
+    from functions.ingest import quote  # functions.ingest imports this module
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({quote(table)})").fetchall()}
+    return set(catalog.get(table, ())) == columns
+
+
+def compute_table_stats(conn, table):
+    '''Catalog statistics of an existing table, in a single scan of it.'''
+    from functions.ingest import quote  # functions.ingest imports this module
+    cur = conn.execute(f"SELECT * FROM {quote(table)}")
+    table_stats = TableStats([description[0] for description in cur.description])
+    while True:
+        batch = cur.fetchmany(COLUMN_STATS_BATCH_ROWS)
+        if not batch:
+            break
+        table_stats.add_rows([tuple(row) for row in batch])
+    cur.close()
+    return table_stats
+
+
+def refresh_stats(db_path, tables=None):
+    '''
+    Build the catalog for `tables` (default: the user tables that have no
+    statistics yet, or statistics of other columns than they have now).
+    Returns the tables refreshed.
+    '''
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    try:
+        catalog = read_stats(conn)
+        if tables is None:
+            names = conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' "
+                "AND name NOT LIKE ? ESCAPE '\\'", (INTERNAL_TABLE_PREFIX.replace('_', '\\_') + '%',)
+            ).fetchall()
+            tables = [name for (name,) in names if not catalog_matches(conn, name, catalog)]
+        refreshed = []
+        for table in tables:
+            # Scan outside the write lock, then swap the rows in one short transaction
+            table_stats = compute_table_stats(conn, table)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                write_table_stats(conn, table, table_stats)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            refreshed.append(table)
+        return refreshed
+    finally:
+        conn.close()
+
+
+class StatsRefresher:
+    '''
+    Background catalog builds for databases that were created before the
+    catalog existed (or outside the app). One worker; a database is queued
+    at most once at a time.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='column-stats')
+
+    def schedule(self, db_path):
+        db_path = os.path.abspath(db_path)
+        with self.lock:
+            if db_path in self.pending:
+                return
+            self.pending.add(db_path)
+        self.executor.submit(self.run, db_path)
+
+    def run(self, db_path):
+        try:
+            refreshed = refresh_stats(db_path)
+            if refreshed:
+                print(f"Column statistics built for {', '.join(refreshed)} in {db_path}")
+        except Exception as e:
+            print(f"Column statistics failed for {db_path}: {e}")
+        finally:
+            with self.lock:
+                self.pending.discard(db_path)
+
+
+stats_refresher = StatsRefresher()
@@ -0,0 +1,214 @@
+import re
+import sqlite3
+from datetime import datetime
+
+# Values read as NULL on import (pandas' default NA strings)
+NULL_SENTINELS = {
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null', 'none', 'Null',
+}
+BOOLEAN_VALUES = {
+    'true': 1, 'false': 0, 't': 1, 'f': 0, 'yes': 1, 'no': 0, 'y': 1, 'n': 0,
+}
+DATE_FORMATS = ['%Y-%m-%d', '%Y/%m/%d', '%d/%m/%Y', '%m/%d/%Y', '%d-%m-%Y', '%d.%m.%Y', '%b %d, %Y', '%d %b %Y']
+DATETIME_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%m/%d/%Y %H:%M', '%d/%m/%Y %H:%M', '%m/%d/%Y %H:%M:%S']
+INTEGER_PATTERN = re.compile(r'^[+-]?(0|[1-9]\d*)$')
+LEADING_ZERO = re.compile(r'^[+-]?0\d')  # zip codes, padded IDs: kept as text
+CATEGORICAL_MIN_SAMPLE = 50
+CATEGORICAL_MAX_DISTINCT = 20
+STRICT_SUPPORTED = sqlite3.sqlite_version_info >= (3, 37, 0)
+
+# Declared type per kind: normal tables keep descriptive names (the LLM sees
+# them in the schema), STRICT tables only allow the core storage types.
+SQL_TYPES = {
+    'integer': ('INTEGER', 'INTEGER'),
+    'real': ('REAL', 'REAL'),
+    'boolean': ('BOOLEAN', 'INTEGER'),
+    'date': ('DATE', 'TEXT'),
+    'datetime': ('DATETIME', 'TEXT'),
+    'categorical': ('TEXT', 'TEXT'),
+    'text': ('TEXT', 'TEXT'),
+}
+
+
+def normalize_null(value):
+    if value is None or value.strip() in NULL_SENTINELS:
+        return None
+    return value
+
+
+def is_integer(value):
+    return INTEGER_PATTERN.match(value.strip()) is not None and -2**63 <= int(value) < 2**63
+
+
+def is_real(value):
+    try:
+        float(value)
+        return value.strip().lower() not in ('inf', '-inf', '+inf', 'infinity', '-infinity')
+    except ValueError:
+        return False
+
+
+def parses(values, fmt):
+    for value in values:
+        try:
+            datetime.strptime(value.strip(), fmt)
+        except ValueError:
+            return False
+    return True
+
+
+def detect_date_format(values):
+    '''
+    Return (kind, format) for a column of dates or datetimes, or None. A
+    sample that parses in several formats (e.g. 03/04/2024 as day-first and
+    month-first) is ambiguous and not taken for dates either.
+    '''
+    for kind, formats in (('date', DATE_FORMATS), ('datetime', DATETIME_FORMATS)):
+        matches = [fmt for fmt in formats if parses(values, fmt)]
+        if len(matches) == 1:
+            return kind, matches[0]
+        if matches:
+            return None
+    return None
+
+
+def converter(kind, fmt=None):
+    '''Value converter for a kind. Raises ValueError for values that do not fit.'''
+    def convert(value):
+        if value is None:
+            return None
+        if kind == 'integer':
+            # Same rule as the inference: no leading zeros, within 64 bits
+            if not is_integer(value):
+                raise ValueError(f"not an integer: {value!r}")
+            return int(value)
+        if kind == 'real':
+            if not is_real(value) or LEADING_ZERO.match(value.strip()):
+                raise ValueError(f"not a real: {value!r}")
+            return float(value)
+        if kind == 'boolean':
+            try:
+                return BOOLEAN_VALUES[value.strip().lower()]
+            except KeyError:
+                raise ValueError(f"not a boolean: {value!r}") from None
+        if kind == 'date':
+            return datetime.strptime(value.strip(), fmt).date().isoformat()
+        if kind == 'datetime':
+            return datetime.strptime(value.strip(), fmt).isoformat(sep=' ')
+        return value
+    return convert
+
+
+def column_type(kind, strict=False, fmt=None, spellings=None):
+    '''{'kind', 'sql_type', 'convert', 'format', 'spellings'} of a column; see infer_column_types.'''
+    normal_type, strict_type = SQL_TYPES[kind]
+    return {
+        'kind': kind,
+        'sql_type': strict_type if strict else normal_type,
+        'convert': converter(kind, fmt),
+        'format': fmt,
+        'spellings': spellings,  # boolean columns: {1: 'yes', 0: 'no'} as written in the file
+    }
+
+
+def infer_column_types(sample, width, strict=False):
+    '''
+    Infer each column's kind from a sample of rows (values already passed
+    through normalize_null). Numbers with leading zeros stay text so zip
+    codes and padded IDs keep their digits; columns without any value
+    are text. Returns [column_type(...)].
+    '''
+    columns = []
+    for i in range(width):
+        values = [row[i] for row in sample if row[i] is not None]
+        fmt = None
+        spellings = None
+        if not values:
+            kind = 'text'
+        elif all(value.strip().lower() in BOOLEAN_VALUES for value in values):
+            kind = 'boolean'
+            spellings = {BOOLEAN_VALUES[value.strip().lower()]: value.strip() for value in values}
+        elif all(is_integer(value) for value in values):
+            kind = 'integer'
+        elif all(is_real(value) for value in values) and not any(LEADING_ZERO.match(value.strip()) for value in values):
+            kind = 'real'
+        else:
+            detected = detect_date_format(values)
+            if detected:
+                kind, fmt = detected
+            elif len(values) >= CATEGORICAL_MIN_SAMPLE and len(set(values)) <= CATEGORICAL_MAX_DISTINCT:
+                kind = 'categorical'
+            else:
+                kind = 'text'
+        columns.append(column_type(kind, strict, fmt, spellings))
+    return columns
+
+
+def convert_rows(rows, column_types):
+    '''
+    Convert raw rows with the column converters. Returns (rows, misfits)
+    where misfits maps a column index to its values that do not fit the
+    inferred kind (left unconverted in the rows).
+    '''
+    converters = [column_type['convert'] for column_type in column_types]
+    converted = []
+    misfits = {}
+    for row in rows:
+        try:
+            converted.append([convert(value) for convert, value in zip(converters, row)])
+            continue
+        except ValueError:
+            pass
+        out = []
+        for i, (convert, value) in enumerate(zip(converters, row)):
+            try:
+                out.append(convert(value))
+            except ValueError:
+                misfits.setdefault(i, []).append(value)
+                out.append(value)
+        converted.append(out)
+    return converted, misfits
+
+
+def widen(old, values, strict=False):
+    '''
+    Wider column type for a column whose later values do not fit `old`:
+    integer becomes real when the values are numbers, anything else text.
+    Returns (new type, function turning values stored as `old` into values
+    of the new type), with text written the way the file had it where the
+    conversion is reversible (dates in their original format, booleans with
+    their original spelling).
+    '''
+    kind, fmt, spellings = old['kind'], old['format'], old['spellings']
+    if kind == 'integer' and all(is_real(value) for value in values) \
+            and not any(LEADING_ZERO.match(value.strip()) for value in values):
+        return column_type('real', strict), lambda value: None if value is None else float(value)
+
+    def to_text(value):
+        if value is None:
+            return None
+        if kind == 'boolean':
+            return (spellings or {}).get(value, str(value))
+        if kind in ('date', 'datetime'):
+            try:
+                return datetime.fromisoformat(value).strftime(fmt)
+            except (TypeError, ValueError):
+                return value
+        return value if isinstance(value, str) else str(value)
+
+    return column_type('text', strict), to_text
+
+
+def find_key_column(table, columns, column_types, sample):
+    '''
+    Column usable as PRIMARY KEY for a WITHOUT ROWID table: an integer `id`
+    or `<table>_id` column that is unique and never null in the sample.
+    '''
+    for i, (name, column_type) in enumerate(zip(columns, column_types)):
+        if name not in ('id', f'{table}_id') or column_type['kind'] != 'integer':
+            continue
+        values = [row[i] for row in sample]
+        if None not in values and len(set(values)) == len(values):
+            return i
+    return None
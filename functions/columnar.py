@@ -0,0 +1,104 @@
+import base64
+import gzip
+import json
+import os
+import sys
+from array import array
+
+COLUMNAR_MEDIA_TYPE = 'application/vnd.aisql.columnar+json'
+GZIP_MIN_BYTES = int(os.getenv("GZIP_MIN_BYTES", "1024"))  # smaller responses are sent uncompressed
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+MAX_SAFE_INTEGER = 2 ** 53  # larger integers lose precision as float64 / JS numbers
+
+RESULT_FORMATS = ('rows', 'columnar', 'columnar-packed')
+INT32_RANGE = (-2 ** 31, 2 ** 31 - 1)
+
+
+def column_type(values):
+    '''int, float, bool, string, null or mixed, ignoring NULLs.'''
+    kinds = set()
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            kinds.add('bool')
+        elif isinstance(value, int):
+            kinds.add('int')
+        elif isinstance(value, float):
+            kinds.add('float')
+        elif isinstance(value, str):
+            kinds.add('string')
+        else:
+            kinds.add('mixed')
+        if len(kinds) > 1 and kinds != {'int', 'float'}:
+            return 'mixed'
+    if not kinds:
+        return 'null'
+    if kinds == {'int', 'float'}:
+        return 'float'
+    return kinds.pop()
+
+
+def pack(typecode, values):
+    '''Little-endian typed array as base64 ('d' = float64 with NULL as NaN, 'i' = int32).'''
+    if typecode == 'd':
+        values = (float('nan') if value is None else value for value in values)
+    packed = array(typecode, values)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return base64.b64encode(packed.tobytes()).decode('ascii')
+
+
+def to_columnar(headers, rows, packed=False):
+    '''
+    Column-oriented form of a [headers, rows] result:
+
+        {"headers": [...], "row_count": n,
+         "columns": [{"type": "int", "values": [...]}, {"type": "float", "f64": "<base64>"}, ...]}
+
+    With packed=True numeric columns are sent as base64 typed arrays instead
+    of JSON lists: "i32" for integer columns without NULLs that fit in 32
+    bits, otherwise "f64" (NULL as NaN), unless an integer would lose
+    precision. Other columns, and mixed ones, stay JSON lists.
+    '''
+    columns = []
+    for i in range(len(headers)):
+        values = [row[i] for row in rows]
+        kind = column_type(values)
+        column = {'type': kind}
+        if packed and kind == 'int' and None not in values and all(INT32_RANGE[0] <= value <= INT32_RANGE[1] for value in values):
+            column['i32'] = pack('i', values)
+        elif packed and kind in ('int', 'float') and (
+                kind == 'float' or all(value is None or -MAX_SAFE_INTEGER <= value <= MAX_SAFE_INTEGER for value in values)):
+            column['f64'] = pack('d', values)
+        else:
+            if kind == 'mixed':
+                values = [value if value is None or isinstance(value, (int, float, str)) else str(value) for value in values]
+            column['values'] = values
+        columns.append(column)
+    return {'headers': list(headers), 'row_count': len(rows), 'columns': columns}
+
+
+def encode_result(response, result_format):
+    '''
+    Copy of a {"query", "result": [headers, rows], ...} response with the
+    result in `result_format` ("rows" leaves it unchanged).
+    '''
+    if result_format == 'rows' or 'result' not in response:
+        return response
+    headers, rows = response['result']
+    encoded = dict(response)
+    encoded['result'] = to_columnar(headers, rows, packed=result_format == 'columnar-packed')
+    encoded['format'] = result_format
+    return encoded
+
+
+def json_body(payload, accept_encoding=''):
+    '''(body bytes, headers) of a JSON payload, gzipped when the client accepts it and it is large enough.'''
+    body = json.dumps(payload, default=str, separators=(',', ':')).encode('utf-8')
+    headers = {}
+    if 'gzip' in accept_encoding and len(body) >= GZIP_MIN_BYTES:
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+        headers['Content-Encoding'] = 'gzip'
+    headers['Vary'] = 'Accept, Accept-Encoding'
+    return body, headers
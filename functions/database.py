@@ -1,20 +1,38 @@
 import json
 import pandas as pd
-from functions.sql import SqlConn
+from functions.sql import SqlConn, QueryLimitExceeded, SqlValidationError, is_read_query
+from functions.index_advisor import index_advisor
+from functions.schema_prompt import SCHEMA_PROMPT_BUDGET
+from functions.metrics import inc, span
+from functions.result_cache import result_cache
+from functions.schema_cache import schema_cache
+from functions.relationships import infer_relationships
 import logging
-from difflib import SequenceMatcher
 import re
+from itertools import chain, islice
 
 
 def get_sql_database_structure(db_name='user001.starter.db'):
-    sql = SqlConn(db_name)
-    columns = sql.get_database_structure()
+    with SqlConn(db_name) as sql:
+        columns = sql.get_database_structure()
 
     return columns
 
+def get_schema_version(db_name='user001.starter.db'):
+    with SqlConn(db_name) as sql:
+        return sql.get_schema_version()
+
+def get_schema_fingerprint(db_name='user001.starter.db'):
+    with SqlConn(db_name) as sql:
+        return sql.get_schema_fingerprint()
+
+def get_identifier_index(db_name='user001.starter.db'):
+    with SqlConn(db_name) as sql:
+        return sql.get_identifier_index()
+
 def get_table_list_in_database(db_name='user001.starter.db'):
-    sql = SqlConn(db_name)
-    columns = sql.get_database_structure()
+    with SqlConn(db_name) as sql:
+        columns = sql.get_database_structure()
 
     return list(columns['tables'].keys())
 
@@ -29,7 +47,6 @@ def extract_keywords(text):
     # Remove any empty strings
     words = [word for word in words if word]
     text = ",".join(words)
-    print("Input for extract_keywords:", text)
     if not text:
         return []
     text = text.lower().strip()
@@ -50,17 +67,14 @@ def validate_keywords(keywords, sensitivity=0.8, db_name='user001.starter.db'):
     :return: List of useful, valid keywords.
     """
 
-    def is_match(keyword, target):
-        return SequenceMatcher(None, keyword.lower(), target.lower()).ratio() >= sensitivity
-
     COMMON_WORDS = {
         "id", "name", "created_at", "updated_at", "deleted_at",
         "timestamp", "status", "type", "date", "user_id",
         "is_active", "enabled", "flag", "description"
     }
 
-    db_structure = get_sql_database_structure(db_name)
-    tables = db_structure.get("tables", {})
+    index = get_identifier_index(db_name)
+    tables = index.columns
 
     valid_keywords = []
 
@@ -68,13 +82,14 @@ def validate_keywords(keywords, sensitivity=0.8, db_name='user001.starter.db'):
         if keyword.lower() in COMMON_WORDS:
             continue  # Skip common/generic words
 
+        matched_names = index.matches(keyword, sensitivity)
         match_count = 0
         for table_name, columns in tables.items():
-            if is_match(keyword, table_name):
+            if table_name.lower() in matched_names:
                 match_count += 1
                 continue
             for column in columns:
-                if is_match(keyword, column["Field"]):
+                if column.lower() in matched_names:
                     match_count += 1
                     break
 
@@ -91,60 +106,169 @@ def validate_keywords(keywords, sensitivity=0.8, db_name='user001.starter.db'):
     
 
 def find_table_and_column_by_keywords(keywords, sensitivity=0.8, db_name='user001.starter.db'):
-    sql = SqlConn(db_name)
-    return sql.find_table_and_column_by_keywords(keywords, sensitivity)
-
-
-def get_sql_query(query, db_name='user001.starter.db'):
-    print("Executing SQL Query: " + str(query))
-    sql = SqlConn(db_name)
-    return {"query": query, "result": sql.execute(query)}
-
-def get_database_structure_as_context():
-    db_structure = get_sql_database_structure()
-
-    db_name = db_structure['database']
-    tables_info = db_structure['tables']
-
-    context_lines = [f"Database Name: {db_name}", "Tables and Columns:"]
-
-    for table_name, columns in tables_info.items():
-        context_lines.append(f"\nTable: {table_name}")
-        for col in columns:
-            field = col['Field']
-            col_type = col['Type']
-            nullable = col.get('Null', 'YES')
-            key = col.get('Key', '')
-            default = col.get('Default', 'None')
-            extra = col.get('Extra', '')
-
-            attributes = []
+    with SqlConn(db_name) as sql:
+        return sql.find_table_and_column_by_keywords(keywords, sensitivity)
 
-            if key == 'PRI':
-                attributes.append('Primary Key')
-            if key == 'UNI':
-                attributes.append('Unique')
-            if key == 'MUL':
-                attributes.append('Foreign Key / Indexed')
 
-            if nullable == 'NO':
-                attributes.append('Not Null')
-
-            if default != 'None':
-                attributes.append(f"Default: {default}")
+def commit_write(sql, tables=()):
+    '''
+    Commit a statement run on a read-write connection (the pool would roll
+    it back on checkin) and start a new data version of the database, so
+    cached results of earlier reads are not served again. The catalog rows
+    of the `tables` it changed (SqlConn.tracking_writes) are dropped in the
+    same commit; their statistics are rebuilt in the background and
+    relationships involving them are inferred again.
+    '''
+    reinfer = sql.forget_tables(tables)
+    if sql.conn.in_transaction:
+        sql.conn.commit()
+    result_cache.invalidate(sql.db_path)
+    if tables:
+        schema_cache.invalidate(sql.db_path)
+    if reinfer:
+        infer_relationships(sql.db_path)
+
+
+def get_sql_query(query, db_name='user001.starter.db', execute=True, limit=None, cursor=None, validate=False,
+                  use_cache=True):
+    '''
+    Runs the generated SQL. With execute=False only the query is returned, so
+    callers can run it themselves (e.g. to stream it). Passing limit and/or
+    cursor returns a single page plus the cursor of the next one.
+
+    Reads run on a read-only connection; anything else is committed and
+    invalidates the result cache of the database (commit_write). All
+    queries are subject to the SqlConn execution limits and raise
+    QueryLimitExceeded past them.
+    With validate=True (LLM output) the query is first dry-run with
+    SqlConn.validate, also when execute=False, and SqlValidationError
+    is raised for anything but a valid single SELECT.
+    use_cache=False bypasses the SQL result cache.
+    '''
+    if not execute and not validate:
+        return {"query": query}
+    with SqlConn(db_name, readonly=validate or is_read_query(query), use_cache=use_cache) as sql:
+        if validate:
+            with span('sql_validation'):
+                sql.validate(query)
+        if not execute:
+            return {"query": query}
+        print("Executing SQL Query: " + str(query))
+        try:
+            with span('sql_execution'):
+                with sql.tracking_writes() as written:
+                    if limit is None and cursor is None:
+                        response = {"query": query, "result": sql.execute(query)}
+                    else:
+                        headers, rows, next_cursor = sql.execute_page(query, limit=limit, cursor=cursor)
+                        response = {"query": query, "result": (headers, rows), "next_cursor": next_cursor}
+        except QueryLimitExceeded as e:
+            inc('aisql_sql_queries_total', outcome=e.limit)
+            raise
+        except Exception:
+            inc('aisql_sql_queries_total', outcome='error')
+            raise
+        if not sql.readonly:
+            commit_write(sql, written)
+        inc('aisql_sql_queries_total', outcome='ok')
+        index_advisor.observe(sql.db_path, query, sql.conn)
+        return response
+
+def stream_sql_query(query, db_name='user001.starter.db', fmt='ndjson', limit=None, cursor=None):
+    '''
+    Run a query for a streamed result and return a generator of its text chunks.
 
-            if extra:
-                attributes.append(extra)
+    ndjson: a {"query", "headers"} line, one JSON array per row, then a
+    {"next_cursor", "row_count"} line.
+    json: the same document get_sql_query returns, written row by row.
 
-            attributes_str = ", ".join(attributes)
-            column_line = f"  - {field} ({col_type}) [{attributes_str}]" if attributes_str else f"  - {field} ({col_type})"
+    The query is executed and its first page row fetched before this
+    returns, so SQL errors and limits hit up front raise here, before any
+    response is started. A query that goes over the timeout later, while
+    streaming, ends the stream with an "error" entry
+    (QueryLimitExceeded.to_dict()) instead of the last line / key.
+    '''
+    print("Streaming SQL Query: " + str(query))
+    cursor = int(cursor or 0)
+    stop = None if limit is None else cursor + int(limit)
+    sql = SqlConn(db_name, readonly=is_read_query(query))
+    try:
+        with sql.tracking_writes() as written:
+            headers, rows = sql.stream(query)
+        try:
+            page = islice(rows, cursor, stop)
+            first = next(page, None)
+        except Exception:
+            rows.close()
+            raise
+    except Exception:
+        sql.close()
+        raise
+    page = page if first is None else chain([first], page)
+    return stream_chunks(sql, query, headers, rows, page, stop, fmt, written)
+
+def stream_chunks(sql, query, headers, rows, page, stop, fmt, written=()):
+    '''Text chunks of stream_sql_query; returns the connection to its pool at the end.'''
+    row_count = 0
+    with sql:
+        try:
+            try:
+                if fmt == 'ndjson':
+                    yield json.dumps({"query": query, "headers": headers}) + "\n"
+                else:
+                    yield '{"query": ' + json.dumps(query) + ', "result": [' + json.dumps(headers) + ', ['
+
+                for row in page:
+                    if fmt == 'ndjson':
+                        yield json.dumps(row, default=str) + "\n"
+                    else:
+                        yield ("" if row_count == 0 else ", ") + json.dumps(row, default=str)
+                    row_count += 1
+
+                next_cursor = None
+                if stop is not None and next(rows, None) is not None:
+                    next_cursor = stop
+
+                if fmt == 'ndjson':
+                    yield json.dumps({"next_cursor": next_cursor, "row_count": row_count}) + "\n"
+                else:
+                    yield ']], "next_cursor": ' + json.dumps(next_cursor) + '}'
+            finally:
+                rows.close()
+        except QueryLimitExceeded as e:
+            print("Query limit exceeded:", e)
+            if fmt == 'ndjson':
+                yield json.dumps({"error": e.to_dict(), "row_count": row_count}) + "\n"
+            else:
+                yield ']], "error": ' + json.dumps(e.to_dict()) + '}'
+            return
+        if not sql.readonly:
+            commit_write(sql, written)
+        index_advisor.observe(sql.db_path, query, sql.conn)
+
+def get_schema_prompt(db_name='user001.starter.db'):
+    with SqlConn(db_name) as sql:
+        return sql.get_schema_prompt()
+
+def get_database_structure_as_context(db_name='user001.starter.db', prompt=None, budget=SCHEMA_PROMPT_BUDGET):
+    '''
+    Schema of `db_name` as a primed conversation. With a prompt, the tables
+    and columns it mentions come first and get sample values; the rendering
+    stays within about `budget` tokens.
+    '''
+    keywords = extract_keywords(prompt) if prompt else []
+    schema = get_schema_prompt(db_name).render(get_identifier_index(db_name), keywords, budget=budget)
 
-            context_lines.append(column_line)
+    context_lines = [
+        f"Database Name: {db_name}",
+        "Tables and Columns (PK = primary key, FK->t.c = foreign key to column c of table t, e.g. = sample values, a..b = value range):",
+        schema,
+    ]
 
     relationship_note = (
         "\nNote:\n"
-        "- Tables containing columns marked 'Indexed' often reference primary keys of other tables.\n"
-        "- Use indexed and primary key columns to join related tables appropriately in queries."
+        "- Columns marked 'FK->table.column' reference that column of the other table.\n"
+        "- Use FK and primary key columns to join related tables appropriately in queries."
     )
 
     context_lines.append(relationship_note)
@@ -0,0 +1,158 @@
+import math
+import os
+import re
+from datetime import datetime
+
+CHART_MAX_POINTS = int(os.getenv("CHART_MAX_POINTS", "5000"))  # 0 sends every row
+OTHER_LABEL = 'Other'
+
+METHODS = ('lttb', 'minmax', 'top_n')
+
+# Columns whose values add up across rows (counts, totals), judged by the words of
+# their name; only these are summed into the "Other" row. Averages, ratios, ids etc. are not.
+ADDITIVE_WORDS = ('count', 'cnt', 'total', 'sum', 'amount', 'qty', 'quantity', 'revenue', 'sales', 'volume', 'spend', 'cost')
+NON_ADDITIVE_WORDS = ('avg', 'average', 'mean', 'median', 'ratio', 'rate', 'percent', 'pct', 'share', 'min', 'max',
+                      'price', 'score', 'rating')
+NAME_WORD = re.compile(r'[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+')
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def numeric_x(values):
+    '''
+    The x column as numbers: numbers as they are, ISO dates/datetimes as
+    timestamps. None if the column is categorical. NULL x stays None.
+    '''
+    present = [value for value in values if value is not None]
+    if not present:
+        return None
+    if all(is_number(value) for value in present):
+        return [None if value is None else float(value) for value in values]
+    if all(isinstance(value, str) for value in present):
+        try:
+            return [None if value is None else datetime.fromisoformat(value).timestamp() for value in values]
+        except ValueError:
+            return None
+    return None
+
+
+def lttb(xs, ys, threshold):
+    '''
+    Largest-Triangle-Three-Buckets over points sorted by x: keeps the first
+    and last point and, per bucket, the point forming the largest triangle
+    with the previously kept point and the average of the next bucket.
+    Returns the indices of the kept points.
+    '''
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+    kept = [0]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        if avg_start >= avg_end:
+            avg_start, avg_end = n - 1, n
+        count = avg_end - avg_start
+        avg_x = sum(xs[avg_start:avg_end]) / count
+        avg_y = sum(ys[avg_start:avg_end]) / count
+
+        ax, ay = xs[a], ys[a]
+        dx, dy = ax - avg_x, avg_y - ay
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        # Twice the triangle area is |dx * (y - ay) - (ax - x) * dy|
+        areas = [abs(dx * (y - ay) - (ax - x) * dy) for x, y in zip(xs[start:end], ys[start:end])]
+        a = start + areas.index(max(areas))
+        kept.append(a)
+    kept.append(n - 1)
+    return kept
+
+
+def minmax(rows, y_indices, threshold):
+    '''
+    Min/max bucketing over rows sorted by x: equal-count buckets, keeping
+    the rows holding the minimum and maximum of every y column per bucket.
+    '''
+    n = len(rows)
+    per_bucket = 2 * max(1, len(y_indices))
+    buckets = max(1, threshold // per_bucket)
+    size = math.ceil(n / buckets)
+    keep = set()
+    for start in range(0, n, size):
+        end = min(start + size, n)
+        for index in y_indices:
+            values = [(rows[i][index], i) for i in range(start, end) if is_number(rows[i][index])]
+            if values:
+                keep.add(min(values)[1])
+                keep.add(max(values)[1])
+    return [rows[i] for i in sorted(keep)]
+
+
+def is_additive(header):
+    '''Whether a column's values can be summed, e.g. order_count or SUM(total) but not avg_price or id.'''
+    words = [word.lower() for word in NAME_WORD.findall(str(header))]
+    if any(word == 'id' or word.startswith(NON_ADDITIVE_WORDS) for word in words):
+        return False
+    return any(word.startswith(ADDITIVE_WORDS) for word in words)
+
+
+def top_n(rows, headers, y_indices, threshold):
+    '''
+    Categorical x: the `threshold - 1` rows with the largest first numeric
+    column, in their original order, plus an "Other" row for the rest. Rows
+    are kept as they are (never regrouped); the "Other" row only sums the
+    additive columns (see is_additive) and leaves the others NULL.
+    '''
+    if len(rows) <= threshold:
+        return rows
+    first = y_indices[0]
+    ranked = sorted(range(len(rows)), key=lambda i: rows[i][first] if is_number(rows[i][first]) else float('-inf'),
+                    reverse=True)
+    kept = sorted(ranked[:max(0, threshold - 1)])
+    rest = ranked[max(0, threshold - 1):]
+    other = [None] * len(headers)
+    other[0] = OTHER_LABEL
+    for index in y_indices:
+        if is_additive(headers[index]):
+            other[index] = sum(rows[i][index] for i in rest if is_number(rows[i][index]))
+    return [rows[i] for i in kept] + [other]
+
+
+def downsample(headers, rows, max_points=CHART_MAX_POINTS, method=None):
+    '''
+    Reduce a result to about `max_points` rows for charting, with the first
+    column as x (the chart default). Returns (rows, method used or None).
+
+    Numeric or ISO date x: LTTB with a single numeric y column, min/max
+    bucketing with several (rows are sorted by x, rows with NULL x dropped).
+    Categorical x: the top-N rows plus an "Other" row. Results that are
+    small enough, or have no numeric column to reduce by, are unchanged.
+    Meant for chart points only: the reduced rows are not the query result.
+    '''
+    if not max_points or len(rows) <= max_points or len(headers) < 2:
+        return rows, None
+
+    y_indices = [
+        index for index in range(1, len(headers))
+        if any(is_number(row[index]) for row in rows[:100]) and all(row[index] is None or is_number(row[index]) for row in rows)
+    ]
+    if not y_indices:
+        return rows, None
+
+    xs = numeric_x([row[0] for row in rows])
+    if xs is None or method == 'top_n':
+        return top_n(rows, headers, y_indices, max_points), 'top_n'
+
+    if None in xs or any(xs[i] > xs[i + 1] for i in range(len(xs) - 1)):
+        ordered = sorted(((x, row) for x, row in zip(xs, rows) if x is not None), key=lambda item: item[0])
+        xs = [x for x, _ in ordered]
+        rows = [row for _, row in ordered]
+    if method == 'minmax' or (method is None and len(y_indices) > 1):
+        return minmax(rows, y_indices, max_points), 'minmax'
+
+    y = y_indices[0]
+    ys = [0.0 if row[y] is None else float(row[y]) for row in rows]
+    return [rows[i] for i in lttb(xs, ys, max_points)], 'lttb'
@@ -0,0 +1,69 @@
+from collections import Counter
+from difflib import SequenceMatcher
+
+MAX_MEMOIZED_RATIOS = 100000
+
+
+class IdentifierIndex:
+    '''
+    Precomputed index over the table and column names of one schema version,
+    answering "which identifiers match this keyword at sensitivity s" with
+    exactly the ratios difflib.SequenceMatcher(None, keyword, name) gives.
+
+    SequenceMatcher can only match characters both strings contain, so
+    2 * |shared characters| / (len(a) + len(b)) is an upper bound of the
+    ratio (difflib's quick_ratio). Character postings give that bound for
+    every identifier at once; only identifiers whose bound reaches the
+    sensitivity are scored with SequenceMatcher, and scores are memoized
+    across calls and retries.
+    '''
+
+    def __init__(self, db_structure):
+        self.tables = list(db_structure['tables'].keys())
+        self.columns = {
+            table_name: [column['Field'] for column in columns]
+            for table_name, columns in db_structure['tables'].items()
+        }
+
+        names = set(name.lower() for name in self.tables)
+        for columns in self.columns.values():
+            names.update(name.lower() for name in columns)
+        self.identifiers = sorted(names)
+        self.lengths = [len(name) for name in self.identifiers]
+
+        self.postings = {}  # char -> [(identifier id, count)]
+        for ident_id, name in enumerate(self.identifiers):
+            for char, count in Counter(name).items():
+                self.postings.setdefault(char, []).append((ident_id, count))
+
+        self.ratios = {}
+
+    def ratio(self, keyword, name):
+        key = (keyword, name)
+        ratio = self.ratios.get(key)
+        if ratio is None:
+            if len(self.ratios) > MAX_MEMOIZED_RATIOS:
+                self.ratios = {}
+            ratio = self.ratios[key] = SequenceMatcher(None, keyword, name).ratio()
+        return ratio
+
+    def matches(self, keyword, sensitivity):
+        '''Lowercased identifiers whose ratio against the keyword is >= sensitivity.'''
+        keyword = keyword.lower()
+        if sensitivity <= 0:
+            return set(self.identifiers)
+
+        shared = {}
+        for char, count in Counter(keyword).items():
+            for ident_id, ident_count in self.postings.get(char, ()):
+                shared[ident_id] = shared.get(ident_id, 0) + min(count, ident_count)
+
+        matched = set()
+        for ident_id, common in shared.items():
+            length = len(keyword) + self.lengths[ident_id]
+            if 2.0 * common / length < sensitivity:
+                continue
+            name = self.identifiers[ident_id]
+            if self.ratio(keyword, name) >= sensitivity:
+                matched.add(name)
+        return matched
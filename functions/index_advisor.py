@@ -0,0 +1,292 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from functions.ingest import quote
+from functions.sql import SqlConn, QueryLimitExceeded, is_read_query
+
+INDEX_ADVISOR_MODE = os.getenv("INDEX_ADVISOR_MODE", "suggest")  # off, suggest or auto
+INDEX_ADVISOR_BUDGET = int(os.getenv("INDEX_ADVISOR_BUDGET", "5"))  # indexes auto-created per database
+INDEX_ADVISOR_MIN_HITS = int(os.getenv("INDEX_ADVISOR_MIN_HITS", "3"))  # hotspot score before auto-creating
+
+# SQLite 3.36+ names the alias of a table in the plan (SCAN p), earlier versions the table (SCAN TABLE products AS p)
+SCAN_PATTERN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?(.*)$')
+# An index SQLite builds for a single query: the clearest sign of a missing join index
+AUTOMATIC_INDEX_PATTERN = re.compile(r'^SEARCH (?:TABLE )?(\w+)(?: AS \w+)? USING AUTOMATIC (?:PARTIAL )?(?:COVERING )?INDEX \((.*)\)')
+SORT_PATTERN = re.compile(r'USE TEMP B-TREE FOR (ORDER BY|GROUP BY|DISTINCT)')
+TOKEN_PATTERN = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|`[^`]*`|\[[^\]]*\]|\w+|[^\s\w]")
+CLAUSE_ENDS = {'SELECT', 'FROM', 'JOIN', 'LIMIT', 'HAVING', 'UNION', 'EXCEPT', 'INTERSECT', 'WINDOW', 'OFFSET'}
+# Words that can follow a table name in FROM / JOIN and are not its alias
+NOT_ALIASES = {'WHERE', 'ON', 'USING', 'JOIN', 'INNER', 'LEFT', 'RIGHT', 'FULL', 'CROSS', 'NATURAL', 'OUTER', 'GROUP',
+               'ORDER', 'LIMIT', 'HAVING', 'UNION', 'EXCEPT', 'INTERSECT', 'WINDOW', 'INDEXED', 'NOT', 'AS'}
+
+
+IDENTIFIER = re.compile(r'^(?:[A-Za-z_]\w*|["`\[].*)$')
+
+
+def unquote(token):
+    return token[1:-1] if token[0] in '"`[' else token
+
+
+def clause_columns(query):
+    '''Identifiers used in WHERE ('filter'), JOIN ... ON ('join') and ORDER/GROUP BY ('sort').'''
+    columns = {'filter': set(), 'join': set(), 'sort': set()}
+    clause = None
+    tokens = TOKEN_PATTERN.findall(query)
+    for i, token in enumerate(tokens):
+        upper = token.upper()
+        if upper == 'WHERE':
+            clause = 'filter'
+        elif upper == 'ON':
+            clause = 'join'
+        elif upper in ('ORDER', 'GROUP') and i + 1 < len(tokens) and tokens[i + 1].upper() == 'BY':
+            clause = 'sort'
+        elif upper in CLAUSE_ENDS:
+            clause = None
+        elif clause and token[0] in '"`[':
+            columns[clause].add(token[1:-1].lower())
+        elif clause and re.match(r'^[A-Za-z_]\w*$', token):
+            columns[clause].add(token.lower())
+    return columns
+
+
+def table_aliases(query):
+    '''{alias or table name (lowercase): table name} of the tables in FROM and JOIN clauses.'''
+    aliases = {}
+    tokens = TOKEN_PATTERN.findall(query)
+    in_from = False
+    for i, token in enumerate(tokens):
+        upper = token.upper()
+        if upper in ('FROM', 'JOIN') or (token == ',' and in_from):
+            in_from = True
+        else:
+            if upper in CLAUSE_ENDS or upper in NOT_ALIASES or token == ')':
+                in_from = False
+            continue
+        name = tokens[i + 1:i + 2]
+        if not name or not IDENTIFIER.match(name[0]):
+            continue  # a subquery
+        position = i + 1
+        if tokens[position + 1:position + 2] == ['.'] and tokens[position + 2:position + 3]:
+            position += 2  # schema.table
+        table = unquote(tokens[position])
+        aliases[table.lower()] = table
+        following = tokens[position + 1:position + 3]
+        if following and following[0].upper() == 'AS':
+            following = following[1:]
+        if following and IDENTIFIER.match(following[0]) and following[0].upper() not in NOT_ALIASES:
+            aliases[unquote(following[0]).lower()] = table
+    return aliases
+
+
+def explain(conn, query):
+    '''
+    EXPLAIN QUERY PLAN of a query plus the (table, column) pairs it reads,
+    collected with an authorizer while the statement is prepared.
+    '''
+    reads = set()
+
+    def authorizer(action, arg1, arg2, db_name, source):
+        if action == sqlite3.SQLITE_READ and arg1 and arg2:
+            reads.add((arg1, arg2.lower()))
+        return sqlite3.SQLITE_OK
+
+    conn.set_authorizer(authorizer)
+    try:
+        plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query).fetchall()]
+    finally:
+        conn.set_authorizer(None)
+    return plan, reads
+
+
+def indexed_columns(conn, table):
+    '''Columns that already lead an index of the table.'''
+    columns = set()
+    for index in conn.execute(f"PRAGMA index_list({quote(table)})").fetchall():
+        info = conn.execute(f"PRAGMA index_info({quote(index[1])})").fetchall()
+        if info and info[0][2]:
+            columns.add(info[0][2].lower())
+    return columns
+
+
+def time_query(db_path, query):
+    '''
+    Milliseconds a read query takes on a read-only connection, within the
+    SqlConn execution limits and bypassing the result cache.
+    '''
+    with SqlConn(os.path.relpath(db_path, SqlConn.base_path), readonly=True, use_cache=False) as sql:
+        start = time.perf_counter()
+        sql.execute(query)
+        return (time.perf_counter() - start) * 1000
+
+
+class IndexAdvisor:
+    '''
+    Collects scan/sort hotspots from the plans of executed queries and turns
+    them into single-column index suggestions per database. In auto mode the
+    top suggestions are created in the background, up to `budget` per
+    database, and the speedup of a query that triggered them is measured.
+    '''
+
+    def __init__(self, mode=INDEX_ADVISOR_MODE, budget=INDEX_ADVISOR_BUDGET, min_hits=INDEX_ADVISOR_MIN_HITS):
+        self.mode = mode
+        self.budget = budget
+        self.min_hits = min_hits
+        self.lock = threading.Lock()
+        self.hotspots = {}  # db_path -> {(table, column): {'filter', 'join', 'sort', 'query'}}
+        self.created = {}  # db_path -> [created index reports]
+        self.applying = set()
+
+    def observe(self, db_path, query, conn):
+        '''
+        Record the hotspots of an executed query. Only reads are observed,
+        since their queries are replayed to measure new indexes. Never raises.
+        '''
+        if self.mode == 'off' or not is_read_query(query):
+            return
+        try:
+            plan, reads = explain(conn, query)
+        except sqlite3.Error:
+            return
+
+        aliases = table_aliases(query)
+        scanned = set()
+        automatic = set()  # (table, column) SQLite builds a temporary index on
+        sorted_with_temp_tree = False
+        for detail in plan:
+            scan = SCAN_PATTERN.match(detail)
+            if scan and 'INDEX' not in scan.group(2):
+                scanned.add(aliases.get(scan.group(1).lower(), scan.group(1)).lower())
+            search = AUTOMATIC_INDEX_PATTERN.match(detail)
+            if search:
+                table = aliases.get(search.group(1).lower(), search.group(1)).lower()
+                for term in search.group(2).split(' AND '):
+                    automatic.add((table, term.split('=')[0].split('>')[0].split('<')[0].strip().lower()))
+            if SORT_PATTERN.search(detail):
+                sorted_with_temp_tree = True
+
+        used = clause_columns(query)
+        with self.lock:
+            hotspots = self.hotspots.setdefault(db_path, {})
+            for table, column in reads:
+                roles = []
+                if table.lower() in scanned:
+                    roles += [role for role in ('filter', 'join') if column in used[role]]
+                if (table.lower(), column) in automatic and 'join' not in roles:
+                    roles.append('join')
+                if sorted_with_temp_tree and column in used['sort']:
+                    roles.append('sort')
+                if not roles:
+                    continue
+                spot = hotspots.setdefault((table, column), {'filter': 0, 'join': 0, 'sort': 0, 'query': query})
+                for role in roles:
+                    spot[role] += 1
+                spot['query'] = query
+
+        if self.mode == 'auto':
+            self.maybe_apply(db_path)
+
+    @staticmethod
+    def score(spot):
+        return 2 * spot['filter'] + 2 * spot['join'] + spot['sort']
+
+    def advice(self, db_path):
+        '''Index suggestions for a database, best first, skipping columns that are already indexed.'''
+        with self.lock:
+            hotspots = dict(self.hotspots.get(db_path, {}))
+            created = list(self.created.get(db_path, []))
+
+        suggestions = []
+        if hotspots:
+            conn = sqlite3.connect(db_path)
+            try:
+                indexed = {}
+                for (table, column), spot in hotspots.items():
+                    if table not in indexed:
+                        try:
+                            indexed[table] = indexed_columns(conn, table)
+                        except sqlite3.Error:
+                            continue
+                    if column in indexed[table]:
+                        continue
+                    suggestions.append({
+                        'table': table,
+                        'column': column,
+                        'score': self.score(spot),
+                        'filter': spot['filter'],
+                        'join': spot['join'],
+                        'sort': spot['sort'],
+                        'sql': f"CREATE INDEX IF NOT EXISTS {quote('idx_' + table + '_' + column)} ON {quote(table)} ({quote(column)})",
+                        'query': spot['query'],
+                    })
+            finally:
+                conn.close()
+
+        suggestions.sort(key=lambda suggestion: suggestion['score'], reverse=True)
+        return {'mode': self.mode, 'budget': self.budget, 'suggestions': suggestions, 'created': created}
+
+    def apply(self, db_path, limit=None, min_score=0):
+        '''
+        Create the top suggestions within the remaining budget and measure
+        their effect on the query that suggested them (see time_query). Only
+        the CREATE INDEX is ever written.
+        '''
+        with self.lock:
+            remaining = self.budget - len(self.created.get(db_path, []))
+        limit = remaining if limit is None else min(limit, remaining)
+
+        suggestions = [s for s in self.advice(db_path)['suggestions'] if s['score'] >= min_score]
+        reports = []
+        for suggestion in suggestions[:max(0, limit)]:
+            if not is_read_query(suggestion['query']):
+                continue
+            try:
+                before = time_query(db_path, suggestion['query'])
+                conn = sqlite3.connect(db_path, timeout=30)
+                try:
+                    conn.execute(suggestion['sql'])
+                    conn.commit()
+                finally:
+                    conn.close()
+                after = time_query(db_path, suggestion['query'])
+            except (sqlite3.Error, QueryLimitExceeded) as e:
+                print('Could not create index:', suggestion['sql'], e)
+                continue
+            report = {
+                'table': suggestion['table'],
+                'column': suggestion['column'],
+                'sql': suggestion['sql'],
+                'query': suggestion['query'],
+                'before_ms': round(before, 3),
+                'after_ms': round(after, 3),
+                'speedup': round(before / after, 2) if after else None,
+            }
+            print('Created index:', report)
+            reports.append(report)
+            with self.lock:
+                self.created.setdefault(db_path, []).append(report)
+        return reports
+
+    def maybe_apply(self, db_path):
+        '''Auto mode: create indexes for hotspots past min_hits, off the request thread.'''
+        with self.lock:
+            if db_path in self.applying or len(self.created.get(db_path, [])) >= self.budget:
+                return
+            hot = any(self.score(spot) >= self.min_hits for spot in self.hotspots.get(db_path, {}).values())
+            if not hot:
+                return
+            self.applying.add(db_path)
+
+        def run():
+            try:
+                self.apply(db_path, limit=1, min_score=self.min_hits)
+            finally:
+                with self.lock:
+                    self.applying.discard(db_path)
+
+        threading.Thread(target=run, name="index-advisor", daemon=True).start()
+
+
+index_advisor = IndexAdvisor()
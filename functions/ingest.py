@@ -0,0 +1,270 @@
+import csv
+import io
+import os
+import re
+import sqlite3
+import threading
+import time
+from itertools import islice
+
+from functions.schema_cache import schema_cache
+from functions.result_cache import result_cache
+from functions.column_types import (normalize_null, infer_column_types, convert_rows, widen, find_key_column,
+                                    STRICT_SUPPORTED)
+from functions.column_stats import COLUMN_STATS, TableStats, write_table_stats, drop_table_stats, compute_table_stats
+
+INGEST_CHUNK_ROWS = int(os.getenv("INGEST_CHUNK_ROWS", "5000"))
+INGEST_PROGRESS_TTL = 3600  # seconds a finished import stays queryable
+IMPORT_STRICT_TABLES = os.getenv("IMPORT_STRICT_TABLES") == "true" or os.getenv("IMPORT_STRICT_TABLES") == "1" or os.getenv("IMPORT_STRICT_TABLES") == "True"
+IMPORT_WITHOUT_ROWID = os.getenv("IMPORT_WITHOUT_ROWID") == "true" or os.getenv("IMPORT_WITHOUT_ROWID") == "1" or os.getenv("IMPORT_WITHOUT_ROWID") == "True"
+# Connection settings for the bulk load. The whole load is one transaction,
+# so synchronous only costs a few syncs at commit; the default rollback
+# journal keeps the rest of the database safe if the process dies mid-load.
+INGEST_PRAGMAS = {
+    'journal_mode': os.getenv("INGEST_JOURNAL_MODE", "DELETE"),
+    'synchronous': os.getenv("INGEST_SYNCHRONOUS", "NORMAL"),
+    'cache_size': os.getenv("INGEST_CACHE_SIZE", "-65536"),  # negative = KiB, i.e. 64 MB
+    'temp_store': 'MEMORY',
+}
+
+
+def sanitize_table_name(csv_title):
+    return csv_title.split('.')[0].lower().replace(' ', '_').replace('-', '_').replace('(', '').replace(')', '').strip().strip('_')
+
+
+def sanitize_columns(header):
+    '''
+    Column rules of the import: pandas-style names for blank/duplicate headers
+    ("Unnamed: 3", "a.1"), lowercase with spaces as underscores, later
+    duplicates dropped, then non-word characters removed.
+    Returns (indices of the kept columns, their names).
+    '''
+    seen = {}
+    names = []
+    for i, name in enumerate(header):
+        name = name if name.strip() else f"Unnamed: {i}"
+        if name in seen:
+            count = seen[name]
+            while f"{name}.{count}" in seen:
+                count += 1
+            seen[name] = count + 1
+            name = f"{name}.{count}"
+        seen.setdefault(name, 1)
+        names.append(name)
+
+    # Make all column names lowercase and replace spaces with underscores
+    names = [name.lower().replace(' ', '_') for name in names]
+
+    # Remove duplicate columns and special characters
+    keep = []
+    kept_names = []
+    for i, name in enumerate(names):
+        if name not in names[:i]:
+            keep.append(i)
+            kept_names.append(re.sub(r'[^\w]+', '', name))
+    return keep, kept_names
+
+
+def quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+class CountingReader(io.RawIOBase):
+    '''Raw binary reader over a stream that counts the bytes read through it.'''
+
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        self.bytes_read += len(data)
+        return len(data)
+
+
+# Progress of running and finished imports, by upload id
+ingest_progress = {}
+ingest_progress_lock = threading.Lock()
+
+
+def report_progress(upload_id, **fields):
+    if upload_id is None:
+        return
+    now = time.time()
+    with ingest_progress_lock:
+        ingest_progress.setdefault(upload_id, {}).update(fields, updated_at=now)
+        for key in [key for key, value in ingest_progress.items() if now - value['updated_at'] > INGEST_PROGRESS_TTL]:
+            del ingest_progress[key]
+
+
+def get_progress(upload_id):
+    with ingest_progress_lock:
+        progress = ingest_progress.get(upload_id)
+        return dict(progress) if progress is not None else None
+
+
+def table_definition(table, columns, column_types, key=None, strict=False):
+    '''CREATE TABLE statement of an imported table.'''
+    definitions = [quote(c) + ' ' + t['sql_type'] for c, t in zip(columns, column_types)]
+    if key is not None:
+        definitions[key] += ' NOT NULL PRIMARY KEY'
+    options = (['STRICT'] if strict else []) + (['WITHOUT ROWID'] if key is not None else [])
+    return f"CREATE TABLE {quote(table)} ({', '.join(definitions)}) {', '.join(options)}"
+
+
+def rebuild_table(conn, table, create_sql, columns, changes):
+    '''
+    Replace `table` by a copy created with `create_sql` (in the current
+    transaction), passing column i through changes[i] on the way.
+    '''
+    staging = table + '__rebuild'
+    selected = []
+    for i, column in enumerate(columns):
+        if i in changes:
+            conn.create_function(f'aisql_change_{i}', 1, changes[i], deterministic=True)
+            selected.append(f'aisql_change_{i}({quote(column)})')
+        else:
+            selected.append(quote(column))
+    conn.execute(f"DROP TABLE IF EXISTS {quote(staging)}")
+    conn.execute(create_sql.replace(f"CREATE TABLE {quote(table)}", f"CREATE TABLE {quote(staging)}", 1))
+    conn.execute(f"INSERT INTO {quote(staging)} SELECT {', '.join(selected)} FROM {quote(table)}")
+    conn.execute(f"DROP TABLE {quote(table)}")
+    conn.execute(f"ALTER TABLE {quote(staging)} RENAME TO {quote(table)}")
+    for i in changes:
+        conn.create_function(f'aisql_change_{i}', 1, None)
+
+
+def ingest_csv(fileobj, csv_title, db_path, chunk_size=INGEST_CHUNK_ROWS, upload_id=None, counter=None,
+               strict=IMPORT_STRICT_TABLES, without_rowid=IMPORT_WITHOUT_ROWID):
+    '''
+    Load a CSV text stream into `db_path` as table `csv_title`, replacing it.
+
+    Rows are parsed and inserted `chunk_size` at a time with executemany(),
+    so memory does not depend on the file size. The drop, create and inserts
+    run in one transaction: readers see the old table until the commit.
+    Progress (rows, and bytes when a CountingReader `counter` is given) is
+    published under `upload_id`.
+
+    Column types are inferred from the first chunk (see functions.column_types)
+    and null sentinels such as "null" or "N/A" are stored as NULL. When a
+    later chunk has values that do not fit a column's type, the column is
+    widened (integer to real, anything to text) and the rows loaded so far
+    are rewritten to match, so a column never mixes representations and
+    STRICT tables do not reject the file. With `strict` the table is created
+    STRICT; with `without_rowid` it is created WITHOUT ROWID keyed on an
+    integer id column, if the sample has one (a duplicate key later in the
+    file then fails the import).
+
+    The column statistics catalog (functions.column_stats) is filled from the
+    same chunks as they are inserted and committed with the table (or from
+    the table itself once a column was widened). Inferred relationships of
+    a replaced table (functions.relationships) are dropped with it and
+    inferred again after the commit.
+    '''
+    from functions.relationships import has_relationships, drop_table_relationships, infer_relationships  # they import this module
+    table = sanitize_table_name(csv_title)
+    report_progress(upload_id, status='running', table=table, rows=0, bytes=0)
+
+    reader = csv.reader(fileobj)
+    header = next(reader, None)
+    if not header:
+        report_progress(upload_id, status='error', error='Empty CSV')
+        raise ValueError("CSV has no header row")
+    keep, columns = sanitize_columns(header)
+
+    def chunks():
+        while True:
+            chunk = list(islice(reader, chunk_size))
+            if not chunk:
+                return
+            yield [
+                [(normalize_null(row[i]) if i < len(row) else None) for i in keep]
+                for row in chunk
+            ]
+
+    chunk_iter = chunks()
+    first = next(chunk_iter, [])
+
+    if strict and not STRICT_SUPPORTED:
+        print('SQLite is too old for STRICT tables, creating a regular table')
+        strict = False
+    column_types = infer_column_types(first, len(columns), strict=strict)
+    raw_first = first
+    first, misfits = convert_rows(raw_first, column_types)
+    while misfits:
+        for i, values in misfits.items():
+            column_types[i], _ = widen(column_types[i], values, strict)
+        first, misfits = convert_rows(raw_first, column_types)
+
+    key = find_key_column(table, columns, column_types, first) if without_rowid else None
+    if without_rowid and key is None:
+        print(f'No unique integer id column in {table}, creating a rowid table')
+
+    table_stats = TableStats(columns) if COLUMN_STATS else None
+
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    rows = 0
+    reinfer = False
+    try:
+        for name, value in INGEST_PRAGMAS.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(f"DROP TABLE IF EXISTS {quote(table)}")
+        reinfer = has_relationships(conn)
+        drop_table_relationships(conn, table)
+        conn.execute(table_definition(table, columns, column_types, key, strict))
+        insert = f"INSERT INTO {quote(table)} VALUES ({', '.join('?' * len(columns))})"
+
+        chunk = first
+        while chunk:
+            conn.executemany(insert, chunk)
+            if table_stats is not None:
+                table_stats.add_rows(chunk)
+            rows += len(chunk)
+            report_progress(upload_id, rows=rows, bytes=counter.bytes_read if counter else None)
+            raw = next(chunk_iter, None)
+            if not raw:
+                break
+            chunk, misfits = convert_rows(raw, column_types)
+            while misfits:
+                # Values the sample did not predict: widen those columns and rewrite what is loaded
+                changes = {}
+                for i, values in misfits.items():
+                    column_types[i], changes[i] = widen(column_types[i], values, strict)
+                    print(f'Column {columns[i]} of {table} widened to {column_types[i]["kind"]}')
+                rebuild_table(conn, table, table_definition(table, columns, column_types, key, strict), columns, changes)
+                table_stats = None
+                chunk, misfits = convert_rows(raw, column_types)
+
+        if table_stats is not None:
+            write_table_stats(conn, table, table_stats)
+        elif COLUMN_STATS:
+            write_table_stats(conn, table, compute_table_stats(conn, table))
+        else:
+            drop_table_stats(conn, table)
+        conn.execute("COMMIT")
+    except Exception as e:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        report_progress(upload_id, status='error', error=str(e))
+        raise
+    finally:
+        conn.close()
+
+    if reinfer:
+        infer_relationships(db_path)
+    # Drop the cached structure and query results so the next read sees the new table
+    schema_cache.invalidate(db_path)
+    result_cache.invalidate(db_path)
+    report_progress(upload_id, status='done', rows=rows)
+    return {
+        'table': table,
+        'columns': columns,
+        'types': [column_type['kind'] for column_type in column_types],
+        'rows': rows,
+    }
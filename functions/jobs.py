@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from functions.metrics import inc
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))  # pipelines running at once
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", "64"))  # queued + running jobs before new ones are refused
+JOB_TTL = float(os.getenv("JOB_TTL", "3600"))  # seconds a finished job stays queryable
+
+FINISHED = ('done', 'error')
+
+
+class JobQueueFull(Exception):
+    def __init__(self, limit):
+        super().__init__(f"Too many pending jobs ({limit}); try again later")
+        self.limit = limit
+
+
+class Job:
+    '''
+    One submitted pipeline run. `events` is the ordered list of progress
+    steps ({"id", "step", "time", ...}); waiters are woken on every change.
+    '''
+
+    def __init__(self, kind, meta):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.meta = meta
+        self.status = 'queued'
+        self.events = []
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.changed = threading.Condition()
+
+    def report(self, step, **fields):
+        '''Progress callback handed to the pipeline.'''
+        with self.changed:
+            self.events.append({'id': len(self.events), 'step': step, 'time': time.time(), **fields})
+            self.updated_at = time.time()
+            self.changed.notify_all()
+
+    def finish(self, status, result=None, error=None):
+        with self.changed:
+            self.status = status
+            self.result = result
+            self.error = error
+            self.updated_at = time.time()
+            self.changed.notify_all()
+
+    def wait(self, since, timeout):
+        '''
+        Events with an id >= `since`, waiting up to `timeout` seconds for one
+        if there are none yet. Returns (events, finished).
+        '''
+        with self.changed:
+            if len(self.events) <= since and self.status not in FINISHED:
+                self.changed.wait(timeout)
+            return self.events[since:], self.status in FINISHED
+
+    def to_dict(self):
+        with self.changed:
+            return {
+                'job_id': self.id,
+                'kind': self.kind,
+                'status': self.status,
+                'steps': list(self.events),
+                'error': self.error,
+                'created_at': self.created_at,
+                'updated_at': self.updated_at,
+                **self.meta,
+            }
+
+
+class JobManager:
+    '''
+    Runs long pipelines (e.g. /request) on a bounded executor of its own, so
+    the web server threads only submit jobs and report on them. At most
+    `max_pending` jobs are queued or running; finished jobs are kept for
+    `ttl` seconds.
+    '''
+
+    def __init__(self, workers=JOB_WORKERS, max_pending=JOB_MAX_PENDING, ttl=JOB_TTL):
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+
+    def submit(self, kind, run, error_payload=None, **meta):
+        '''
+        Queue `run(report)` as a job and return it. `report(step, **fields)`
+        records progress; the return value becomes the job result. Exceptions
+        are stored as error_payload(e) (by default {"error", "message"}).
+        Raises JobQueueFull when `max_pending` jobs are already waiting or running.
+        '''
+        with self.lock:
+            self.expire()
+            pending = sum(1 for job in self.jobs.values() if job.status not in FINISHED)
+            if pending >= self.max_pending:
+                inc('aisql_jobs_total', kind=kind, status='rejected')
+                raise JobQueueFull(self.max_pending)
+            job = Job(kind, meta)
+            self.jobs[job.id] = job
+        self.executor.submit(self.run, job, run, error_payload)
+        return job
+
+    def run(self, job, run, error_payload):
+        with job.changed:
+            job.status = 'running'
+            job.updated_at = time.time()
+        job.report('started')
+        try:
+            result = run(job.report)
+        except Exception as e:
+            payload = error_payload(e) if error_payload else {'error': type(e).__name__, 'message': str(e)}
+            job.finish('error', error=payload)
+        else:
+            job.finish('done', result=result)
+        inc('aisql_jobs_total', kind=job.kind, status=job.status)
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def expire(self):
+        '''Drop finished jobs older than the ttl. Caller holds the lock.'''
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job.status in FINISHED and now - job.updated_at > self.ttl]:
+            del self.jobs[job_id]
+
+    def stats(self):
+        with self.lock:
+            statuses = {}
+            for job in self.jobs.values():
+                statuses[job.status] = statuses.get(job.status, 0) + 1
+            return {'jobs': len(self.jobs), 'max_pending': self.max_pending, **statuses}
+
+
+job_manager = JobManager()
@@ -0,0 +1,283 @@
+import asyncio
+import functools
+import os
+import random
+import threading
+import time
+
+import httpx
+import ollama
+import google.generativeai as genai
+
+from functions.metrics import inc, span
+
+USE_OLLAMA = os.environ.get('USE_OLLAMA', 'False') == 'True'
+LLM_BACKEND = os.getenv("LLM_BACKEND") or ('ollama' if USE_OLLAMA else 'gemini')
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))  # seconds per call
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "2"))  # extra attempts after a transient failure
+LLM_BACKOFF = float(os.getenv("LLM_BACKOFF", "0.5"))  # first retry delay, doubled each time
+LLM_STUB_LATENCY = float(os.getenv("LLM_STUB_LATENCY", "0"))
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", 'gemini-2.0-flash')
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL") or 'llama3.3:70b-instruct-q2_K'
+OLLAMA_HOST = os.getenv("OLLAMA_HOST")
+
+
+class LLMError(Exception):
+    '''
+    A backend call that failed for good: a permanent error (bad request,
+    auth, ...) or a transient one (timeout, 429, 5xx) still failing after
+    the client's retries. The backend's exception is the __cause__.
+    '''
+
+    def __init__(self, backend, error, attempts):
+        super().__init__(f"LLM call to {backend} failed after {attempts} attempt(s): {error}")
+        self.backend = backend
+        self.attempts = attempts
+
+
+def is_transient(error):
+    '''Whether a backend error is worth retrying: timeouts, connection errors, HTTP 408/429/5xx.'''
+    if isinstance(error, (TimeoutError, ConnectionError, httpx.TimeoutException, httpx.TransportError)):
+        return True
+    # google.api_core exceptions carry the HTTP status as `code`, ollama's ResponseError as `status_code`
+    status = getattr(error, 'code', None)
+    if not isinstance(status, int):
+        status = getattr(error, 'status_code', None)
+    return isinstance(status, int) and (status in (408, 429) or status >= 500)
+
+
+def convert_ollama_tool_to_gemini(ollama_tool: dict) -> dict:
+    if USE_OLLAMA:
+        return ollama_tool
+    if ollama_tool['type'] != 'function':
+        raise ValueError("Only 'function' tools are supported.")
+
+    gemini_tool = {
+        "function_declarations": [
+            {
+                "name": ollama_tool['function']['name'],
+                "description": ollama_tool['function']['description'],
+                "parameters": ollama_tool['function']['parameters'],
+            }
+        ]
+    }
+    return gemini_tool
+
+
+def convert_ollama_context_to_gemini(context: list) -> list:
+    role_mapping = {
+        "user": "user",
+        "assistant": "model",
+        "tool": "model"
+    }
+
+    gemini_context = []
+    for message in context:
+        original_role = message.get("role", "user")
+        mapped_role = role_mapping.get(original_role)
+
+        if not mapped_role:
+            print(f"Skipping unsupported role: {original_role}")
+            continue
+
+        content = message.get("content", "")
+        if not content.strip():
+            print(f"Skipping empty content for role: {original_role}")
+            continue
+
+        gemini_message = {
+            "role": mapped_role,
+            "parts": [{"text": content}]
+        }
+        gemini_context.append(gemini_message)
+
+    return gemini_context
+
+
+def make_reply(text=None, name=None, arguments=None):
+    '''
+    Backend-independent reply: {"text": ..., "function": {"name", "arguments"} or None}.
+    '''
+    function = {"name": name, "arguments": arguments or {}} if name else None
+    return {"text": text, "function": function}
+
+
+ollama_clients = {}
+ollama_clients_lock = threading.Lock()
+
+
+def get_ollama_client(timeout=LLM_TIMEOUT):
+    '''Shared ollama.Client; its httpx connection pool keeps connections alive.'''
+    with ollama_clients_lock:
+        client = ollama_clients.get(timeout)
+        if client is None:
+            client = ollama_clients[timeout] = ollama.Client(host=OLLAMA_HOST, timeout=timeout)
+        return client
+
+
+class GeminiBackend:
+    '''
+    Configures the API key once and keeps one GenerativeModel per tool set,
+    so the underlying client and its connections are reused across calls.
+    '''
+
+    def __init__(self, model_name=GEMINI_MODEL):
+        self.model_name = model_name
+        self.lock = threading.Lock()
+        self.configured = False
+        self.models = {}
+
+    def get_model(self, tools):
+        key = tuple(tool['function']['name'] for tool in tools)
+        with self.lock:
+            if not self.configured:
+                genai.configure(api_key=os.environ.get('GEMINI_API_KEY'))
+                self.configured = True
+            model = self.models.get(key)
+            if model is None:
+                model = self.models[key] = genai.GenerativeModel(
+                    model_name=self.model_name,
+                    tools=[convert_ollama_tool_to_gemini(tool) for tool in tools],
+                )
+            return model
+
+    def generate(self, context, tools, timeout=LLM_TIMEOUT):
+        gemini_context = convert_ollama_context_to_gemini(context)
+        chat = self.get_model(tools).start_chat(history=gemini_context)
+
+        # Send latest user message
+        user_message = gemini_context[-1]['parts'][0]['text']
+        response = chat.send_message(user_message, request_options={'timeout': timeout})
+
+        for candidate in response.candidates or []:
+            if candidate.content and candidate.content.parts:
+                for part in candidate.content.parts:
+                    function_call = getattr(part, 'function_call', None)
+                    if function_call and function_call.name:
+                        return make_reply(name=function_call.name, arguments=dict(function_call.args or {}))
+
+        # No tool call was made; return normal model text
+        return make_reply(text=response.text)
+
+
+class OllamaBackend:
+    def __init__(self, model_name=OLLAMA_MODEL):
+        self.model_name = model_name
+
+    def generate(self, context, tools, timeout=LLM_TIMEOUT):
+        response = get_ollama_client(timeout).chat(self.model_name, messages=context, tools=tools or None)
+        for tool in response.message.tool_calls or []:
+            return make_reply(name=tool.function.name, arguments=dict(tool.function.arguments or {}))
+        return make_reply(text=response.message.content)
+
+
+class StubBackend:
+    '''
+    Deterministic local stand-in for tests and benchmarks. `responder(context, tools)`
+    returns a reply from make_reply(); by default the first tool is called with
+    arguments derived from the last message.
+    '''
+
+    def __init__(self, responder=None, latency=LLM_STUB_LATENCY):
+        self.responder = responder or self.default_responder
+        self.latency = latency
+
+    @staticmethod
+    def default_responder(context, tools):
+        last = context[-1]['content'] if context else ''
+        if not tools:
+            return make_reply(text=last)
+        tool = tools[0]['function']
+        arguments = {
+            name: ",".join(last.split()) if spec.get('type') == 'string' else spec.get('default')
+            for name, spec in tool['parameters']['properties'].items()
+            if name in tool['parameters'].get('required', [])
+        }
+        return make_reply(name=tool['name'], arguments=arguments)
+
+    def generate(self, context, tools, timeout=LLM_TIMEOUT):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.responder(context, tools)
+
+
+BACKENDS = {
+    'gemini': GeminiBackend,
+    'ollama': OllamaBackend,
+    'stub': StubBackend,
+}
+
+
+class LLMClient:
+    '''
+    Retrying front end over one backend. Only transient errors (see
+    is_transient) are retried, with jittered exponential backoff; anything
+    else, and the last failed attempt, raises LLMError at once.
+    '''
+
+    def __init__(self, backend, timeout=LLM_TIMEOUT, retries=LLM_RETRIES, backoff=LLM_BACKOFF):
+        self.backend = backend
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+    def delay(self, attempt):
+        return self.backoff * (2 ** attempt) * (0.5 + random.random() / 2)
+
+    def generate(self, context, tools):
+        backend = type(self.backend).__name__
+        for attempt in range(self.retries + 1):
+            try:
+                with span('llm', backend=backend):
+                    reply = self.backend.generate(context, tools, timeout=self.timeout)
+                inc('aisql_llm_calls_total', backend=backend, outcome='ok')
+                return reply
+            except Exception as e:
+                inc('aisql_llm_calls_total', backend=backend, outcome='error')
+                if attempt == self.retries or not is_transient(e):
+                    raise LLMError(backend, e, attempt + 1) from e
+                inc('aisql_llm_retries_total', backend=backend)
+                print(f'LLM call failed ({e}), retrying ({attempt + 1}/{self.retries})')
+                time.sleep(self.delay(attempt))
+
+    async def agenerate(self, context, tools):
+        '''
+        generate() for async callers: the blocking backend call runs in the
+        default executor, and the retries sleep without holding the event loop.
+        '''
+        backend = type(self.backend).__name__
+        loop = asyncio.get_running_loop()
+        call = functools.partial(self.backend.generate, context, tools, timeout=self.timeout)
+        for attempt in range(self.retries + 1):
+            try:
+                with span('llm', backend=backend):
+                    reply = await asyncio.wait_for(loop.run_in_executor(None, call), self.timeout)
+                inc('aisql_llm_calls_total', backend=backend, outcome='ok')
+                return reply
+            except Exception as e:
+                inc('aisql_llm_calls_total', backend=backend, outcome='error')
+                if attempt == self.retries or not is_transient(e):
+                    raise LLMError(backend, e, attempt + 1) from e
+                inc('aisql_llm_retries_total', backend=backend)
+                print(f'LLM call failed ({e}), retrying ({attempt + 1}/{self.retries})')
+                await asyncio.sleep(self.delay(attempt))
+
+
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_client(backend=None):
+    '''Shared LLMClient per backend name (LLM_BACKEND by default).'''
+    backend = backend or LLM_BACKEND
+    with clients_lock:
+        client = clients.get(backend)
+        if client is None:
+            client = clients[backend] = LLMClient(BACKENDS[backend]())
+        return client
+
+
+def set_client(backend, client):
+    '''Replace the shared client of a backend, e.g. a StubBackend with a custom responder.'''
+    with clients_lock:
+        clients[backend] = client
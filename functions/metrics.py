@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+METRICS = os.getenv("METRICS", "true") not in ("false", "0", "False")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HELP = {
+    'aisql_request_seconds': ('histogram', 'HTTP request latency by route, method and status.'),
+    'aisql_span_seconds': ('histogram', 'Duration of pipeline steps (spans).'),
+    'aisql_llm_calls_total': ('counter', 'LLM calls by backend and outcome.'),
+    'aisql_llm_retries_total': ('counter', 'LLM calls retried after a failure.'),
+    'aisql_sql_queries_total': ('counter', 'SQL queries executed by outcome.'),
+    'aisql_jobs_total': ('counter', 'Background jobs by kind and final status.'),
+    'aisql_singleflight_total': ('counter', 'Single-flight calls by group and outcome (leader, coalesced, timeout).'),
+}
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    '''
+    In-process counters and histograms, rendered in the Prometheus text
+    format. Series are keyed by metric name and sorted label pairs.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (
+            f'{key}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+            for key, value in pairs
+        )
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(h.counts), h.sum, h.count, h.buckets) for key, h in self.histograms.items()}
+
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                help_kind, help_text = HELP.get(name, (kind, name))
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in sorted(counters.items()):
+            describe(name, 'counter')
+            lines.append(f'{name}{self.format_labels(labels)} {value}')
+
+        for (name, labels), (counts, total, count, buckets) in sorted(histograms.items()):
+            describe(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{self.format_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{self.format_labels(labels)} {total}')
+            lines.append(f'{name}_count{self.format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def inc(name, value=1, **labels):
+    if METRICS:
+        registry.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    if METRICS:
+        registry.observe(name, value, **labels)
+
+
+@contextmanager
+def span(name, **labels):
+    '''Time a block into aisql_span_seconds{span=name}, whether it succeeds or raises.'''
+    if not METRICS:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe('aisql_span_seconds', time.perf_counter() - start, span=name, **labels)
@@ -0,0 +1,143 @@
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+
+POOL_MAX_SIZE = int(os.getenv("SQL_POOL_SIZE", "8"))
+POOL_IDLE_TIMEOUT = float(os.getenv("SQL_POOL_IDLE_TIMEOUT", "300"))
+POOL_CHECKOUT_TIMEOUT = float(os.getenv("SQL_POOL_CHECKOUT_TIMEOUT", "30"))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    '''
+    Bounded pool of sqlite3 connections for a single database file.
+
+    A connection is owned by one thread between checkout() and checkin(), so
+    connections are opened with check_same_thread=False and may be handed to
+    a different waitress worker on the next checkout. Connections idle for
+    longer than idle_timeout are closed the next time the pool is touched.
+    A readonly pool opens its connections with the mode=ro URI, so nothing
+    run on them can modify the file. Extension loading is disabled on all
+    connections.
+    '''
+
+    def __init__(self, db_path, max_size=POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT, readonly=False):
+        self.db_path = db_path
+        self.readonly = readonly
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.cond = threading.Condition()
+        self.idle = []  # [(connection, returned_at)], most recently used last
+        self.in_use = 0
+        self.closed = False
+
+    def connect(self):
+        if self.readonly:
+            uri = 'file:' + quote(os.path.abspath(self.db_path)) + '?mode=ro'
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        if hasattr(conn, 'enable_load_extension'):
+            # Off by default; make sure no statement can turn load_extension() on
+            conn.enable_load_extension(False)
+        conn.row_factory = sqlite3.Row  # So we can get column names easily
+        return conn
+
+    def evict_idle(self):
+        '''Close idle connections past idle_timeout. Caller holds the lock.'''
+        now = time.monotonic()
+        keep = []
+        for conn, returned_at in self.idle:
+            if now - returned_at > self.idle_timeout:
+                conn.close()
+            else:
+                keep.append((conn, returned_at))
+        self.idle = keep
+
+    def checkout(self, timeout=POOL_CHECKOUT_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise RuntimeError(f"Connection pool closed: {self.db_path}")
+                self.evict_idle()
+                if self.idle:
+                    conn, _ = self.idle.pop()
+                    self.in_use += 1
+                    return conn
+                if self.in_use < self.max_size:
+                    self.in_use += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f"No free connection for {self.db_path} after {timeout}s")
+                self.cond.wait(remaining)
+
+        # Open outside the lock; give the slot back if it fails
+        try:
+            return self.connect()
+        except Exception:
+            with self.cond:
+                self.in_use -= 1
+                self.cond.notify()
+            raise
+
+    def checkin(self, conn):
+        with self.cond:
+            self.in_use -= 1
+            if self.closed:
+                conn.close()
+            else:
+                if conn.in_transaction:
+                    conn.rollback()
+                self.idle.append((conn, time.monotonic()))
+                self.evict_idle()
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            for conn, _ in self.idle:
+                conn.close()
+            self.idle = []
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'db_path': self.db_path,
+                'readonly': self.readonly,
+                'max_size': self.max_size,
+                'idle': len(self.idle),
+                'in_use': self.in_use,
+            }
+
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(db_path, readonly=False):
+    key = (os.path.abspath(db_path), readonly)
+    with pools_lock:
+        pool = pools.get(key)
+        if pool is None or pool.closed:
+            pool = ConnectionPool(db_path, readonly=readonly)
+            pools[key] = pool
+        return pool
+
+
+def close_all_pools():
+    with pools_lock:
+        for pool in pools.values():
+            pool.close()
+        pools.clear()
+
+
+atexit.register(close_all_pools)
@@ -0,0 +1,171 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from functions.cache import LRUCache
+from functions.similarity import PromptIndex
+
+PERSISTENT_QUERY_CACHE = os.getenv("PERSISTENT_QUERY_CACHE") == "true" or os.getenv("PERSISTENT_QUERY_CACHE") == "1" or os.getenv("PERSISTENT_QUERY_CACHE") == "True"
+QUERY_CACHE_PATH = os.getenv("QUERY_CACHE_PATH", "./cache/nl_sql_cache.db")
+# Jaccard similarity needed to reuse the SQL of a near-duplicate prompt; > 1 disables it
+PROMPT_SIMILARITY_THRESHOLD = float(os.getenv("PROMPT_SIMILARITY_THRESHOLD", "0.9"))
+# Entries kept, in memory (least recently used evicted first) and in the persisted table (oldest dropped first)
+QUERY_STORE_MAX_ENTRIES = int(os.getenv("QUERY_STORE_MAX_ENTRIES", "10000"))
+
+
+def normalize_prompt(prompt):
+    '''Lowercase, collapse whitespace and drop surrounding punctuation.'''
+    prompt = re.sub(r'\s+', ' ', prompt.lower()).strip()
+    return prompt.strip(' ?!.,;:')
+
+
+class QueryStore:
+    '''
+    NL -> SQL cache of the queries produced by functions.run.get_sql_query.
+
+    Entries are keyed by (db_name, schema fingerprint, normalized prompt) so a
+    schema change never serves stale SQL. Lookups are served from memory; when
+    `path` is given every entry is also written to an SQLite side table and
+    warm_load() brings them back after a restart.
+
+    Prompts without an exact entry fall back to a PromptIndex per
+    (db_name, fingerprint), which finds near-duplicates such as
+    "Top ten products by rating?" for "top 10 products by rating".
+
+    At most `max_entries` entries are kept: in memory as an LRU whose
+    evictions also leave the prompt index, on disk by age. Storing an entry
+    under a new fingerprint of a database drops those of its older schemas.
+    '''
+
+    def __init__(self, path=None, similarity_threshold=PROMPT_SIMILARITY_THRESHOLD, max_entries=QUERY_STORE_MAX_ENTRIES):
+        self.path = path
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # Every entry costs 1, so the byte budget of the LRU is an entry count
+        self.entries = LRUCache(max_bytes=max_entries, on_evict=self.evicted)
+        self.indexes = {}
+        self.conn = None
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        if path:
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS nl_sql_cache (
+                    db_name TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    prompt TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (db_name, fingerprint, prompt)
+                )
+            ''')
+            self.conn.execute("CREATE INDEX IF NOT EXISTS nl_sql_cache_created_at ON nl_sql_cache (created_at)")
+            self.conn.commit()
+
+    def warm_load(self):
+        '''Load the newest `max_entries` persisted entries into memory. Returns the number loaded.'''
+        if self.conn is None:
+            return 0
+        with self.lock:
+            self.prune_persisted()
+            rows = self.conn.execute(
+                "SELECT db_name, fingerprint, prompt, query FROM nl_sql_cache ORDER BY created_at DESC LIMIT ?",
+                (self.max_entries,)).fetchall()
+            # Oldest first, so the newest end up most recently used
+            for db_name, fingerprint, prompt, query in reversed(rows):
+                if self.entries.set((db_name, fingerprint, prompt), query, size=1):
+                    self.get_index(db_name, fingerprint).add(prompt, query)
+        print(f"Warm-loaded {len(rows)} cached queries from {self.path}")
+        return len(rows)
+
+    def get_index(self, db_name, fingerprint):
+        '''Prompt index of one schema. Caller holds the lock.'''
+        index = self.indexes.get((db_name, fingerprint))
+        if index is None:
+            index = self.indexes[(db_name, fingerprint)] = PromptIndex()
+        return index
+
+    def evicted(self, key, query):
+        '''LRU eviction callback: the prompt leaves its index too. Runs under the lock of put().'''
+        db_name, fingerprint, prompt = key
+        index = self.indexes.get((db_name, fingerprint))
+        if index is not None:
+            index.remove(prompt)
+            if not len(index):
+                del self.indexes[(db_name, fingerprint)]
+
+    def drop_stale(self, db_name, fingerprint):
+        '''Forget the entries of other (older) schemas of a database. Caller holds the lock.'''
+        stale = [key for key in self.indexes if key[0] == db_name and key[1] != fingerprint]
+        if not stale:
+            return
+        for key in stale:
+            del self.indexes[key]
+        self.entries.invalidate(lambda key: key[0] == db_name and key[1] != fingerprint)
+        if self.conn is not None:
+            self.conn.execute("DELETE FROM nl_sql_cache WHERE db_name = ? AND fingerprint != ?", (db_name, fingerprint))
+
+    def prune_persisted(self):
+        '''Keep the newest `max_entries` rows of the persisted table. Caller holds the lock.'''
+        self.conn.execute(
+            "DELETE FROM nl_sql_cache WHERE rowid IN "
+            "(SELECT rowid FROM nl_sql_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def get(self, db_name, fingerprint, prompt):
+        key = (db_name, fingerprint, normalize_prompt(prompt))
+        with self.lock:
+            query = self.entries.get(key)
+            if query is not None:
+                self.hits += 1
+                return query
+            index = self.indexes.get((db_name, fingerprint))
+
+        if index is not None and 0 < self.similarity_threshold <= 1:
+            query, score = index.find(prompt, self.similarity_threshold)
+            if query is not None:
+                print(f"Near-duplicate prompt matched (similarity {score:.2f})")
+                with self.lock:
+                    self.near_hits += 1
+                return query
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, db_name, fingerprint, prompt, query):
+        key = (db_name, fingerprint, normalize_prompt(prompt))
+        with self.lock:
+            self.drop_stale(db_name, fingerprint)
+            if self.entries.set(key, query, size=1):
+                self.get_index(db_name, fingerprint).add(key[2], query)
+            if self.conn is not None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO nl_sql_cache (db_name, fingerprint, prompt, query, created_at) VALUES (?, ?, ?, ?, ?)",
+                    key + (query, time.time()),
+                )
+                self.prune_persisted()
+                self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.near_hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'persistent': self.conn is not None,
+                'similarity_threshold': self.similarity_threshold,
+                'hits': self.hits,
+                'near_hits': self.near_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.near_hits) / total if total else 0.0,
+            }
+
+
+query_store = QueryStore(QUERY_CACHE_PATH if PERSISTENT_QUERY_CACHE else None)
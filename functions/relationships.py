@@ -0,0 +1,170 @@
+import os
+import sqlite3
+import time
+
+from functions.ingest import quote
+from functions.column_stats import INTERNAL_TABLE_PREFIX
+
+RELATIONSHIP_MIN_OVERLAP = float(os.getenv("RELATIONSHIP_MIN_OVERLAP", "0.9"))  # share of sampled values found in the parent key
+RELATIONSHIP_SAMPLE = int(os.getenv("RELATIONSHIP_SAMPLE", "1000"))  # distinct child values checked per candidate
+
+RELATIONSHIPS_TABLE = '_aisql_relationships'
+RELATIONSHIPS_TABLE_SQL = f'''
+    CREATE TABLE IF NOT EXISTS {RELATIONSHIPS_TABLE} (
+        child_table TEXT NOT NULL,
+        child_column TEXT NOT NULL,
+        parent_table TEXT NOT NULL,
+        parent_column TEXT NOT NULL,
+        overlap REAL NOT NULL,
+        created_at REAL NOT NULL,
+        PRIMARY KEY (child_table, child_column, parent_table, parent_column)
+    )
+'''
+
+
+def singular(name):
+    name = name.lower()
+    if name.endswith('ies') and len(name) > 3:
+        return name[:-3] + 'y'
+    if name.endswith(('ses', 'xes', 'ches', 'shes')):
+        return name[:-2]
+    if name.endswith('s') and not name.endswith('ss'):
+        return name[:-1]
+    return name
+
+
+def user_tables(conn):
+    rows = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' AND name NOT LIKE ? ESCAPE '\\'",
+        (INTERNAL_TABLE_PREFIX.replace('_', '\\_') + '%',)).fetchall()
+    return [name for (name,) in rows]
+
+
+def is_unique(conn, table, column):
+    count, distinct = conn.execute(
+        f"SELECT COUNT({quote(column)}), COUNT(DISTINCT {quote(column)}) FROM {quote(table)}").fetchone()
+    return count > 0 and count == distinct
+
+
+def parent_keys(conn, tables):
+    '''
+    {table: key column} of the tables that can be referenced: a single-column
+    primary key, else a unique `id` / `<table>_id` / `<table>id` column.
+    '''
+    keys = {}
+    for table in tables:
+        columns = conn.execute(f"PRAGMA table_info({quote(table)})").fetchall()
+        primary = [column[1] for column in columns if column[5]]
+        if len(primary) == 1:
+            keys[table] = primary[0]
+            continue
+        names = {column[1].lower(): column[1] for column in columns}
+        stem = singular(table)
+        for candidate in ('id', f'{stem}_id', f'{stem}id'):
+            if candidate in names and is_unique(conn, table, names[candidate]):
+                keys[table] = names[candidate]
+                break
+    return keys
+
+
+def name_candidates(conn, tables, keys):
+    '''
+    (child table, child column, parent table, parent column) pairs suggested
+    by the names: `customer_id` / `customerid` pointing at a table
+    customer(s), or a column named like another table's key column.
+    '''
+    by_stem = {singular(table): table for table in keys}
+    candidates = []
+    for table in tables:
+        for column in conn.execute(f"PRAGMA table_info({quote(table)})").fetchall():
+            name = column[1]
+            if keys.get(table) == name:
+                continue
+            lower = name.lower()
+            parents = set()
+            for suffix in ('_id', 'id'):
+                if lower.endswith(suffix) and len(lower) > len(suffix):
+                    parent = by_stem.get(singular(lower[:-len(suffix)]))
+                    if parent:
+                        parents.add(parent)
+            for parent, key in keys.items():
+                if key.lower() == lower and key.lower() != 'id':
+                    parents.add(parent)
+            for parent in parents:
+                if parent != table:
+                    candidates.append((table, name, parent, keys[parent]))
+    return candidates
+
+
+def value_overlap(conn, child_table, child_column, parent_table, parent_column, sample=RELATIONSHIP_SAMPLE):
+    '''Share of (up to `sample`) distinct non-NULL child values present in the parent column; None without values.'''
+    sampled, matched = conn.execute(f'''
+        SELECT COUNT(*), COALESCE(SUM(value IN (SELECT {quote(parent_column)} FROM {quote(parent_table)})), 0)
+        FROM (SELECT DISTINCT {quote(child_column)} AS value FROM {quote(child_table)}
+              WHERE {quote(child_column)} IS NOT NULL LIMIT ?)
+    ''', (sample,)).fetchone()
+    return matched / sampled if sampled else None
+
+
+def infer_relationships(db_path, min_overlap=RELATIONSHIP_MIN_OVERLAP):
+    '''
+    Find likely foreign keys of a database by name, confirm them by value
+    overlap sampling, and record them in the relationships side table
+    (replacing earlier inferences), each child column indexed. Returns the
+    relationships as dicts.
+    '''
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    try:
+        tables = user_tables(conn)
+        keys = parent_keys(conn, tables)
+        found = []
+        for child_table, child_column, parent_table, parent_column in name_candidates(conn, tables, keys):
+            overlap = value_overlap(conn, child_table, child_column, parent_table, parent_column)
+            if overlap is not None and overlap >= min_overlap:
+                found.append({
+                    'child_table': child_table, 'child_column': child_column,
+                    'parent_table': parent_table, 'parent_column': parent_column,
+                    'overlap': round(overlap, 4),
+                })
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(RELATIONSHIPS_TABLE_SQL)
+            conn.execute(f"DELETE FROM {RELATIONSHIPS_TABLE}")
+            now = time.time()
+            for relationship in found:
+                conn.execute(f"INSERT INTO {RELATIONSHIPS_TABLE} VALUES (?, ?, ?, ?, ?, ?)", (
+                    relationship['child_table'], relationship['child_column'],
+                    relationship['parent_table'], relationship['parent_column'], relationship['overlap'], now))
+                child_table, child_column = relationship['child_table'], relationship['child_column']
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {quote('idx_' + child_table + '_' + child_column)} "
+                             f"ON {quote(child_table)} ({quote(child_column)})")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return found
+    finally:
+        conn.close()
+
+
+def has_relationships(conn):
+    '''Whether relationships were ever inferred for the database (the side table exists).'''
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (RELATIONSHIPS_TABLE,)).fetchone() is not None
+
+
+def drop_table_relationships(conn, table):
+    '''Forget the relationships `table` is part of, as child or parent, e.g. because it was replaced or changed.'''
+    if has_relationships(conn):
+        conn.execute(f"DELETE FROM {RELATIONSHIPS_TABLE} WHERE child_table = ? OR parent_table = ?", (table, table))
+
+
+def read_relationships(conn):
+    '''{(child table, child column): (parent table, parent column)} recorded for a database.'''
+    if not has_relationships(conn):
+        return {}
+    rows = conn.execute(
+        f"SELECT child_table, child_column, parent_table, parent_column FROM {RELATIONSHIPS_TABLE} ORDER BY overlap"
+    ).fetchall()
+    return {(child_table, child_column): (parent_table, parent_column)
+            for child_table, child_column, parent_table, parent_column in rows}
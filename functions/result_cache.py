@@ -0,0 +1,105 @@
+import os
+import re
+import threading
+
+from functions.cache import LRUCache
+
+SQL_RESULT_CACHE_MAX_BYTES = int(os.getenv("SQL_RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # 0 disables the cache
+# Bounds staleness after outside edits that leave the file's mtime and size unchanged
+SQL_RESULT_CACHE_TTL = float(os.getenv("SQL_RESULT_CACHE_TTL", "600")) or None
+
+# Single-quoted literals, double-quoted / bracketed / backticked identifiers, comments, whitespace
+SQL_TOKEN = re.compile(r"""('(?:[^']|'')*')|("(?:[^"]|"")*"|\[[^\]]*\]|`(?:[^`]|``)*`)|(--[^\n]*|/\*.*?\*/)|(\s+)""", re.DOTALL)
+
+
+def canonical_sql(query):
+    '''
+    Cache key form of a query: comments dropped, whitespace collapsed, a
+    trailing semicolon removed and bare words lowercased (SQLite keywords
+    and identifiers are case-insensitive). String literals and quoted or
+    bracketed identifiers are kept as written.
+    '''
+    parts = []
+    position = 0
+    for match in SQL_TOKEN.finditer(query):
+        if match.start() > position:
+            parts.append(query[position:match.start()].lower())
+        literal, identifier, comment, space = match.groups()
+        if literal is not None or identifier is not None:
+            parts.append(match.group())
+        elif not parts or not parts[-1].endswith(' '):
+            parts.append(' ')
+        position = match.end()
+    parts.append(query[position:].lower())
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+class ResultCache:
+    '''
+    Results of read queries, keyed by (database, canonical SQL, parameters,
+    data version) and bounded by an approximate byte budget (LRU).
+
+    The data version of a database is a generation counter, bumped by
+    invalidate() whenever the app writes to it (imports and non-read
+    statements, see functions.database), plus the inode, mtime and size of
+    the file and of its WAL, so changes made by other connections or
+    processes are not served from old entries either. Entries of earlier
+    versions are dropped on invalidate().
+    '''
+
+    def __init__(self, max_bytes=SQL_RESULT_CACHE_MAX_BYTES, ttl=SQL_RESULT_CACHE_TTL):
+        self.enabled = max_bytes > 0
+        self.cache = LRUCache(max_bytes=max_bytes, ttl=ttl)
+        self.lock = threading.Lock()
+        self.generations = {}
+
+    @staticmethod
+    def path_key(db_path):
+        return os.path.abspath(db_path)
+
+    @staticmethod
+    def file_version(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def data_version(self, db_path):
+        with self.lock:
+            generation = self.generations.get(self.path_key(db_path), 0)
+        # A commit rewrites the database file, or its WAL in WAL mode
+        return (generation, self.file_version(db_path), self.file_version(db_path + '-wal'))
+
+    def key(self, db_path, query, params):
+        params = tuple(params) if isinstance(params, (list, tuple)) else \
+            tuple(sorted(params.items())) if isinstance(params, dict) else params
+        return (self.path_key(db_path), canonical_sql(query), params, self.data_version(db_path))
+
+    def get(self, db_path, query, params=None):
+        '''(headers, rows) of an earlier identical query, or None.'''
+        if not self.enabled:
+            return None
+        cached = self.cache.get(self.key(db_path, query, params))
+        if cached is None:
+            return None
+        headers, rows = cached
+        # Callers get their own lists; the rows themselves are shared
+        return list(headers), list(rows)
+
+    def set(self, db_path, query, params, headers, rows, size):
+        if self.enabled:
+            self.cache.set(self.key(db_path, query, params), (list(headers), list(rows)), size=size)
+
+    def invalidate(self, db_path):
+        '''Start a new data version of `db_path` and drop its entries.'''
+        path = self.path_key(db_path)
+        with self.lock:
+            self.generations[path] = self.generations.get(path, 0) + 1
+        return self.cache.invalidate(lambda key: key[0] == path)
+
+    def stats(self):
+        return {'enabled': self.enabled, **self.cache.stats()}
+
+
+result_cache = ResultCache()
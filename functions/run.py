@@ -1,10 +1,9 @@
 # Standard imports
-import ollama
 from typing import Dict, Any, Callable
-import json
 import os
 import random
-import google.generativeai as genai
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
 
 # internal imports
 from functions.database import get_database_structure_as_context
@@ -12,7 +11,24 @@ from functions.database import get_sql_query, get_sql_query_tool
 from functions.database import extract_keywords, extract_keywords_tool, validate_keywords, get_table_list_in_database
 from functions.database import find_table_and_column_by_keywords, find_table_and_column_by_keywords_tool
 from functions.database import get_questions_tool, get_questions
+from functions.database import get_schema_fingerprint, get_sql_query as execute_sql_query
+from functions.sql import QueryLimitExceeded, SqlValidationError
+from functions.query_store import query_store
+from functions.throttle import RateLimiter
+from functions.trace import trace
+from functions.metrics import span
+from functions.llm import get_client, get_ollama_client, OLLAMA_MODEL, LLMError
+from functions.llm import convert_ollama_tool_to_gemini, convert_ollama_context_to_gemini
+
+QUESTIONS_MAX_PAIRS = int(os.getenv("QUESTIONS_MAX_PAIRS", "4"))
+QUESTIONS_WORKERS = int(os.getenv("QUESTIONS_WORKERS", "4"))
+QUESTIONS_RATE_LIMIT = float(os.getenv("QUESTIONS_RATE_LIMIT", "2"))  # LLM calls per second
+QUESTIONS_TIME_BUDGET = float(os.getenv("QUESTIONS_TIME_BUDGET", "20"))  # seconds
+
+questions_rate_limiter = RateLimiter(QUESTIONS_RATE_LIMIT)
+
 context = []
+traced_messages = 0  # messages of `context` already handed to the trace sink
 tools = [get_sql_query_tool]
 available_functions: Dict[str, Callable] = {
     'extract_keywords': extract_keywords,
@@ -31,33 +47,15 @@ def tool_call_to_dict(tool_call):
         }
     }
 
-def convert_ollama_tool_to_gemini(ollama_tool: dict) -> dict:
-    if os.environ.get('USE_OLLAMA', 'False') == 'True':
-        return ollama_tool
-    if ollama_tool['type'] != 'function':
-        raise ValueError("Only 'function' tools are supported.")
-    
-    gemini_tool = {
-        "function_declarations": [
-            {
-                "name": ollama_tool['function']['name'],
-                "description": ollama_tool['function']['description'],
-                "parameters": ollama_tool['function']['parameters'],
-            }
-        ]
-    }
-    return gemini_tool
-
-
-def get_response(prompt: str, use_tools: bool = True) -> Any:
+def get_response(prompt: str, use_tools: bool = True, db_name: str = 'user001.starter.db') -> Any:
     global context
     global tools
     global available_functions
-    set_context(get_database_structure_as_context())
+    set_context(get_database_structure_as_context(db_name, prompt=prompt))
     context.append({'role': 'user', 'content': prompt})
 
-    response = ollama.chat(
-        'llama3.3:70b-instruct-q2_K',
+    response = get_ollama_client().chat(
+        OLLAMA_MODEL,
         messages=context,
         tools=tools if use_tools else None,
     )
@@ -98,102 +96,69 @@ def get_response(prompt: str, use_tools: bool = True) -> Any:
 
     return returner
 
-def ask(context: list, tools: list, db_name: str = 'user001.starter.db') -> str:
-    # Configure Gemini API
-    genai.configure(api_key=os.environ.get('GEMINI_API_KEY'))
-
-    # Prepare tools and context
-    converted_tools = [convert_ollama_tool_to_gemini(tool) for tool in tools]
-    gemini_context = convert_ollama_context_to_gemini(context)
-
-    # Initialize model with tools
-    model = genai.GenerativeModel(
-        model_name='gemini-2.0-flash',
-        tools=converted_tools,
-    )
-
-    # Start chat session
-    chat = model.start_chat(history=gemini_context)
-
-    # Send latest user message
-    user_message = gemini_context[-1]['parts'][0]['text']
-    response = chat.send_message(user_message)
+def ask(context: list, tools: list, db_name: str = 'user001.starter.db', tool_args: dict = None) -> str:
+    # One call through the shared client of the configured backend (gemini, ollama or stub)
+    reply = get_client().generate(context, tools)
 
     # Handle tool calls if any
-    if hasattr(response, 'candidates') and response.candidates:
-        for candidate in response.candidates:
-            if hasattr(candidate, 'content') and candidate.content.parts:
-                for part in candidate.content.parts:
-                    if hasattr(part, 'function_call'):
-                        function_call = part.function_call
-                        func_name = function_call.name
-                        if function_call.args:
-                            args = dict(function_call.args)
-                        else:
-                            args = {}
-
-
-                        function_to_call = available_functions.get(func_name)
-                        if function_to_call:
-                            if 'db_name' in function_to_call.__code__.co_varnames and 'db_name' not in args:
-                                args['db_name'] = db_name
-                            return function_to_call(**args)
+    if reply["function"]:
+        func_name = reply["function"]["name"]
+        args = dict(reply["function"]["arguments"])
+
+        function_to_call = available_functions.get(func_name)
+        if function_to_call:
+            if 'db_name' in function_to_call.__code__.co_varnames and 'db_name' not in args:
+                args['db_name'] = db_name
+            for name, value in (tool_args or {}).items():
+                if name in function_to_call.__code__.co_varnames:
+                    args[name] = value
+            with span('tool', tool=func_name):
+                return function_to_call(**args)
+        print('Function', func_name, 'not found')
 
     # No tool call was made; return normal model text
-    return response.text
+    return reply["text"]
 
-def add_to_context(context: list, role: str, content: str = '', file_name: str = 'context') -> list:
+def add_to_context(context: list, role: str, content: str = '', conversation: str = 'context') -> list:
+    '''
+    Append a message to the in-memory conversation. Nothing is written on the
+    request path; with CONTEXT_TRACE on, the message also goes to the
+    background trace sink under the given conversation id.
+    '''
     context.append({'role': role, 'content': content})
-    if not os.path.exists("context"):
-        os.makedirs("context")
-    with open( "context/"+file_name + '.json', 'w') as f:
-        json.dump(context, f, indent=4)
+    trace(conversation, role, content)
     return context
 
 
-def convert_ollama_context_to_gemini(context: list) -> list:
-    role_mapping = {
-        "user": "user",
-        "assistant": "model",
-        "tool": "model"
-    }
-
-    gemini_context = []
-    for message in context:
-        original_role = message.get("role", "user")
-        mapped_role = role_mapping.get(original_role)
-
-        if not mapped_role:
-            print(f"Skipping unsupported role: {original_role}")
-            continue
-        
-        content = message.get("content", "")
-        if not content.strip():
-            print(f"Skipping empty content for role: {original_role}")
-            continue
-
-        gemini_message = {
-            "role": mapped_role,
-            "parts": [{"text": content}]
-        }
-        gemini_context.append(gemini_message)
-
-    return gemini_context
-
-
-
-
-
 def random_string(length: int) -> str:
     import string
     import random
     letters = string.ascii_lowercase
     return ''.join(random.choice(letters) for i in range(length))
 
-def get_sql_query(prompt: str, context: list = None, db_name: str = 'user001.starter.db') -> str:
+def get_sql_query(prompt: str, context: list = None, db_name: str = 'user001.starter.db', execute: bool = True,
+                  progress=None, use_cache: bool = True) -> str:
     '''
     Step 1: Extract keywords from the user's request.
+
+    With execute=False the generated SQL is returned without running it.
+    `progress(step, **fields)` is called as the pipeline advances, with the
+    steps "keywords", "tables" and "sql" (see functions.jobs).
+    use_cache=False runs the SQL without the SQL result cache.
     '''
+    progress = progress or (lambda step, **fields: None)
+    with span('query_store_lookup'):
+        fingerprint = get_schema_fingerprint(db_name)
+        cached_query = query_store.get(db_name, fingerprint, prompt)
+    if cached_query:
+        print('Cached SQL Query:', cached_query)
+        progress('sql', query=cached_query, cached=True)
+        try:
+            return execute_sql_query(cached_query, db_name=db_name, execute=execute, validate=True, use_cache=use_cache)
+        except SqlValidationError as e:
+            print('Cached SQL Query is no longer valid:', e)
+
+    conversation_id = ".".join([db_name, "sql", random_string(10)])
     context = add_to_context([], 'user', f"""
     I need you to extract as many relevant keywords as possible from the following request:
     
@@ -202,25 +167,25 @@ def get_sql_query(prompt: str, context: list = None, db_name: str = 'user001.sta
     Be very creative and thorough — don't just copy words directly. Think about synonyms, related terms, and different ways the same idea might be expressed. 
     Imagine all possible column names, table names, and SQL functions that could be relevant to this request.
     Return a comma-separated list of single-word keywords (no spaces), capturing the full scope of the request's meaning.
-    """, file_name=random_string(10))
-
-    context_file_name = ".".join([db_name, "sql", random_string(10),'json'])
+    """, conversation=conversation_id)
 
     
-    tables = get_table_list_in_database(db_name=db_name)
-    sub_keywords = extract_keywords(prompt)
+    with span('keyword_extraction'):
+        tables = get_table_list_in_database(db_name=db_name)
+        sub_keywords = extract_keywords(prompt)
 
-    if len(tables) <= 2:
-        print('Tables were less than or equal to 2:', tables)
-        raw_keywords = list(tables)
-    else:
-        raw_keywords = ask(context, [extract_keywords_tool], db_name=db_name)
+        if len(tables) <= 2:
+            print('Tables were less than or equal to 2:', tables)
+            raw_keywords = list(tables)
+        else:
+            raw_keywords = ask(context, [extract_keywords_tool], db_name=db_name)
 
-    if type(raw_keywords) == str:
-        raw_keywords = extract_keywords(raw_keywords)
+        if type(raw_keywords) == str:
+            raw_keywords = extract_keywords(raw_keywords)
 
-    keywords = validate_keywords(sub_keywords + raw_keywords, db_name=db_name)
-    context = add_to_context(context, 'assistant', f'Are these valid keywords? {", ".join(keywords)}.', file_name=context_file_name)
+    with span('keyword_validation'):
+        keywords = validate_keywords(sub_keywords + raw_keywords, db_name=db_name)
+    context = add_to_context(context, 'assistant', f'Are these valid keywords? {", ".join(keywords)}.', conversation=conversation_id)
 
     # Step 2: Validate keywords with the user
     max_attempts = 3
@@ -230,19 +195,22 @@ def get_sql_query(prompt: str, context: list = None, db_name: str = 'user001.sta
         context = add_to_context(context, 'user', f'''
         None of the keywords were found in the database.
         Please confirm or provide the correct keywords for the prompt: 
-        ```{prompt}```''', file_name=context_file_name)
+        ```{prompt}```''', conversation=conversation_id)
 
-        raw_keywords = ask(context, [extract_keywords_tool], db_name=db_name)
-        keywords = validate_keywords(sub_keywords + raw_keywords,sensitivity=sensitivity/(attempts+1), db_name=db_name)
+        with span('keyword_extraction'):
+            raw_keywords = ask(context, [extract_keywords_tool], db_name=db_name)
+        with span('keyword_validation'):
+            keywords = validate_keywords(sub_keywords + raw_keywords,sensitivity=sensitivity/(attempts+1), db_name=db_name)
         print("Keywords finalized are ", keywords)
-        context = add_to_context(context, 'assistant', f'Are these valid keywords? {", ".join(keywords)}.', file_name=context_file_name)
+        context = add_to_context(context, 'assistant', f'Are these valid keywords? {", ".join(keywords)}.', conversation=conversation_id)
         attempts += 1
 
     if len(keywords) == 0:
         raise Exception('No valid keywords found.')
 
     print('Keywords:', keywords, sensitivity)
-    context = add_to_context(context, 'user', f'Yes, {", ".join(keywords)} are valid.', file_name=context_file_name)
+    progress('keywords', keywords=keywords)
+    context = add_to_context(context, 'user', f'Yes, {", ".join(keywords)} are valid.', conversation=conversation_id)
 
 
     
@@ -250,9 +218,11 @@ def get_sql_query(prompt: str, context: list = None, db_name: str = 'user001.sta
     '''
     Step 3: Identify relevant tables and columns using the confirmed keywords.
     '''
-    table_and_column = find_table_and_column_by_keywords(keywords, sensitivity=sensitivity, db_name=db_name)
+    with span('table_lookup'):
+        table_and_column = find_table_and_column_by_keywords(keywords, sensitivity=sensitivity, db_name=db_name)
     print('Table and Column:', table_and_column, sensitivity)
-    context = add_to_context(context, 'assistant', f'Table and Column: {table_and_column}', file_name=context_file_name)
+    progress('tables', tables=table_and_column)
+    context = add_to_context(context, 'assistant', f'Table and Column: {table_and_column}', conversation=conversation_id)
 
     '''
     Step 4: Request generation and execution of the SQL query based on the original prompt.
@@ -260,44 +230,65 @@ def get_sql_query(prompt: str, context: list = None, db_name: str = 'user001.sta
     add_to_context(context, 'user', f'''
     Thanks. Can you prepare and run the SQL query for my original request?
     {prompt}
-    ''', file_name=context_file_name)
+    ''', conversation=conversation_id)
 
     attempts = 0
     max_attempts = 3
     sql_query = None
+    last_error = None
 
     while attempts < max_attempts:
         try:
-            sql_query = ask(context, [get_sql_query_tool], db_name=db_name)
+            # Includes validating and (with execute) running the query in the tool call
+            with span('sql_generation'):
+                sql_query = ask(context, [get_sql_query_tool], db_name=db_name, tool_args={'execute': execute, 'validate': True, 'use_cache': use_cache})
             if sql_query and sql_query.get("query"):
                 print('SQL Query:', sql_query.get("query"))
-                context = add_to_context(context, 'assistant', f'SQL Query: {sql_query.get("query")}')
+                progress('sql', query=sql_query.get("query"))
+                context = add_to_context(context, 'assistant', f'SQL Query: {sql_query.get("query")}', conversation=conversation_id)
                 break
+        except LLMError:
+            # The client already retried transient errors; asking again would only repeat them
+            raise
         except Exception as e:
             print(f'Attempt {attempts + 1} failed with error: {e}')
-            context = add_to_context(context, 'tool', f'Error: {e}', file_name=context_file_name)
+            last_error = e
+            if isinstance(e, SqlValidationError):
+                context = add_to_context(context, 'tool', f'Error: the query `{e.query}` is invalid: {e}. Please fix it.', conversation=conversation_id)
+            else:
+                context = add_to_context(context, 'tool', f'Error: {e}', conversation=conversation_id)
             context = add_to_context(context, 'user', f'''
             Just a reminder of the original request: {prompt}
             Keywords: {keywords}
             Table and Column: {table_and_column}
-            ''', file_name=context_file_name)
+            ''', conversation=conversation_id)
         attempts += 1
 
     if not sql_query or not sql_query.get("query"):
+        if isinstance(last_error, (QueryLimitExceeded, SqlValidationError)):
+            raise last_error
         raise Exception('Failed to generate SQL query after multiple attempts.')
 
-    if os.path.exists("context/"+context_file_name):
-        os.remove("context/"+context_file_name)
+    query_store.put(db_name, fingerprint, prompt, sql_query["query"])
+
     return sql_query
 
 
 
 
-def generate_questions(db_name):
+def generate_questions(db_name, max_pairs: int = None, time_budget: float = None):
     """
     Generate creative question ideas by combining tables two at a time.
+
+    Up to `max_pairs` table pairs are sent to the LLM concurrently through a
+    bounded thread pool and a shared rate limiter. Questions are deduplicated
+    as they arrive, and whatever has arrived after `time_budget` seconds is
+    returned; unfinished pairs are dropped.
     """
-    context_file_name = ".".join([db_name, "question", random_string(19), "json"])
+    max_pairs = QUESTIONS_MAX_PAIRS if max_pairs is None else max_pairs
+    time_budget = QUESTIONS_TIME_BUDGET if time_budget is None else time_budget
+    deadline = time.monotonic() + time_budget
+    conversation_id = ".".join([db_name, "question", random_string(19)])
     print('Generating questions...', db_name)
 
     tables = get_table_list_in_database(db_name=db_name)
@@ -305,55 +296,75 @@ def generate_questions(db_name):
         print('Not enough tables to generate questions.')
         return []
 
-    context = add_to_context([], 'user', '''
+    base_context = add_to_context([], 'user', '''
     Hey there, can you help me generate some ideas for questions I can ask about my database?
-    ''', file_name=context_file_name)
+    ''', conversation=conversation_id)
 
-    context = add_to_context(context, 'assistant', '''
+    base_context = add_to_context(base_context, 'assistant', '''
     Sure! Share the tables and columns, and I’ll create some questions for you.
-    ''', file_name=context_file_name)
-
-    questions = []
+    ''', conversation=conversation_id)
 
     table_pairs = [(tables[i], tables[j]) for i in range(len(tables)) for j in range(i + 1, len(tables))]
     random.shuffle(table_pairs)
+    table_pairs = table_pairs[:max_pairs]
 
-    for str_1, str_2 in table_pairs:
+    def ask_pair(str_1, str_2):
         keywords = extract_keywords(str_1) + extract_keywords(str_2)
         table_info = find_table_and_column_by_keywords(keywords, db_name=db_name, sensitivity=0.3)
 
         if not table_info:
             print(f'No relevant data for: {str_1}, {str_2}')
-            continue
+            return []
 
-        context = add_to_context(context, 'user', f'''
+        if not questions_rate_limiter.acquire(deadline):
+            return []
+
+        context = add_to_context(list(base_context), 'user', f'''
         Please generate creative and insightful questions involving the following tables and columns:
         {table_info}
         Think of real-world scenarios where these tables might interact.
-        ''', file_name=context_file_name)
+        ''', conversation=".".join([conversation_id, random_string(6)]))
 
         new_questions = ask(context, [get_questions_tool], db_name=db_name)
+        if isinstance(new_questions, str):
+            new_questions = get_questions(new_questions)
+        return new_questions or []
 
-        if new_questions:
-            questions.extend(new_questions)
-            context = add_to_context(context, 'assistant', f'''
-            Here are some generated questions:
-            {new_questions}
-            ''', file_name=context_file_name)
-        break
-    questions = list(set(questions))  # Remove duplicates
-    questions = [question for question in questions if question.strip()]  # Remove empty strings
+    questions = []
+    seen = set()
+    executor = ThreadPoolExecutor(max_workers=QUESTIONS_WORKERS)
+    try:
+        futures = [executor.submit(ask_pair, str_1, str_2) for str_1, str_2 in table_pairs]
+        for future in as_completed(futures, timeout=max(0.0, deadline - time.monotonic())):
+            try:
+                new_questions = future.result()
+            except Exception as e:
+                print('Question generation failed for a table pair:', e)
+                continue
+            for question in new_questions:
+                key = " ".join(question.lower().split())
+                if key and key not in seen:  # Remove duplicates and empty strings
+                    seen.add(key)
+                    questions.append(question.strip())
+    except FuturesTimeout:
+        print(f'Question generation stopped after {time_budget}s with {len(questions)} questions.')
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
     return questions
 
 def update_context():
     global context
-    with open('context.json', 'w') as f:
-        json.dump(context, f, indent=4)
+    global traced_messages
+    for message in context[traced_messages:]:
+        trace('context', message['role'], message['content'])
+    traced_messages = len(context)
 
 def set_context(new_context):
     global context
+    global traced_messages
     context = new_context
+    traced_messages = 0
 
 
 
@@ -0,0 +1,82 @@
+import copy
+import os
+import threading
+
+
+class SchemaCache:
+    '''
+    Process-wide cache of database structures, keyed by database file.
+
+    Each entry is tagged with a version (file mtime + PRAGMA schema_version).
+    A lookup with a different version is a miss and the entry gets rebuilt.
+    Values derived from the structure (indexes, rendered prompts, ...) can be
+    memoized on the same entry so they are dropped together with it.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(db_path):
+        return os.path.abspath(db_path)
+
+    def lookup(self, db_path, version):
+        with self.lock:
+            entry = self.entries.get(self.key(db_path))
+            if entry is not None and entry['version'] == version:
+                self.hits += 1
+                return copy.deepcopy(entry['structure'])
+            self.misses += 1
+            return None
+
+    def store(self, db_path, version, structure):
+        with self.lock:
+            self.entries[self.key(db_path)] = {
+                'version': version,
+                'structure': copy.deepcopy(structure),
+                'derived': {},
+            }
+
+    def memoize(self, db_path, version, name, build):
+        '''
+        Return a value derived from the cached structure, building it at most
+        once per schema version. `build` is called without the lock held.
+        '''
+        with self.lock:
+            entry = self.entries.get(self.key(db_path))
+            if entry is not None and entry['version'] == version and name in entry['derived']:
+                return entry['derived'][name]
+
+        value = build()
+
+        with self.lock:
+            entry = self.entries.get(self.key(db_path))
+            if entry is not None and entry['version'] == version:
+                entry['derived'][name] = value
+        return value
+
+    def invalidate(self, db_path=None):
+        with self.lock:
+            if db_path is None:
+                self.invalidations += len(self.entries)
+                self.entries.clear()
+            elif self.entries.pop(self.key(db_path), None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+
+schema_cache = SchemaCache()
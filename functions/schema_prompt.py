@@ -0,0 +1,160 @@
+import os
+import threading
+
+SCHEMA_PROMPT_BUDGET = int(os.getenv("SCHEMA_PROMPT_BUDGET", "1500"))  # tokens
+SCHEMA_PROMPT_SAMPLES = 3  # sample values shown per relevant column
+SAMPLE_MAX_LENGTH = 30  # longer values are not worth their tokens
+SCHEMA_PROMPT_OTHER_COLUMNS = 8  # unmatched, non-key columns kept per matched table
+MAX_MEMOIZED_RENDERS = 256
+
+TYPE_ABBREVIATIONS = {
+    'INTEGER': 'int', 'INT': 'int', 'BIGINT': 'int', 'SMALLINT': 'int', 'TINYINT': 'int',
+    'REAL': 'real', 'FLOAT': 'real', 'DOUBLE': 'real', 'NUMERIC': 'num', 'DECIMAL': 'num',
+    'TEXT': 'text', 'VARCHAR': 'text', 'CHAR': 'text', 'NVARCHAR': 'text', 'CLOB': 'text',
+    'BOOLEAN': 'bool', 'DATE': 'date', 'DATETIME': 'datetime', 'TIMESTAMP': 'datetime', 'BLOB': 'blob',
+}
+SAMPLED_TYPES = {'text', 'bool', 'date', 'datetime'}
+RANGED_TYPES = {'int', 'real', 'num'}
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def abbreviate_type(sql_type):
+    base = (sql_type or '').split('(')[0].strip().upper()
+    return TYPE_ABBREVIATIONS.get(base, (sql_type or '?').lower())
+
+
+def estimate_tokens(text):
+    '''Rough token count (about 4 characters per token).'''
+    return (len(text) + 3) // 4
+
+
+class SchemaPrompt:
+    '''
+    Compact rendering of one schema version for LLM prompts:
+
+        reviews(id int PK, product_id int FK->products.id, rating int 1..5, city text e.g. Paris|Oslo)
+
+    Tables are ranked by how well their names and columns match the keywords
+    of a request (through the IdentifierIndex), and rendered best first until
+    the token budget is used up. Tables with matched columns only keep a few
+    of their other columns; a table that does not fit is shortened to its
+    matched and key columns, and otherwise only named at the end. Sample
+    values (matched text-like columns) and value ranges (matched numeric
+    columns) come from the column statistics catalog. Renders are
+    memoized, and the instance itself is memoized per schema version.
+    '''
+
+    def __init__(self, db_structure):
+        self.tables = []  # [(table name, [column fragments], [(lowercased name, is key, samples)])]
+        for table_name, columns in db_structure['tables'].items():
+            fragments = []
+            details = []
+            for column in columns:
+                col_type = abbreviate_type(column['Type'])
+                fragment = f"{column['Field']} {col_type}"
+                key = column.get('Key', '')
+                if key == 'PRI':
+                    fragment += ' PK'
+                elif key == 'MUL':
+                    fragment += ' FK->' + column['References'] if column.get('References') else ' FK'
+                samples = ''
+                values = [value for value in column.get('Common Values') or [] if len(value) <= SAMPLE_MAX_LENGTH]
+                stats = column.get('Statistics') or {}
+                if col_type in SAMPLED_TYPES and values:
+                    samples = ' e.g. ' + '|'.join(values[:SCHEMA_PROMPT_SAMPLES])
+                elif col_type in RANGED_TYPES and is_number(stats.get('min')) and is_number(stats.get('max')):
+                    samples = f" {stats['min']:g}..{stats['max']:g}"
+                is_key = bool(key) or column['Field'].lower() == 'id' or column['Field'].lower().endswith('_id')
+                fragments.append(fragment)
+                details.append((column['Field'].lower(), is_key, samples))
+            self.tables.append((table_name, fragments, details))
+        self.lock = threading.Lock()
+        self.renders = {}
+
+    def relevance(self, index, keywords, sensitivity):
+        '''{table: (table score, {column: score})} for the tables the keywords match.'''
+        matched = set()
+        exact = set()
+        for keyword in keywords:
+            matched |= index.matches(keyword, sensitivity)
+            exact.add(keyword.lower())
+
+        scores = {}
+        for table_name, fragments, details in self.tables:
+            columns = {}
+            for name, is_key, samples in details:
+                if name in matched:
+                    columns[name] = 2 + (name in exact or name.rstrip('s') in exact)
+            table_score = 3 if table_name.lower() in matched else 0
+            if columns or table_score:
+                scores[table_name] = (table_score + sum(columns.values()), columns)
+        return scores
+
+    def render_table(self, table_name, fragments, details, relevant, other_columns=None):
+        '''
+        One table line. Matched and key columns are always shown; of the
+        other columns at most `other_columns` (all when None).
+        '''
+        parts = []
+        others = 0
+        for fragment, (name, is_key, samples) in zip(fragments, details):
+            if name in relevant:
+                parts.append(fragment + samples)
+            elif is_key:
+                parts.append(fragment)
+            elif other_columns is None or others < other_columns:
+                parts.append(fragment)
+                others += 1
+        if len(parts) < len(fragments):
+            parts.append(f"+{len(fragments) - len(parts)} more")
+        return f"{table_name}({', '.join(parts)})"
+
+    def render(self, index=None, keywords=(), budget=SCHEMA_PROMPT_BUDGET, sensitivity=0.8, only_matched=False):
+        '''
+        Schema text within about `budget` tokens, one line per table.
+        With only_matched, tables the keywords do not match are left out.
+        '''
+        keywords = sorted(set(keyword.lower() for keyword in keywords or ()))
+        key = (tuple(keywords), budget, sensitivity, only_matched)
+        with self.lock:
+            text = self.renders.get(key)
+        if text is not None:
+            return text
+
+        scores = self.relevance(index, keywords, sensitivity) if index is not None and keywords else {}
+        ranked = [
+            (position, table) for position, table in enumerate(self.tables)
+            if not only_matched or table[0] in scores
+        ]
+        ranked.sort(key=lambda item: (-scores.get(item[1][0], (0,))[0], item[0]))
+
+        lines = []
+        omitted = []
+        used = 0
+        for _, (table_name, fragments, details) in ranked:
+            relevant = scores.get(table_name, (0, {}))[1]
+            line = self.render_table(table_name, fragments, details, relevant,
+                                     SCHEMA_PROMPT_OTHER_COLUMNS if relevant else None)
+            if used + estimate_tokens(line) > budget:
+                line = self.render_table(table_name, fragments, details, relevant, other_columns=0)
+            if used + estimate_tokens(line) > budget:
+                omitted.append(table_name)
+                continue
+            lines.append(line)
+            used += estimate_tokens(line) + 1
+
+        if omitted:
+            others = 'Other tables: ' + ', '.join(omitted)
+            if used + estimate_tokens(others) > budget:
+                others = f'Other tables: {len(omitted)} not shown'
+            lines.append(others)
+
+        text = "\n".join(lines)
+        with self.lock:
+            if len(self.renders) >= MAX_MEMOIZED_RENDERS:
+                self.renders = {}
+            self.renders[key] = text
+        return text
@@ -0,0 +1,166 @@
+import math
+import threading
+
+from functions.database import extract_keywords
+
+STOPWORDS = {
+    "a", "an", "the", "of", "for", "in", "on", "at", "to", "from", "with", "and", "or",
+    "is", "are", "was", "were", "be", "been", "do", "does", "did", "what", "which", "who",
+    "how", "me", "my", "show", "give", "list", "find", "get", "please", "can", "you", "i",
+    "we", "our", "there", "this", "that", "these", "those", "it", "its", "each",
+}
+# extract_keywords strips a trailing 's', so match the stripped forms too
+STOPWORDS |= {word.rstrip('s') for word in STOPWORDS}
+
+NUMBER_WORDS = {
+    "zero": "0", "one": "1", "two": "2", "three": "3", "four": "4", "five": "5",
+    "six": "6", "seven": "7", "eight": "8", "nine": "9", "ten": "10", "eleven": "11",
+    "twelve": "12", "fifteen": "15", "twenty": "20", "thirty": "30", "fifty": "50",
+    "hundred": "100", "thousand": "1000",
+}
+
+# Sort direction and extremes, each spelling mapped to one token. Like numbers
+# they change the answer ("sorted by name ascending" != "... descending").
+DIRECTION_WORDS = {
+    "asc": "asc", "ascending": "asc", "increasing": "asc",
+    "desc": "desc", "descending": "desc", "decreasing": "desc",
+    "highest": "high", "higher": "high", "largest": "high", "biggest": "high", "greatest": "high",
+    "max": "high", "maximum": "high", "most": "high", "top": "high", "best": "high",
+    "lowest": "low", "lower": "low", "smallest": "low", "least": "low", "fewest": "low",
+    "min": "low", "minimum": "low", "bottom": "low", "worst": "low",
+    "first": "first", "earliest": "first", "oldest": "first",
+    "last": "last", "latest": "last", "newest": "last", "recent": "last",
+    "not": "not", "no": "not", "without": "not", "except": "not", "excluding": "not", "never": "not",
+}
+DIRECTION_TOKENS = set(DIRECTION_WORDS.values())
+
+# Grouping words: the word after them names the grouping, so
+# "customers per order" != "orders per customer"
+RELATION_WORDS = {"per", "by"}
+
+
+def prompt_tokens(prompt):
+    '''
+    Normalized token set of a prompt: extract_keywords (lowercase, split on
+    non-alphanumerics, trailing 's' stripped), number words as digits,
+    direction words as their DIRECTION_WORDS token and stopwords removed.
+    Besides these words the set holds the bigrams of adjacent ones
+    ("customer per", "per order"), so word order counts too.
+    '''
+    words = []
+    for word in extract_keywords(prompt):
+        word = NUMBER_WORDS.get(word, word)
+        word = DIRECTION_WORDS.get(word, word)
+        if word and word not in STOPWORDS:
+            words.append(word)
+    return frozenset(words) | frozenset(f"{a} {b}" for a, b in zip(words, words[1:]))
+
+
+def jaccard(a, b):
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class PromptIndex:
+    '''
+    Inverted token index over cached prompts for near-duplicate lookup.
+
+    A match needs Jaccard similarity >= threshold on the token sets and the
+    same key tokens: numbers (usually parameters: "top 5" != "top 10"),
+    direction words (asc/desc, highest/lowest, first/last, negations) and
+    groupings ("per"/"by" and the bigram of the word after them).
+    Postings are partitioned by (key tokens, set size), so a lookup only
+    reads partitions that can pass both filters. Within them it uses prefix
+    filtering: a prompt x can only reach the threshold with a prompt sharing
+    one of its n - ceil(t*n) + 1 rarest tokens, so only those posting lists
+    are read. This is exact, not an approximation.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.docs = {}  # doc id -> [tokens, query, prompts with these tokens]
+        self.next_id = 0
+        self.by_tokens = {}  # tokens -> doc id
+        self.partitions = {}  # (key tokens, size) -> {token: set of doc ids}
+
+    def __len__(self):
+        return len(self.docs)
+
+    @staticmethod
+    def key_tokens(tokens):
+        return frozenset(
+            token for token in tokens
+            if token.isdigit() or token in DIRECTION_TOKENS or token.split(' ')[0] in RELATION_WORDS
+        )
+
+    def add(self, prompt, query):
+        tokens = prompt_tokens(prompt)
+        with self.lock:
+            doc_id = self.by_tokens.get(tokens)
+            if doc_id is not None:
+                doc = self.docs[doc_id]
+                doc[1] = query
+                doc[2].add(prompt)
+                return
+            doc_id = self.next_id
+            self.next_id += 1
+            self.docs[doc_id] = [tokens, query, {prompt}]
+            self.by_tokens[tokens] = doc_id
+            postings = self.partitions.setdefault((self.key_tokens(tokens), len(tokens)), {})
+            for token in tokens:
+                postings.setdefault(token, set()).add(doc_id)
+
+    def remove(self, prompt):
+        '''Forget a prompt added before; its postings go once no other prompt has the same tokens.'''
+        tokens = prompt_tokens(prompt)
+        with self.lock:
+            doc_id = self.by_tokens.get(tokens)
+            if doc_id is None:
+                return
+            prompts = self.docs[doc_id][2]
+            prompts.discard(prompt)
+            if prompts:
+                return
+            del self.docs[doc_id]
+            del self.by_tokens[tokens]
+            partition = (self.key_tokens(tokens), len(tokens))
+            postings = self.partitions[partition]
+            for token in tokens:
+                postings[token].discard(doc_id)
+                if not postings[token]:
+                    del postings[token]
+            if not postings:
+                del self.partitions[partition]
+
+    def find(self, prompt, threshold):
+        '''Return (query, similarity) of the closest cached prompt, or (None, 0.0).'''
+        tokens = prompt_tokens(prompt)
+        if not tokens:
+            return None, 0.0
+        keys = self.key_tokens(tokens)
+        size = len(tokens)
+        prefix_length = size - math.ceil(threshold * size - 1e-9) + 1
+
+        with self.lock:
+            doc_id = self.by_tokens.get(tokens)
+            if doc_id is not None:
+                return self.docs[doc_id][1], 1.0
+
+            best_query, best_score = None, 0.0
+            # Size filter: |y| must lie in [t*|x|, |x|/t]
+            for other_size in range(math.ceil(threshold * size - 1e-9), int(size / threshold + 1e-9) + 1):
+                postings = self.partitions.get((keys, other_size))
+                if not postings:
+                    continue
+                prefix = sorted(tokens, key=lambda token: len(postings.get(token, ())))[:prefix_length]
+                candidates = set()
+                for token in prefix:
+                    candidates |= postings.get(token, set())
+
+                for doc_id in candidates:
+                    doc_tokens, query, _ = self.docs[doc_id]
+                    score = jaccard(tokens, doc_tokens)
+                    if score >= threshold and score > best_score:
+                        best_query, best_score = query, score
+            return best_query, best_score
@@ -0,0 +1,86 @@
+import os
+import threading
+
+from functions.metrics import inc
+
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv("SINGLE_FLIGHT_TIMEOUT", "120"))  # seconds a duplicate waits for the first call
+
+
+class SingleFlightTimeout(Exception):
+    def __init__(self, group, timeout):
+        super().__init__(f"Timed out after {timeout:g}s waiting for an identical {group} call in progress")
+        self.group = group
+        self.timeout = timeout
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    '''
+    Coalesces identical in-flight calls: the first caller for a key runs the
+    function, callers arriving while it runs wait for it (at most `timeout`
+    seconds) and get the same result, or the same exception raised again.
+    Nothing is kept once the call finishes; caching results is up to the
+    caller. `group` names the call site in stats and metrics.
+    '''
+
+    def __init__(self, group, timeout=SINGLE_FLIGHT_TIMEOUT):
+        self.group = group
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    def do(self, key, fn, timeout=None):
+        '''Result of fn() for `key`, shared with concurrent callers. Returns (result, shared).'''
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+                self.leaders += 1
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+
+        if not leader:
+            inc('aisql_singleflight_total', group=self.group, outcome='coalesced')
+            timeout = self.timeout if timeout is None else timeout
+            if not call.done.wait(timeout):
+                with self.lock:
+                    self.timeouts += 1
+                inc('aisql_singleflight_total', group=self.group, outcome='timeout')
+                raise SingleFlightTimeout(self.group, timeout)
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        inc('aisql_singleflight_total', group=self.group, outcome='leader')
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result, False
+
+    def stats(self):
+        with self.lock:
+            return {
+                'in_flight': len(self.calls),
+                'waiting': sum(call.waiters for call in self.calls.values()),
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+                'timeouts': self.timeouts,
+            }
@@ -1,99 +1,465 @@
 import sqlite3
-import difflib
-import yaml
-import pandas as pd
+import hashlib
+import io
 import os
 import re
+import time
+from contextlib import contextmanager
+from itertools import islice
+from functions.schema_cache import schema_cache
+from functions.pool import get_pool
+from functions.fuzzy_index import IdentifierIndex
+from functions.schema_prompt import SchemaPrompt, SCHEMA_PROMPT_BUDGET
+from functions.ingest import ingest_csv, quote
+from functions.column_stats import COLUMN_STATS, INTERNAL_TABLE_PREFIX, read_stats, stats_refresher, drop_table_stats
+from functions.result_cache import result_cache
+from functions.relationships import read_relationships, has_relationships, drop_table_relationships
+
+STREAM_BATCH_SIZE = int(os.getenv("SQL_STREAM_BATCH_SIZE", "1000"))
+# Execution limits per query; 0 disables a limit
+SQL_TIMEOUT = float(os.getenv("SQL_TIMEOUT", "30"))  # seconds
+SQL_MAX_ROWS = int(os.getenv("SQL_MAX_ROWS", "100000"))
+SQL_MAX_BYTES = int(os.getenv("SQL_MAX_BYTES", str(64 * 1024 * 1024)))
+SQL_PROGRESS_STEPS = 1000  # VM instructions between deadline checks
+
+READ_STATEMENT = re.compile(r'^\s*(?:--[^\n]*\n\s*|/\*.*?\*/\s*)*\(*\s*(SELECT|WITH|VALUES|EXPLAIN)\b', re.IGNORECASE | re.DOTALL)
+
+
+def is_read_query(query):
+    '''Whether a statement starts like a read (SELECT, WITH, VALUES, EXPLAIN).'''
+    return READ_STATEMENT.match(query or '') is not None
+
+
+class QueryLimitExceeded(Exception):
+    '''
+    A query went over one of the execution limits. `limit` is 'timeout',
+    'max_rows' or 'max_bytes' and `value` the configured limit.
+    '''
+
+    def __init__(self, limit, value, message):
+        super().__init__(message)
+        self.limit = limit
+        self.value = value
+        self.message = message
+
+    def to_dict(self):
+        return {'error': 'query_limit_exceeded', 'limit': self.limit, 'value': self.value, 'message': self.message}
+
+
+class SqlValidationError(Exception):
+    '''Generated SQL that failed validation; the message is meant to be fed back to the LLM.'''
+
+    def __init__(self, message, query=None):
+        super().__init__(message)
+        self.query = query
+
+
+# Authorizer actions a SELECT statement can need
+SELECT_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+# Authorizer actions that change a table's rows or columns; arg1 is the table (arg2 for ALTER TABLE)
+WRITE_ACTIONS = {sqlite3.SQLITE_INSERT, sqlite3.SQLITE_UPDATE, sqlite3.SQLITE_DELETE, sqlite3.SQLITE_DROP_TABLE,
+                 sqlite3.SQLITE_ALTER_TABLE}
+# SQL functions that reach outside the database (extensions, files, editors) or change SQLite itself
+DENIED_FUNCTIONS = {'load_extension', 'fts3_tokenizer', 'readfile', 'writefile', 'edit', 'fsdir', 'zipfile'}
+ACTION_NAMES = {
+    getattr(sqlite3, 'SQLITE_' + name): name.replace('_', ' ')
+    for name in ('INSERT', 'UPDATE', 'DELETE', 'CREATE_TABLE', 'CREATE_INDEX', 'CREATE_VIEW', 'CREATE_TRIGGER',
+                 'DROP_TABLE', 'DROP_INDEX', 'DROP_VIEW', 'DROP_TRIGGER', 'ALTER_TABLE', 'PRAGMA', 'TRANSACTION',
+                 'ATTACH', 'DETACH', 'REINDEX', 'ANALYZE', 'SAVEPOINT', 'CREATE_VTABLE', 'DROP_VTABLE')
+    if hasattr(sqlite3, 'SQLITE_' + name)
+}
+
+
+def row_size(row):
+    '''Rough in-memory size of a result row, for the byte limit.'''
+    return sum(len(value) if isinstance(value, (str, bytes)) else 8 for value in row)
+
 
 class SqlConn:
     base_path = './databases/'  # Set your desired base path
-    def __init__(self, db_name="user001.starter.db" ):
+    def __init__(self, db_name="user001.starter.db", readonly=False,
+                 timeout=SQL_TIMEOUT, max_rows=SQL_MAX_ROWS, max_bytes=SQL_MAX_BYTES, use_cache=True):
         if not os.path.exists(self.base_path):
             os.makedirs(self.base_path)
         self.db_path = self.base_path + db_name
 
         if not os.path.exists(self.db_path):
             raise FileNotFoundError(f"Database file not found: {self.db_path}")
-        self.conn = sqlite3.connect(self.db_path)
-        self.conn.row_factory = sqlite3.Row  # So we can get column names easily
+        self.readonly = readonly
+        self.timeout = timeout
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.use_cache = use_cache
+        self.pool = get_pool(self.db_path, readonly=readonly)
+        self.conn = self.pool.checkout()
+
+    def close(self):
+        '''Return the connection to the pool. Safe to call more than once.'''
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            self.pool.checkin(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __del__(self):
+        if getattr(self, 'conn', None) is not None:
+            self.close()
+
+    @contextmanager
+    def governed(self):
+        '''
+        Interrupt the statements run inside the block once `timeout` seconds
+        have passed, raising QueryLimitExceeded instead of the interrupt error.
+        '''
+        if not self.timeout:
+            yield
+            return
+        deadline = time.monotonic() + self.timeout
+        self.conn.set_progress_handler(lambda: time.monotonic() > deadline, SQL_PROGRESS_STEPS)
+        try:
+            yield
+        except sqlite3.OperationalError as e:
+            if 'interrupted' in str(e) and time.monotonic() > deadline:
+                raise QueryLimitExceeded('timeout', self.timeout,
+                                         f"Query took longer than {self.timeout:g}s and was interrupted") from e
+            raise
+        finally:
+            self.conn.set_progress_handler(None, 0)
+
+    @contextmanager
+    def tracking_writes(self):
+        '''
+        Yield the set of user tables that statements prepared inside the
+        block write to, filled in as they are prepared (see forget_tables).
+        '''
+        tables = set()
+
+        def authorizer(action, arg1, arg2, db_name, source):
+            if action in WRITE_ACTIONS:
+                table = arg2 if action == sqlite3.SQLITE_ALTER_TABLE else arg1
+                if table and not table.startswith(('sqlite_', INTERNAL_TABLE_PREFIX)):
+                    tables.add(table)
+            return sqlite3.SQLITE_OK
+
+        self.conn.set_authorizer(authorizer)
+        try:
+            yield tables
+        finally:
+            self.conn.set_authorizer(None)
+
+    def forget_tables(self, tables):
+        '''
+        Drop the catalog rows (column statistics, inferred relationships) of
+        tables changed by a statement, in the current transaction. The
+        statistics are rebuilt in the background the next time the
+        structure is read; returns whether relationships need inferring again.
+        '''
+        for table in tables:
+            drop_table_stats(self.conn, table)
+            drop_table_relationships(self.conn, table)
+        return bool(tables) and has_relationships(self.conn)
+
+    def collect(self, rows, collected=None, size=0):
+        '''
+        Append rows to `collected` while enforcing max_rows and max_bytes.
+        Returns (collected, size).
+        '''
+        collected = [] if collected is None else collected
+        for row in rows:
+            row = list(row)
+            size += row_size(row)
+            collected.append(row)
+            if self.max_rows and len(collected) > self.max_rows:
+                raise QueryLimitExceeded('max_rows', self.max_rows,
+                                         f"Query returned more than {self.max_rows} rows; add a LIMIT or aggregate")
+            if self.max_bytes and size > self.max_bytes:
+                raise QueryLimitExceeded('max_bytes', self.max_bytes,
+                                         f"Query result is larger than {self.max_bytes} bytes; select fewer columns or rows")
+        return collected, size
 
     def execute(self, query, params=None):
+        '''
+        Run a query and return (headers, rows), within the timeout, row and
+        byte limits of this connection (QueryLimitExceeded otherwise).
+
+        On read-only connections, queries are answered from the result cache
+        (functions.result_cache) when an identical one ran on the same data before. With use_cache=False
+        the query always runs, and its result refreshes the cache.
+        '''
+        # Only read-only connections: their statements cannot have changed the data
+        cacheable = self.readonly and is_read_query(query)
+        if cacheable and self.use_cache:
+            cached = result_cache.get(self.db_path, query, params)
+            if cached is not None:
+                return cached
+
         cur = self.conn.cursor()
-        if params:
-            cur.execute(query, params)
-        else:
-            cur.execute(query)
+        try:
+            with self.governed():
+                if params:
+                    cur.execute(query, params)
+                else:
+                    cur.execute(query)
+
+                headers = [desc[0] for desc in cur.description] if cur.description else []
+
+                # Fetch in batches so the limits stop a huge result early
+                result_rows, size = [], 0
+                while True:
+                    batch = cur.fetchmany(STREAM_BATCH_SIZE)
+                    if not batch:
+                        break
+                    result_rows, size = self.collect(batch, result_rows, size)
+        finally:
+            cur.close()
+        if cacheable:
+            result_cache.set(self.db_path, query, params, headers, result_rows, size)
+        return headers, result_rows
+
+    def stream(self, query, params=None, batch_size=STREAM_BATCH_SIZE):
+        '''
+        Like execute(), but returns (headers, rows) where rows is a generator
+        that pulls `batch_size` rows at a time with fetchmany().
+
+        Rows are not held in memory, so only the timeout applies, to the
+        initial execute and to each batch separately: a slow reader does not
+        count against it.
+        '''
+        cur = self.conn.cursor()
+        try:
+            with self.governed():
+                if params:
+                    cur.execute(query, params)
+                else:
+                    cur.execute(query)
+        except Exception:
+            cur.close()
+            raise
 
         headers = [desc[0] for desc in cur.description] if cur.description else []
-        rows = cur.fetchall()
 
-        # Convert sqlite3.Row to list
-        result_rows = [list(row) for row in rows]
+        def rows():
+            try:
+                while True:
+                    with self.governed():
+                        batch = cur.fetchmany(batch_size)
+                    if not batch:
+                        break
+                    for row in batch:
+                        yield list(row)
+            finally:
+                cur.close()
+
+        return headers, rows()
+
+    def execute_page(self, query, params=None, limit=None, cursor=0):
+        '''
+        Run a query and return one page of it: (headers, rows, next_cursor).
+        The cursor is the row offset of the page; next_cursor is None on the last page.
+        The timeout covers the whole page and the row/byte limits the rows returned.
+        '''
+        cursor = int(cursor or 0)
+        limit = None if limit is None else int(limit)
+        cur = self.conn.cursor()
+        try:
+            with self.governed():
+                if params:
+                    cur.execute(query, params)
+                else:
+                    cur.execute(query)
+                headers = [desc[0] for desc in cur.description] if cur.description else []
+
+                rows = iter(lambda: cur.fetchmany(STREAM_BATCH_SIZE), [])
+                rows = (row for batch in rows for row in batch)
+                stop = None if limit is None else cursor + limit
+                page, _ = self.collect(islice(rows, cursor, stop))
+                # One more row means there is a next page
+                has_next = limit is not None and next(rows, None) is not None
+        finally:
+            cur.close()
+        return headers, page, (stop if has_next else None)
+
+    def validate(self, query):
+        '''
+        Dry run of a generated query: prepares `EXPLAIN <query>` without
+        running it, allowing only a single SELECT statement that calls none
+        of the DENIED_FUNCTIONS. Raises
+        SqlValidationError with SQLite's error (unknown column, ambiguous
+        name, syntax error, ...) plus a hint of the names that do exist.
+        '''
+        if not query or not query.strip():
+            raise SqlValidationError("The query is empty", query)
+
+        denied = []
+
+        def authorizer(action, arg1, arg2, db_name, source):
+            # For SQLITE_FUNCTION, arg2 is the function name
+            if action == sqlite3.SQLITE_FUNCTION and (arg2 or '').lower() in DENIED_FUNCTIONS:
+                denied.append(f'function {arg2}()')
+                return sqlite3.SQLITE_DENY
+            if action in SELECT_ACTIONS:
+                return sqlite3.SQLITE_OK
+            denied.append(ACTION_NAMES.get(action, str(action)) + (f' {arg1}' if arg1 else ''))
+            return sqlite3.SQLITE_DENY
 
+        cur = self.conn.cursor()
+        self.conn.set_authorizer(authorizer)
+        try:
+            with self.governed():
+                cur.execute("EXPLAIN " + query.strip().rstrip(';'))
+            return
+        except (sqlite3.Warning, sqlite3.Error) as e:
+            error = e
+        finally:
+            self.conn.set_authorizer(None)
+            cur.close()
+
+        if 'one statement at a time' in str(error):
+            raise SqlValidationError("Only a single SELECT statement is allowed, without other statements after it", query) from error
+        if denied:
+            raise SqlValidationError(f"Only SELECT statements are allowed (not allowed: {denied[0]})", query) from error
+        raise SqlValidationError(str(error) + self.validation_hint(str(error)), query) from error
+
+    def validation_hint(self, error):
+        '''Names that do exist, for "no such table/column" errors.'''
+        tables = self.get_database_structure()['tables']
+        if error.startswith('no such table'):
+            return '. Available tables: ' + ', '.join(tables)
+        if error.startswith('no such column'):
+            name = error.split(':', 1)[-1].strip().split('.')[-1].lower()
+            owners = [table for table, columns in tables.items() if any(col['Field'].lower() == name for col in columns)]
+            if owners:
+                return f'. Column {name} exists in: ' + ', '.join(owners)
+            return '. Available columns: ' + '; '.join(
+                f"{table}({', '.join(col['Field'] for col in columns)})" for table, columns in tables.items())
+        return ''
+
+    def get_schema_version(self):
+        '''
+        Version tag used by the schema cache: file mtime plus PRAGMA schema_version.
+        '''
+        cur = self.conn.cursor()
+        cur.execute("PRAGMA schema_version")
+        schema_version = cur.fetchone()[0]
         cur.close()
-        return headers, result_rows
-
+        return (os.stat(self.db_path).st_mtime_ns, schema_version)
 
     def get_database_structure(self):
+        version = self.get_schema_version()
+        db_structure = schema_cache.lookup(self.db_path, version)
+        if db_structure is not None:
+            return db_structure
+
+        db_structure = self.read_database_structure()
+        schema_cache.store(self.db_path, version, db_structure)
+        return db_structure
+
+    def get_schema_fingerprint(self):
+        '''
+        Hash of the table, column and type names. Unlike the schema version it
+        only changes when the shape of the schema does.
+        '''
+        db_structure = self.get_database_structure()
+
+        def build():
+            shape = []
+            for table_name in sorted(db_structure['tables']):
+                columns = db_structure['tables'][table_name]
+                shape.append(table_name + '(' + ','.join(col['Field'] + ' ' + col['Type'] for col in columns) + ')')
+            return hashlib.sha1(';'.join(shape).encode('utf-8')).hexdigest()
+
+        return schema_cache.memoize(self.db_path, self.get_schema_version(), 'fingerprint', build)
+
+    def get_identifier_index(self):
+        '''Fuzzy-match index of table/column names, built once per schema version.'''
+        db_structure = self.get_database_structure()
+        return schema_cache.memoize(self.db_path, self.get_schema_version(), 'identifier_index',
+                                    lambda: IdentifierIndex(db_structure))
+
+    def get_schema_prompt(self):
+        '''Compact schema renderer for prompts (functions.schema_prompt), built once per schema version.'''
+        db_structure = self.get_database_structure()
+        return schema_cache.memoize(self.db_path, self.get_schema_version(), 'schema_prompt',
+                                    lambda: SchemaPrompt(db_structure))
+
+    def read_database_structure(self):
+        '''
+        Tables and columns of the database, without the app's own side tables.
+        Common values and statistics come from the column statistics catalog
+        (functions.column_stats); tables it does not cover yet, or covers
+        with other columns, are sampled with SELECT DISTINCT and queued for
+        a background catalog build.
+        Inferred foreign keys (functions.relationships) get Key "MUL" and
+        "References": "table.column".
+        '''
         cur = self.conn.cursor()
 
         # Get list of tables
-        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")
+        cur.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' AND name NOT LIKE ? ESCAPE '\\'",
+            (INTERNAL_TABLE_PREFIX.replace('_', '\\_') + '%',))
         tables = cur.fetchall()
+        catalog = read_stats(self.conn)
+        relationships = read_relationships(self.conn)
 
         db_structure = {"database": self.db_path, "tables": {}}
 
+        missing_stats = False
         for table_row in tables:
             table_name = table_row[0]
-            cur.execute(f"PRAGMA table_info('{table_name}')")
+            cur.execute(f"PRAGMA table_info({quote(table_name)})")
             columns = cur.fetchall()
+            table_stats = catalog.get(table_name, {})
+            if set(table_stats) != {column["name"] for column in columns}:
+                # Changed since the catalog was built: sample it instead, and rebuild
+                table_stats = {}
 
             db_structure["tables"][table_name] = []
             for column in columns:
-                common_values = self.execute(f"SELECT DISTINCT {column[1]} FROM {table_name} LIMIT 5")
-                common_values = [str(value[0]) for value in common_values[1]] if common_values[1] else []
+                stats = table_stats.get(column["name"])
+                if stats is not None:
+                    common_values = [str(value) for value, count in stats['top_values']]
+                else:
+                    missing_stats = True
+                    common_values = self.execute(f"SELECT DISTINCT {quote(column[1])} FROM {quote(table_name)} LIMIT 5")
+                    common_values = [str(value[0]) for value in common_values[1]] if common_values[1] else []
                 column_info = {
                     "Field": column["name"],
                     "Type": column["type"],
                     "Null": "YES" if column["notnull"] == 0 else "NO",
-                    "Key": "PRI" if column["pk"] else "",
+                    "Key": "PRI" if column["pk"] else "MUL" if (table_name, column["name"]) in relationships else "",
                     "Default": column["dflt_value"],
                     "Extra": "",
                     "Common Values": common_values,
+                    "Statistics": stats,
                 }
+                reference = relationships.get((table_name, column["name"]))
+                if reference is not None:
+                    column_info["References"] = f"{reference[0]}.{reference[1]}"
                 db_structure["tables"][table_name].append(column_info)
 
         cur.close()
+        if missing_stats and COLUMN_STATS:
+            stats_refresher.schedule(self.db_path)
         return db_structure
 
-    def find_table_and_column_by_keywords(self, keyword, sensitivity=0.8):
+    def find_table_and_column_by_keywords(self, keyword, sensitivity=0.8, budget=SCHEMA_PROMPT_BUDGET):
+        '''
+        Compact description of the tables whose names or columns match the
+        keywords, most relevant first, within `budget` tokens.
+        '''
         if isinstance(keyword, str):
             keywords = [keyword]
         else:
             keywords = keyword
 
         sensitivity = max(0.0, min(1.0, float(sensitivity)))
-        db_struct = self.get_database_structure()
-        tables = db_struct['tables']
-
-        matched_tables = {}
-
-        for table_name, columns in tables.items():
-            for column in columns:
-                column_name = column['Field']
-                for kw in keywords:
-                    ratio = difflib.SequenceMatcher(None, kw.lower(), column_name.lower()).ratio()
-                    if ratio >= sensitivity:
-                        matched_tables[table_name] = [
-                            col['Field'] + " (" + col['Type'] + ")" + (" - (" + ",".join(col['Common Values']) if col['Common Values'] else "") + ")" for col in columns
-                        ]
-                        break
-                if table_name in matched_tables:
-                    break
-
-        return yaml.dump(matched_tables, sort_keys=False)
-
-
+        return self.get_schema_prompt().render(self.get_identifier_index(), keywords, budget=budget,
+                                               sensitivity=sensitivity, only_matched=True)
 
     def get_columns_for_table(self, table_name):
         db_struct = self.get_database_structure()
@@ -101,37 +467,21 @@ class SqlConn:
         return tables.get(table_name, [])
 
     @classmethod
-    def create_new_database(cls, csv_title, csv_string, db_name='user001.starter.db'):
-
-        csv_title = csv_title.split('.')[0].lower().replace(' ', '_').replace('-', '_').replace('(', '').replace(')', '').strip().strip('_')
+    def create_new_database(cls, csv_title, csv_string, db_name='user001.starter.db', **options):
+        '''
+        Replace table `csv_title` of `db_name` with the given CSV text.
+        Runs the same import as ingest_csv_stream (options: strict, without_rowid).
+        '''
+        return cls.ingest_csv_stream(io.StringIO(csv_string, newline=''), csv_title, db_name, **options)
 
-        # Ensure the base directory exists
+    @classmethod
+    def ingest_csv_stream(cls, fileobj, csv_title, db_name='user001.starter.db', **options):
+        '''
+        Streaming counterpart of create_new_database for large uploads: reads
+        the CSV text stream in bounded chunks (see functions.ingest).
+        '''
         if not os.path.exists(cls.base_path):
             os.makedirs(cls.base_path)
-
-        # Write the CSV to a temporary file
-        csv_path = os.path.join(cls.base_path, csv_title + '.csv')
-        with open(csv_path, 'w') as f:
-            f.write(csv_string)
-
-        # Read the CSV
-        df = pd.read_csv(csv_path)
-
-        # Make all column names lowercase and replace spaces with underscores
-        df.columns = [col.lower().replace(' ', '_') for col in df.columns]
-
-        # Remove duplicate columns and special characters
-        df = df.loc[:, ~df.columns.duplicated()].rename(columns=lambda x: re.sub(r'[^\w]+', '', x))
-
-        # Create database and write table
         db_path = os.path.join(cls.base_path, db_name)
-        conn = sqlite3.connect(db_path)
-        df.to_sql(csv_title, conn, index=False, if_exists='replace')
-        conn.close()
-
-        # Remove the temporary CSV file
-        os.remove(csv_path)
-
-        # Return SqlConn object
+        ingest_csv(fileobj, csv_title, db_path, **options)
         return cls(db_name=db_name)
-
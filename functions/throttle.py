@@ -0,0 +1,31 @@
+import threading
+import time
+
+
+class RateLimiter:
+    '''
+    Spaces calls evenly at `rate` calls per second across threads.
+    A rate of 0 (or less) disables limiting.
+    '''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def acquire(self, deadline=None):
+        '''
+        Wait for the next free slot. Returns False without waiting if that
+        slot lies past `deadline` (a time.monotonic() value).
+        '''
+        if not self.interval:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            if deadline is not None and slot > deadline:
+                return False
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+        return True
@@ -0,0 +1,114 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+
+CONTEXT_TRACE = os.getenv("CONTEXT_TRACE") == "true" or os.getenv("CONTEXT_TRACE") == "1" or os.getenv("CONTEXT_TRACE") == "True"
+TRACE_PATH = os.getenv("TRACE_PATH", "context/trace.jsonl")
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", "1"))  # seconds
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "200"))
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_RETENTION = int(os.getenv("TRACE_RETENTION", "5"))  # rotated files kept
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "10000"))
+
+
+class TraceSink:
+    '''
+    Append-only JSONL trace of conversation messages.
+
+    record() only puts the message on a bounded queue; a background thread
+    writes batches of records every `flush_interval` seconds. The file is
+    rotated at `max_bytes` (trace.jsonl.1, .2, ...) keeping `retention`
+    old files. When the queue is full, records are dropped and counted
+    rather than slowing the request down.
+    '''
+
+    def __init__(self, path=TRACE_PATH, flush_interval=TRACE_FLUSH_INTERVAL, batch_size=TRACE_BATCH_SIZE,
+                 max_bytes=TRACE_MAX_BYTES, retention=TRACE_RETENTION, queue_size=TRACE_QUEUE_SIZE):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.retention = retention
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.written = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="trace-sink", daemon=True)
+        self.thread.start()
+
+    def record(self, conversation, role, content):
+        try:
+            self.queue.put_nowait({
+                'ts': time.time(),
+                'conversation': conversation,
+                'role': role,
+                'content': content,
+            })
+        except queue.Full:
+            self.dropped += 1
+
+    def drain(self):
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def rotate(self):
+        if self.retention <= 0:
+            os.remove(self.path)
+            return
+        for i in range(self.retention - 1, 0, -1):
+            older = f"{self.path}.{i}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def write(self, batch):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.path, 'a') as f:
+            for record in batch:
+                f.write(json.dumps(record, default=str) + "\n")
+        self.written += len(batch)
+        if os.path.getsize(self.path) > self.max_bytes:
+            self.rotate()
+
+    def flush(self):
+        while True:
+            batch = self.drain()
+            if not batch:
+                return
+            try:
+                self.write(batch)
+            except OSError as e:
+                print('Could not write trace:', e)
+                return
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join(timeout=5)
+
+
+trace_sink = TraceSink() if CONTEXT_TRACE else None
+
+
+def trace(conversation, role, content):
+    '''Record one conversation message if tracing is enabled; never touches disk itself.'''
+    if trace_sink is not None:
+        trace_sink.record(conversation, role, content)
+
+
+if trace_sink is not None:
+    atexit.register(trace_sink.close)
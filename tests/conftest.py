@@ -0,0 +1,35 @@
+import sqlite3
+
+import pytest
+
+from functions.sql import SqlConn
+
+
+@pytest.fixture
+def databases(tmp_path, monkeypatch):
+    '''Point SqlConn at an empty databases directory of its own.'''
+    base_path = str(tmp_path) + '/'
+    monkeypatch.setattr(SqlConn, 'base_path', base_path)
+    return base_path
+
+
+@pytest.fixture
+def make_db(databases):
+    '''make_db(name, *statements): create a database in `databases` by running the statements.'''
+
+    def make(name, *statements):
+        conn = sqlite3.connect(databases + name)
+        for statement in statements:
+            conn.execute(statement)
+        conn.commit()
+        conn.close()
+        return databases + name
+
+    return make
+
+
+@pytest.fixture
+def client(databases):
+    '''Flask test client of the app, reading databases from `databases`.'''
+    from app import app
+    return app.test_client()
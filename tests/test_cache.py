@@ -0,0 +1,95 @@
+import sqlite3
+
+import pytest
+
+import app as app_module
+from functions.cache import LRUCache
+from functions.schema_cache import SchemaCache
+
+
+def test_lru_bounded_by_bytes_evicts_least_recently_used():
+    evicted = []
+    cache = LRUCache(max_bytes=30, on_evict=lambda key, value: evicted.append(key))
+    for key in 'abc':
+        cache.set(key, key, size=10)
+    assert cache.get('a') == 'a'  # a is now the most recently used
+    cache.set('d', 'd', size=10)
+    assert evicted == ['b']
+    assert cache.get('b') is None
+    assert [cache.get(key) for key in 'acd'] == ['a', 'c', 'd']
+    assert cache.stats()['bytes'] == 30
+
+
+def test_lru_rejects_oversized_entries_and_expires():
+    cache = LRUCache(max_bytes=10, ttl=0)
+    assert cache.set('big', 'x', size=11) is False
+    assert cache.set('small', 'x', size=1)
+    assert cache.get('small') is None
+    assert cache.stats()['expirations'] == 1
+
+
+def test_lru_invalidate_by_match():
+    cache = LRUCache(max_bytes=100)
+    for key in [('one.db', 1), ('one.db', 2), ('two.db', 1)]:
+        cache.set(key, 'v', size=1)
+    assert cache.invalidate(lambda key: key[0] == 'one.db') == 2
+    assert len(cache) == 1 and cache.get(('two.db', 1)) == 'v'
+
+
+def test_schema_cache_is_versioned():
+    cache = SchemaCache()
+    cache.store('x.db', 1, {'tables': {'t': []}})
+    assert cache.lookup('x.db', 1) == {'tables': {'t': []}}
+    assert cache.lookup('x.db', 2) is None
+    assert cache.memoize('x.db', 1, 'prompt', lambda: 'built') == 'built'
+    assert cache.memoize('x.db', 1, 'prompt', lambda: 'rebuilt') == 'built'
+    cache.invalidate('x.db')
+    assert cache.lookup('x.db', 1) is None
+
+
+@pytest.fixture
+def pipeline(make_db, monkeypatch):
+    '''Counts the NL -> SQL pipeline runs behind /request.'''
+    calls = []
+
+    def fake_get_sql_query(query, db_name, progress=None, use_cache=True):
+        calls.append((db_name, query))
+        return {'query': 'SELECT 1', 'result': [['1'], [[1]]]}
+
+    make_db('one.db', 'CREATE TABLE t (a INTEGER)')
+    make_db('two.db', 'CREATE TABLE t (a INTEGER)')
+    monkeypatch.setattr(app_module, 'get_sql_query', fake_get_sql_query)
+    app_module.query_cache.invalidate()
+    return calls
+
+
+def test_query_cache_keyed_by_db_schema_and_query(pipeline, databases):
+    app_module.answer_request('one.db', 'count rows')
+    app_module.answer_request('one.db', 'count rows')
+    assert pipeline == [('one.db', 'count rows')]
+
+    app_module.answer_request('two.db', 'count rows')
+    app_module.answer_request('one.db', 'count all rows')
+    assert len(pipeline) == 3
+
+    conn = sqlite3.connect(databases + 'one.db')
+    conn.execute('ALTER TABLE t ADD COLUMN b TEXT')
+    conn.close()
+    app_module.answer_request('one.db', 'count rows')
+    assert len(pipeline) == 4
+
+    app_module.answer_request('one.db', 'count rows', use_cache=False)
+    assert len(pipeline) == 5
+
+
+def test_create_database_invalidates_query_cache(pipeline, client):
+    app_module.answer_request('one.db', 'count rows')
+    app_module.answer_request('two.db', 'count rows')
+    response = client.post('/create-database', json={'csv_title': 't', 'csv_string': 'a\n1\n', 'db_name': 'one.db'})
+    assert response.get_json()['status'] == 'success'
+    # The rewrite also changes the schema version; the old entry is dropped right away
+    assert [key[0] for key in app_module.query_cache.entries] == ['two.db']
+
+    app_module.answer_request('one.db', 'count rows')
+    app_module.answer_request('two.db', 'count rows')
+    assert pipeline == [('one.db', 'count rows'), ('two.db', 'count rows'), ('one.db', 'count rows')]
@@ -0,0 +1,67 @@
+import sqlite3
+
+import pytest
+
+from functions.column_stats import read_stats
+from functions.database import get_sql_query
+from functions.relationships import infer_relationships, read_relationships
+from functions.sql import SqlConn
+
+CUSTOMERS = "id,name\n1,Ann\n2,Bob\n3,Cy\n"
+ORDERS = "id,customer_id,total\n1,1,9.5\n2,1,3.0\n3,3,12.25\n"
+
+
+@pytest.fixture
+def shop(databases):
+    SqlConn.create_new_database('customers', CUSTOMERS, 'shop.db').close()
+    SqlConn.create_new_database('orders', ORDERS, 'shop.db').close()
+    infer_relationships(databases + 'shop.db')
+    return databases + 'shop.db'
+
+
+def catalog(path):
+    conn = sqlite3.connect(path)
+    try:
+        return read_stats(conn), read_relationships(conn)
+    finally:
+        conn.close()
+
+
+def test_reingest_replaces_stats_and_relationships(shop):
+    stats, relationships = catalog(shop)
+    assert relationships == {('orders', 'customer_id'): ('customers', 'id')}
+    assert stats['orders']['total']['row_count'] == 3
+
+    SqlConn.create_new_database('orders', "id,total\n1,9.5\n2,3.0\n", 'shop.db').close()
+    stats, relationships = catalog(shop)
+    assert relationships == {}
+    assert set(stats['orders']) == {'id', 'total'}
+    assert stats['orders']['total']['row_count'] == 2
+
+    SqlConn.create_new_database('orders', ORDERS, 'shop.db').close()
+    assert catalog(shop)[1] == {('orders', 'customer_id'): ('customers', 'id')}
+
+
+def test_run_sql_writes_drop_stale_catalog_rows(shop):
+    get_sql_query("INSERT INTO orders VALUES (4, 2, 1.0)", 'shop.db')
+    stats, relationships = catalog(shop)
+    assert 'orders' not in stats and 'customers' in stats
+    assert relationships == {('orders', 'customer_id'): ('customers', 'id')}
+
+    get_sql_query("DROP TABLE customers", 'shop.db')
+    stats, relationships = catalog(shop)
+    assert 'customers' not in stats
+    assert relationships == {}
+
+
+def test_structure_samples_tables_changed_outside_the_app(shop):
+    conn = sqlite3.connect(shop)
+    conn.execute("ALTER TABLE customers ADD COLUMN city TEXT")
+    conn.execute("UPDATE customers SET city = 'Oslo'")
+    conn.commit()
+    conn.close()
+
+    with SqlConn('shop.db') as sql:
+        columns = {column['Field']: column for column in sql.get_database_structure()['tables']['customers']}
+    assert columns['city']['Common Values'] == ['Oslo']
+    assert columns['name']['Statistics'] is None
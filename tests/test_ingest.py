@@ -0,0 +1,77 @@
+import io
+import sqlite3
+
+import pytest
+
+from functions.column_stats import read_stats
+from functions.column_types import STRICT_SUPPORTED
+from functions.ingest import ingest_csv
+
+STRICT = [False, True] if STRICT_SUPPORTED else [False]
+
+
+def ingest(path, csv_text, chunk_size=2, **options):
+    return ingest_csv(io.StringIO(csv_text, newline=''), 'items', path, chunk_size=chunk_size, **options)
+
+
+def table(path):
+    '''({column: declared type}, [(value, typeof(value)) rows of the column `v`]).'''
+    conn = sqlite3.connect(path)
+    try:
+        types = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(items)")}
+        values = conn.execute("SELECT v, typeof(v) FROM items ORDER BY id").fetchall()
+        return types, values
+    finally:
+        conn.close()
+
+
+def csv_of(values):
+    return "id,v\n" + "".join(f"{i},{value}\n" for i, value in enumerate(values, 1))
+
+
+@pytest.mark.parametrize('strict', STRICT)
+def test_integer_widened_to_text_in_third_chunk(tmp_path, strict):
+    path = str(tmp_path / 'w.db')
+    result = ingest(path, csv_of(['1', '2', '3', '04', 'abc', '6']), strict=strict)
+    assert result['types'] == ['integer', 'text']
+    assert result['rows'] == 6
+    types, values = table(path)
+    assert types == {'id': 'INTEGER', 'v': 'TEXT'}
+    assert values == [('1', 'text'), ('2', 'text'), ('3', 'text'), ('04', 'text'), ('abc', 'text'), ('6', 'text')]
+
+
+@pytest.mark.parametrize('strict', STRICT)
+def test_integer_widened_to_real(tmp_path, strict):
+    path = str(tmp_path / 'w.db')
+    result = ingest(path, csv_of(['1', '2', '3', '2.5', '', '7']), strict=strict)
+    assert result['types'] == ['integer', 'real']
+    types, values = table(path)
+    assert types['v'] == 'REAL'
+    assert values == [(1.0, 'real'), (2.0, 'real'), (3.0, 'real'), (2.5, 'real'), (None, 'null'), (7.0, 'real')]
+
+
+def test_real_then_text_widens_twice(tmp_path):
+    path = str(tmp_path / 'w.db')
+    result = ingest(path, csv_of(['1', '2', '2.5', '3', 'n/a?', '4']))
+    assert result['types'] == ['integer', 'text']
+    assert table(path)[1][:3] == [('1.0', 'text'), ('2.0', 'text'), ('2.5', 'text')]
+
+
+def test_boolean_and_date_keep_spelling_when_widened(tmp_path):
+    path = str(tmp_path / 'w.db')
+    ingest(path, csv_of(['yes', 'no', 'maybe']))
+    assert table(path)[1] == [('yes', 'text'), ('no', 'text'), ('maybe', 'text')]
+
+    ingest(path, csv_of(['03/14/2024', '12/01/2023', 'soon']))
+    assert table(path)[1] == [('03/14/2024', 'text'), ('12/01/2023', 'text'), ('soon', 'text')]
+
+
+def test_stats_describe_the_widened_column(tmp_path):
+    path = str(tmp_path / 'w.db')
+    ingest(path, csv_of(['1', '2', '3', 'x', 'x']))
+    conn = sqlite3.connect(path)
+    stats = read_stats(conn)['items']['v']
+    conn.close()
+    assert stats['row_count'] == 5
+    assert stats['top_values'][0] == ['x', 2]
+    assert (stats['min'], stats['max']) == ('1', 'x')
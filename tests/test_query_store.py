@@ -0,0 +1,51 @@
+import sqlite3
+
+from functions.query_store import QueryStore
+
+
+def persisted(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT fingerprint, prompt FROM nl_sql_cache ORDER BY created_at").fetchall()
+    finally:
+        conn.close()
+
+
+def test_bounded_in_memory_and_index():
+    store = QueryStore(max_entries=2)
+    store.put('db', 'f1', 'total sales by region', 'Q1')
+    store.put('db', 'f1', 'customers per order', 'Q2')
+    assert store.get('db', 'f1', 'Total sales by region?') == 'Q1'  # Q2 is now the least recently used
+    store.put('db', 'f1', 'top 5 products', 'Q3')
+
+    assert store.stats()['entries'] == 2
+    assert store.get('db', 'f1', 'customers per order') is None
+    # The evicted prompt left the near-duplicate index too
+    assert store.get('db', 'f1', 'show the customers per order') is None
+    assert store.get('db', 'f1', 'show the total sales by region') == 'Q1'
+
+
+def test_persisted_table_is_pruned(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    store = QueryStore(path, max_entries=2)
+    for i in range(4):
+        store.put('db', 'f1', f'prompt number {i}', f'Q{i}')
+    assert persisted(path) == [('f1', 'prompt number 2'), ('f1', 'prompt number 3')]
+
+    warm = QueryStore(path, max_entries=2)
+    assert warm.warm_load() == 2
+    assert warm.get('db', 'f1', 'prompt number 3') == 'Q3'
+
+
+def test_new_schema_drops_stale_entries(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    store = QueryStore(path)
+    store.put('db', 'old', 'total sales by region', 'Q1')
+    store.put('other', 'old', 'total sales by region', 'Q2')
+    store.put('db', 'new', 'customers per order', 'Q3')
+
+    assert store.get('db', 'old', 'total sales by region') is None
+    assert ('db', 'old') not in store.indexes
+    assert store.get('other', 'old', 'total sales by region') == 'Q2'
+    assert store.stats()['entries'] == 2
+    assert sorted(persisted(path)) == [('new', 'customers per order'), ('old', 'total sales by region')]
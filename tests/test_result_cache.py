@@ -0,0 +1,31 @@
+import sqlite3
+
+from functions.database import get_sql_query
+from functions.result_cache import canonical_sql, result_cache
+
+
+def test_canonical_sql_folds_bare_words_only():
+    assert canonical_sql('SELECT  Name FROM T -- note\n WHERE a = \'X\';') == "select name from t where a = 'X'"
+    assert canonical_sql('SELECT "Name", [Total Sales], `Qty` FROM T') == 'select "Name", [Total Sales], `Qty` from t'
+    assert canonical_sql('SELECT "Name" FROM t') != canonical_sql('SELECT "name" FROM t')
+
+
+def test_write_through_run_sql_invalidates_results(make_db):
+    make_db('w.db', 'CREATE TABLE t (a INTEGER)', 'INSERT INTO t VALUES (1)')
+    assert get_sql_query('SELECT count(*) FROM t', 'w.db')['result'][1] == [[1]]
+
+    get_sql_query('INSERT INTO t VALUES (2)', 'w.db')
+    assert get_sql_query('SELECT count(*) FROM t', 'w.db')['result'][1] == [[2]]
+
+
+def test_outside_write_changes_data_version(make_db):
+    path = make_db('o.db', 'CREATE TABLE t (a INTEGER)', 'INSERT INTO t VALUES (1)')
+    assert get_sql_query('SELECT count(*) FROM t', 'o.db')['result'][1] == [[1]]
+    version = result_cache.data_version(path)
+
+    conn = sqlite3.connect(path)
+    conn.executemany('INSERT INTO t VALUES (?)', [(i,) for i in range(1000)])
+    conn.commit()
+    conn.close()
+    assert result_cache.data_version(path) != version
+    assert get_sql_query('SELECT count(*) FROM t', 'o.db')['result'][1] == [[1001]]
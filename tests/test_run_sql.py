@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def items_db(make_db):
+    make_db('items.db', 'CREATE TABLE items (id INTEGER, name TEXT)',
+            "INSERT INTO items VALUES (1, 'a'), (2, 'b'), (3, 'c')")
+    return 'items.db'
+
+
+def run_sql(client, query, db_name, **data):
+    return client.post('/run-sql', json={'query': query, 'databaseName': db_name, **data})
+
+
+@pytest.mark.parametrize('stream', [None, 'ndjson', 'json'])
+def test_sql_error_is_json(client, items_db, stream):
+    response = run_sql(client, 'SELECT * FROM missing', items_db, stream=stream)
+    assert response.status_code == 400
+    assert response.get_json() == {'status': 'error', 'error': 'sql_error', 'message': 'no such table: missing'}
+
+
+def test_stream_ndjson_page(client, items_db):
+    response = run_sql(client, 'SELECT id FROM items ORDER BY id', items_db, stream='ndjson', limit=2, cursor=1)
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert lines == [{'query': 'SELECT id FROM items ORDER BY id', 'headers': ['id']}, [2], [3],
+                     {'next_cursor': None, 'row_count': 2}]
+
+
+def test_stream_json_empty_result(client, items_db):
+    response = run_sql(client, 'SELECT id FROM items WHERE id > 5', items_db, stream='json')
+    assert response.get_json() == {'query': 'SELECT id FROM items WHERE id > 5', 'result': [['id'], []],
+                                   'next_cursor': None}
+
+
+@pytest.mark.parametrize('field, value', [
+    ('limit', 'ten'), ('limit', 0), ('limit', 2.5), ('cursor', -1), ('cursor', [1]), ('max_points', -5), ('max_points', 'x'),
+])
+def test_invalid_integer_fields(client, items_db, field, value):
+    response = run_sql(client, 'SELECT id FROM items', items_db, **{field: value})
+    assert response.status_code == 400
+    body = response.get_json()
+    assert (body['status'], body['error'], body['field']) == ('error', 'invalid_field', field)
+
+
+def test_integer_fields_as_strings(client, items_db):
+    response = run_sql(client, 'SELECT id FROM items ORDER BY id', items_db, limit='2', cursor='1')
+    assert response.get_json()['result'] == [['id'], [[2], [3]]]
+    response = run_sql(client, 'SELECT id, id * 2 AS twice FROM items ORDER BY id', items_db, max_points='0')
+    assert response.get_json()['row_count'] == 3
@@ -0,0 +1,28 @@
+from functions.similarity import PromptIndex, prompt_tokens
+
+
+def make_index(*prompts):
+    index = PromptIndex()
+    for i, prompt in enumerate(prompts):
+        index.add(prompt, f'Q{i}')
+    return index
+
+
+def test_tokens_include_bigrams():
+    tokens = prompt_tokens('Customers per order')
+    assert {'customer', 'per', 'order', 'customer per', 'per order'} == tokens
+
+
+def test_word_order_and_role_survive():
+    index = make_index('customers per order', 'total sales by region')
+    assert index.find('orders per customer', 0.5) == (None, 0.0)
+    assert index.find('total sales region', 0.5) == (None, 0.0)
+    assert index.find('total sales by city', 0.5) == (None, 0.0)
+
+
+def test_near_duplicates_still_match():
+    index = make_index('customers per order', 'top 5 products by revenue')
+    assert index.find('show the customers per order', 0.9) == ('Q0', 1.0)
+    assert index.find('the top five products by revenue', 0.9) == ('Q1', 1.0)
+    assert index.find('top 10 products by revenue', 0.5) == (None, 0.0)
+    assert index.find('lowest 5 products by revenue', 0.5) == (None, 0.0)
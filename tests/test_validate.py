@@ -0,0 +1,35 @@
+import pytest
+
+from functions.sql import SqlConn, SqlValidationError
+
+
+@pytest.fixture
+def conn(make_db):
+    make_db('v.db', 'CREATE TABLE items (id INTEGER, name TEXT)')
+    with SqlConn('v.db', readonly=True) as sql:
+        yield sql
+
+
+def test_select_is_valid(conn):
+    conn.validate('SELECT upper(name), count(*) FROM items GROUP BY name')
+
+
+@pytest.mark.parametrize('query', [
+    "SELECT load_extension('/tmp/evil.so')",
+    "SELECT LOAD_EXTENSION('/tmp/evil.so', 'entry') FROM items",
+    "SELECT id FROM items WHERE name = (SELECT fts3_tokenizer('simple'))",
+])
+def test_risky_functions_are_denied(conn, query):
+    with pytest.raises(SqlValidationError, match='not allowed: function'):
+        conn.validate(query)
+
+
+@pytest.mark.parametrize('query', ["DELETE FROM items", "ATTACH DATABASE '/tmp/x.db' AS x"])
+def test_writes_are_denied(conn, query):
+    with pytest.raises(SqlValidationError, match='not allowed'):
+        conn.validate(query)
+
+
+def test_load_extension_disabled_on_pooled_connections(conn):
+    with pytest.raises(Exception, match='not authorized'):
+        conn.conn.execute("SELECT load_extension('/tmp/evil.so')")